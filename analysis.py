@@ -1,25 +1,41 @@
 import os
+import contextlib
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 from datetime import datetime, timezone
 import time
 import json
-import matplotlib.pyplot as plt
-import seaborn as sns
-from plotly import express as px
-import plotly.graph_objects as go
 import warnings
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from dateutil.parser import parse
+import dataset
+from streaming_stats import QuantileSketch
+from profile_index import update_index
+from manifest import Manifest, DEFAULT_MANIFEST
+from metrics import METRICS, start_profiler, stop_profiler
 warnings.filterwarnings('ignore')
 
-# 配置可视化风格
-plt.style.use('ggplot')
-sns.set_palette("husl")
-
-# 文件路径配置
+# 文件路径配置（命令行 --input-dir / --output-dir 可覆盖）
 parquet_dir = '/work/share/acf6pa03fy/liyanjie/data/10G_data_new'
 output_dir = 'user_profiles'
-os.makedirs(output_dir, exist_ok=True)
+
+def set_output_dir(path):
+    """设置画像与可视化的输出目录（多进程模式下作为工作进程的 initializer）"""
+    global output_dir
+    output_dir = path
+    os.makedirs(output_dir, exist_ok=True)
+
+def plotting():
+    """按需加载 plotly：只有渲染可视化时才导入，无可视化的运行和工作进程不付出导入开销"""
+    from plotly import express as px
+    import plotly.graph_objects as go
+    return px, go
 
 # 添加在 build_user_profile() 函数之前
 def get_age_segment(age):
@@ -33,9 +49,13 @@ def get_age_segment(age):
 
 def parse_purchase_history(history):
     """解析购买历史（增强版）"""
-    data = safe_json_parse(history)
+    PARSE_STATS["json_parsed"] += 1
+    return summarize_purchase(safe_json_parse(history))
+
+def summarize_purchase(data):
+    """由已解码的购买历史生成消费画像"""
     if not data:
-        return {"avg_price": 0, "main_category": "无记录"}
+        return {"avg_price": 0.0, "main_category": "无记录"}
     
     try:
         # 处理多种可能的数据结构
@@ -51,11 +71,14 @@ def parse_purchase_history(history):
             "purchase_count": len(items) if isinstance(items, (list, dict)) else 0
         }
     except Exception as e:
-        print(f"解析购买历史出错: {e}")
+        METRICS.error('purchase_history', e)
         return {"error": str(e)}
 # 辅助函数增强健壮性
 def safe_json_parse(json_str):
     """更安全的JSON解析"""
+    if isinstance(json_str, dict):
+        # 压缩后的嵌套列：空字段视为缺少该键，列表字段为 ndarray
+        return {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in json_str.items() if v is not None}
     if pd.isna(json_str) or not json_str:
         return {}
     try:
@@ -63,8 +86,6 @@ def safe_json_parse(json_str):
             # 处理单引号和非标准JSON
             json_str = json_str.replace("'", '"').replace("None", "null")
             return json.loads(json_str)
-        elif isinstance(json_str, dict):
-            return json_str
         return {}
     except json.JSONDecodeError:
         return {}
@@ -75,7 +96,7 @@ def parse_datetime(dt_str):
         if pd.isna(dt_str):
             return pd.NaT
         
-        dt = parse(dt_str)
+        dt = dt_str if isinstance(dt_str, datetime) else parse(dt_str)
         # 如果已经是带时区的，转换为UTC；否则标记为UTC
         if dt.tzinfo is not None:
             return dt.astimezone(timezone.utc)
@@ -83,6 +104,59 @@ def parse_datetime(dt_str):
             return dt.replace(tzinfo=timezone.utc)
     except (ValueError, TypeError):
         return pd.NaT
+# 向量化时间解析：先在样本上识别主流格式，整列按该格式解析，失败行再回退 dateutil
+DATETIME_FORMATS = ['ISO8601', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y']
+
+def detect_datetime_format(values, sample_size=1000):
+    """在非空样本上检测解析成功率最高的时间格式"""
+    sample = values.dropna().iloc[:sample_size]
+    best_format, best_count = None, 0
+    for fmt in DATETIME_FORMATS:
+        count = pd.to_datetime(sample, format=fmt, utc=True, errors='coerce').notna().sum()
+        if count > best_count:
+            best_format, best_count = fmt, count
+        if count == len(sample):
+            break
+    return best_format
+
+def parse_datetime_series(values):
+    """
+    整列/列表时间解析（结果统一为UTC，与 ensure_tz_aware(parse_datetime(x)) 一致）
+    参数:
+        values (Series|list): 时间字符串
+    返回:
+        Series: datetime64[UTC]，无法解析的为 NaT
+    """
+    values = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        PARSE_STATS["datetime_vectorized"] += int(values.notna().sum())
+        if values.dt.tz is None:
+            return values.dt.tz_localize(timezone.utc)
+        return values.dt.tz_convert(timezone.utc)
+
+    fmt = detect_datetime_format(values)
+    if fmt is None:
+        result = pd.Series(pd.NaT, index=values.index, dtype='datetime64[us, UTC]')
+    else:
+        result = pd.to_datetime(values, format=fmt, utc=True, errors='coerce')
+
+    # 主格式解析失败的行回退到 dateutil
+    failed = result.isna() & values.notna()
+    fallback_count = int(failed.sum())
+    if fallback_count:
+        result = result.astype(object)
+        result[failed] = [parse_datetime(v) for v in values[failed]]
+        result = pd.to_datetime(result, utc=True)
+    PARSE_STATS["datetime_vectorized"] += int(values.notna().sum()) - fallback_count
+    PARSE_STATS["datetime_fallback"] += fallback_count
+    return result
+
+# 常见城市标识符（可根据实际数据调整），按优先级排列
+CITY_INDICATORS = ['市', '区', '州', '县']
+# 与 parse_city 等价的正则：标识符首次出现之前的前缀非空时，取前缀加标识符
+CITY_PATTERNS = [f"^([^{indicator}]+{indicator})" for indicator in CITY_INDICATORS]
+CITY_CACHE_SIZE = 100_000
+
 def parse_city(address):
     """
     从地址字符串中解析城市信息
@@ -94,9 +168,7 @@ def parse_city(address):
     if not isinstance(address, str):
         return "未知"
     
-    # 常见城市标识符（可根据实际数据调整）
-    city_indicators = ['市', '区', '州', '县']
-    for indicator in city_indicators:
+    for indicator in CITY_INDICATORS:
         if indicator in address:
             # 提取市名（如"北京市朝阳区" -> "北京"）
             parts = address.split(indicator)
@@ -104,6 +176,53 @@ def parse_city(address):
                 return parts[0] + indicator
     return "未知"
 
+_CITY_CACHE = OrderedDict()
+
+def parse_city_cached(address):
+    """带有界 LRU 缓存的 parse_city（逐行路径），命中与未命中次数计入 PARSE_STATS"""
+    if not isinstance(address, str):
+        return "未知"
+    city = _CITY_CACHE.get(address)
+    if city is not None:
+        _CITY_CACHE.move_to_end(address)
+        PARSE_STATS["city_cache_hits"] += 1
+        return city
+    PARSE_STATS["city_cache_misses"] += 1
+    city = _CITY_CACHE[address] = parse_city(address)
+    if len(_CITY_CACHE) > CITY_CACHE_SIZE:
+        _CITY_CACHE.popitem(last=False)
+    return city
+
+def parse_city_series(addresses):
+    """
+    批量解析城市，结果与逐个调用 parse_city 完全一致
+    按标识符优先级依次 str.extract，前面的标识符未匹配的地址才尝试下一个；非字符串为"未知"
+    参数:
+        addresses (Series): 地址列（高重复时应先去重再传入）
+    返回:
+        Series: 城市名称，object 类型
+    """
+    addresses = pd.Series(addresses, dtype=object)
+    is_str = np.fromiter((isinstance(a, str) for a in addresses), bool, len(addresses))
+    text = addresses[is_str].astype(str)
+    city = pd.Series(None, index=text.index, dtype=object)
+    for pattern in CITY_PATTERNS:
+        missing = city.isna().to_numpy()
+        if not missing.any():
+            break
+        city[missing] = text[missing].str.extract(pattern, expand=False).astype(object)
+    result = pd.Series("未知", index=addresses.index, dtype=object)
+    result[is_str] = city.where(city.notna(), "未知")
+    return result
+
+def to_number(value, default):
+    """转为浮点数，空值或无法转换时返回 default（与批量路径的 pd.to_numeric(errors='coerce') 一致）"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return float(default)
+    return float(default) if np.isnan(number) else number
+
 def ensure_tz_aware(dt):
     """确保时间对象带有时区（统一为UTC）"""
     if pd.isna(dt):
@@ -112,43 +231,87 @@ def ensure_tz_aware(dt):
         return dt.replace(tzinfo=timezone.utc)
     return dt.astimezone(timezone.utc)
 
+# 历史数据解析层：每行的购买/登录历史只解码一次，供各画像阶段共享
+PARSE_STATS = {"json_parsed": 0, "json_reused": 0, "datetime_parsed": 0, "datetime_reused": 0,
+               "datetime_vectorized": 0, "datetime_fallback": 0,
+               "city_cache_hits": 0, "city_cache_misses": 0, "city_rows": 0, "city_vectorized": 0,
+               "compacted_rows": 0}
+
+def parse_histories(purchase_history, login_history, parse_times=True):
+    """一次性解码单行的购买历史和登录历史"""
+    PARSE_STATS["json_parsed"] += 1
+    return {
+        "purchase": safe_json_parse(purchase_history),
+        "login": decode_login_history(login_history, parse_times),
+    }
+
+def _mark_reused(parsed, json_calls):
+    """记录复用解析结果所避免的解析调用次数"""
+    PARSE_STATS["json_reused"] += json_calls
+    PARSE_STATS["datetime_reused"] += parsed["login"]["raw_count"]
+
+def report_parse_stats():
+    """打印解析复用统计"""
+    saved = PARSE_STATS["json_reused"] + PARSE_STATS["datetime_reused"]
+    print(f"JSON解析 {PARSE_STATS['json_parsed']} 次 (复用 {PARSE_STATS['json_reused']} 次) | "
+          f"时间解析 {PARSE_STATS['datetime_parsed']} 次 (复用 {PARSE_STATS['datetime_reused']} 次) | "
+          f"共避免 {saved} 次重复解析")
+    print(f"向量化时间解析 {PARSE_STATS['datetime_vectorized']} 行 | "
+          f"回退 dateutil {PARSE_STATS['datetime_fallback']} 行")
+    if PARSE_STATS["compacted_rows"]:
+        print(f"压缩输入（免解析）: {PARSE_STATS['compacted_rows']} 行")
+    lookups = PARSE_STATS["city_cache_hits"] + PARSE_STATS["city_cache_misses"]
+    if lookups:
+        print(f"城市解析缓存: 命中 {PARSE_STATS['city_cache_hits']}/{lookups} 次 "
+              f"({PARSE_STATS['city_cache_hits'] / lookups:.1%})")
+    if PARSE_STATS["city_rows"]:
+        print(f"批量城市解析: {PARSE_STATS['city_rows']} 行去重后解析 {PARSE_STATS['city_vectorized']} 个地址")
+
 # 画像构建函数（修正时区问题）
-def build_user_profile(row):
-    """构建单用户画像（增强健壮性）"""
+def build_user_profile(row, parsed=None, now=None):
+    """构建单用户画像（增强健壮性）；parsed 为 parse_histories 的结果时直接复用，now 为RFM参考时间"""
     try:
+        if parsed is None:
+            parsed = parse_histories(row.get('purchase_history'), row.get('login_history'))
         # 基础属性（增加空值处理）
-        age = int(row['age']) if pd.notna(row['age']) else -1
-        income = float(row['income']) if pd.notna(row['income']) else 0
+        age = np.trunc(to_number(row['age'], -1))
+        income = to_number(row['income'], 0)
         
         # 处理时区敏感字段
         last_login = ensure_tz_aware(parse_datetime(row['last_login']))
         registration_date = ensure_tz_aware(parse_datetime(row['registration_date']))
         
+        consumption = summarize_purchase(parsed["purchase"])
+        activity = summarize_login(parsed["login"], last_login, now)
+        _mark_reused(parsed, json_calls=2)
+
         profile = {
             "basic": {
                 "age_segment": get_age_segment(age),
                 "income_level": "高" if income > 500000 else ("中" if income > 100000 else "低"),
-                "geo_group": f"{row.get('country', '未知')}-{parse_city(row.get('address', ''))}",
+                "geo_group": f"{row.get('country', '未知')}-{parse_city_cached(row.get('address', ''))}",
                 "gender": str(row.get('gender', '未知')).replace("'", "")
             },
-            "consumption": parse_purchase_history(row.get('purchase_history')),
-            "activity": parse_login_history(row.get('login_history'), last_login),
-            "value": calculate_user_value(row, last_login),
-            "_raw_login_history": row.get('login_history', ''),  # 保存原始数据用于可视化
-            "_raw_purchase_history": row.get('purchase_history', '')
+            "consumption": consumption,
+            "activity": activity,
+            "value": calculate_user_value(row, last_login, consumption, activity, now),
+            "_raw_login_history": _raw_text(row.get('login_history', '')),  # 保存原始数据用于可视化
+            "_raw_purchase_history": _raw_text(row.get('purchase_history', ''))
         }
         return profile
     except Exception as e:
-        print(f"构建用户画像出错 (ID: {row.get('id', '未知')}): {str(e)}")
+        METRICS.error('profile', e, row.get('id', '未知'))
         return None
 
-def calculate_user_value(row, last_login):
-    """计算用户价值（修正时区问题）"""
-    purchase = parse_purchase_history(row.get('purchase_history'))
-    login = parse_login_history(row.get('login_history'), last_login)
+def calculate_user_value(row, last_login, purchase=None, login=None, now=None):
+    """计算用户价值（修正时区问题）；可传入已生成的消费/活跃画像避免重复解析，now 缺省为当前UTC时间"""
+    if purchase is None:
+        purchase = parse_purchase_history(row.get('purchase_history'))
+    if login is None:
+        login = parse_login_history(row.get('login_history'), last_login)
     
     # 处理可能的None值
-    avg_price = purchase.get('avg_price', 0) or 0
+    avg_price = to_number(purchase.get('avg_price'), 0)
     purchase_count = purchase.get('purchase_count', 0) or 0
     login_count = login.get('login_count', 0) or 0
     
@@ -156,7 +319,7 @@ def calculate_user_value(row, last_login):
     frequency = login_count
     
     # 统一时区处理
-    now = datetime.now(timezone.utc)
+    now = now or datetime.now(timezone.utc)
     last_login_dt = ensure_tz_aware(last_login)
     recency = (now - last_login_dt).days if pd.notna(last_login_dt) else -1
     
@@ -174,26 +337,59 @@ def calculate_user_value(row, last_login):
 
 def parse_login_history(history, last_login):
     """解析登录历史（修正时区问题）"""
+    return summarize_login(decode_login_history(history), last_login)
+
+def decode_login_history(history, parse_times=True):
+    """
+    解码登录历史并解析其中的时间戳（每条记录只做一次）
+    参数:
+        parse_times (bool): 为 False 时只保留原始时间戳(raw)，由调用方批量解析后填入 times
+    返回:
+        dict: data 为解码后的字典, times 为有效登录时间(UTC),
+              raw_count 为原始时间戳个数, error 为解码中的异常
+    """
     data = safe_json_parse(history)
+    PARSE_STATS["json_parsed"] += 1
+    decoded = {"data": data, "times": [], "raw": [], "raw_count": 0, "error": None}
     if not data:
-        return {"login_count": 0}
-    
+        return decoded
+
     try:
         # 处理时间戳数据
         timestamps = data.get('timestamps', [])
         if isinstance(timestamps, str):
             timestamps = safe_json_parse(timestamps) or []
-        
-        valid_logins = []
+
+        if not parse_times:
+            decoded["raw"] = list(timestamps)
+            decoded["raw_count"] = len(decoded["raw"])
+            return decoded
+
         for ts in timestamps:
+            decoded["raw_count"] += 1
             dt = ensure_tz_aware(parse_datetime(ts))
             if pd.notna(dt):
-                valid_logins.append(dt)
-        
+                decoded["times"].append(dt)
+        PARSE_STATS["datetime_parsed"] += decoded["raw_count"]
+    except Exception as e:
+        decoded["error"] = e
+    return decoded
+
+def summarize_login(decoded, last_login, now=None):
+    """由 decode_login_history 的结果生成活跃度画像（最近30天以 now 为准，缺省为当前UTC时间）"""
+    data = decoded["data"]
+    if not data:
+        return {"login_count": 0}
+
+    try:
+        if decoded["error"] is not None:
+            raise decoded["error"]
+        valid_logins = decoded["times"]
+
         # 计算最近30天活跃（使用UTC时间）
         last_30d = 0
         if pd.notna(last_login):
-            cutoff = datetime.now(timezone.utc) - pd.Timedelta(days=30)
+            cutoff = (now or datetime.now(timezone.utc)) - pd.Timedelta(days=30)
             last_30d = sum(1 for d in valid_logins if d >= cutoff)
         
         return {
@@ -203,15 +399,323 @@ def parse_login_history(history, last_login):
             "avg_session_duration": float(data.get('avg_session_duration', 0))
         }
     except Exception as e:
-        print(f"解析登录历史出错: {e}")
+        METRICS.error('login_history', e)
         return {"error": str(e)}
 
+# 批量画像构建（列式向量化，字段与 build_user_profile 一致）
+PROFILE_INPUT_COLUMNS = ['id', 'age', 'income', 'gender', 'country', 'address',
+                         'last_login', 'registration_date', 'purchase_history', 'login_history']
+# 读取时降精度的列：收入保持 float64，float32 会让 10万/50万 附近的收入落到另一个收入等级
+PROFILE_DOWNCAST_COLUMNS = ['age']
+CONSUMPTION_FIELDS = ['avg_price', 'main_category', 'payment_method', 'refund_rate', 'purchase_count']
+ACTIVITY_FIELDS = ['login_count', 'devices', 'last_30d_logins', 'avg_session_duration']
+PROFILE_SECTIONS = {
+    'basic': ['age_segment', 'income_level', 'geo_group', 'gender'],
+    'consumption': CONSUMPTION_FIELDS + ['error'],
+    'activity': ACTIVITY_FIELDS + ['error'],
+    'value': ['rfm_score', 'monetary', 'recency', 'frequency'],
+}
+AGE_BINS = [-np.inf, -1, 17, 25, 35, 50, np.inf]
+AGE_LABELS = ["未知", "未成年", "18-25", "26-35", "36-50", "50+"]
+INCOME_LEVELS = ["低", "中", "高"]
+# 取值很少的画像字段：画像表中为 pandas 分类列，parquet 中为字典编码列
+CATEGORICAL_PROFILE_COLUMNS = ['basic.age_segment', 'basic.income_level', 'basic.geo_group', 'basic.gender',
+                               'consumption.main_category', 'consumption.payment_method']
+
+def _column(df, name, default):
+    """取列，不存在时返回同长度的默认值列"""
+    if name in df.columns:
+        return df[name]
+    return pd.Series(default, index=df.index, dtype=object)
+
+def _categorical(codes, values, index):
+    """由 factorize 的编码和每个唯一值的映射结果构造 Categorical（映射后相同的取值合并为一个类别）"""
+    value_codes, categories = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=False)
+    return pd.Series(pd.Categorical.from_codes(value_codes[codes], categories.astype(object)), index=index)
+
+def _apply_unique(series, func):
+    """对去重后的取值调用标量函数再广播回整列（地址等高重复字段），结果为分类列"""
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    return _categorical(codes, [func(u) for u in uniques], series.index)
+
+def get_age_segment_series(age):
+    """批量年龄分段，与 get_age_segment(int(age)) 一致（分类列）"""
+    age = np.trunc(pd.to_numeric(age, errors='coerce')).fillna(-1)
+    return pd.cut(age, bins=AGE_BINS, labels=AGE_LABELS, ordered=False)
+
+def get_income_level_series(income):
+    """批量收入等级（>50万为高，>10万为中，分类列）"""
+    income = pd.to_numeric(income, errors='coerce').fillna(0)
+    codes = np.select([income > 500000, income > 100000], [2, 1], default=0)
+    return pd.Series(pd.Categorical.from_codes(codes, INCOME_LEVELS), index=income.index)
+
+def get_geo_group_series(country, address):
+    """批量地理分组 "国家-城市"：国家和地址分别去重，只对出现过的组合拼接字符串"""
+    country_codes, countries = pd.factorize(country, use_na_sentinel=False)
+    address_codes, addresses = pd.factorize(address, use_na_sentinel=False)
+    city_codes, cities = pd.factorize(parse_city_series(addresses).to_numpy())
+    PARSE_STATS["city_rows"] += len(address)
+    PARSE_STATS["city_vectorized"] += len(addresses)
+    pair_codes, pairs = pd.factorize(country_codes * max(len(cities), 1) + city_codes[address_codes])
+    names = [f"{countries[p // max(len(cities), 1)]}-{cities[p % max(len(cities), 1)]}" for p in pairs]
+    return _categorical(pair_codes, names, country.index)
+
+def categorize_profile_columns(table):
+    """把画像表中的低基数字段转为分类列（逐行路径得到的画像表与批量路径保持一致）"""
+    for column in CATEGORICAL_PROFILE_COLUMNS:
+        if column in table.columns and not isinstance(table[column].dtype, pd.CategoricalDtype):
+            codes, uniques = pd.factorize(table[column])
+            table[column] = pd.Categorical.from_codes(codes, pd.Index(uniques, dtype=object))
+    return table
+
+def _section_frame(records, fields, int_fields, index):
+    """把解析出的字典列表展开为带前缀的列"""
+    frame = pd.DataFrame.from_records(records, columns=fields, index=index)
+    for field in int_fields:
+        frame[field] = pd.to_numeric(frame[field], errors='coerce').astype('Int64')
+    return frame
+
+# RFM评分：默认按固定阈值（与 calculate_user_value 一致），也可按全量数据集的五分位点分档
+RFM_WEIGHTS = {'recency': 0.5, 'frequency': 0.3, 'monetary': 0.2}
+RFM_COLUMNS = {'recency': 'value.recency', 'frequency': 'value.frequency', 'monetary': 'value.monetary'}
+RFM_QUANTILES = [0.2, 0.4, 0.6, 0.8]
+RFM_INTEGER_METRICS = {'recency', 'frequency'}  # 整数指标的分位点取整，避免近似误差把并列值分到不同档
+
+def rfm_scores(recency, frequency, monetary, bins=None):
+    """
+    批量计算 R/F/M 分（1-5）
+    参数:
+        recency (ndarray): 距参考时间的天数，未知为 -1
+        bins (dict): rfm_bins 得到的各指标分位点；为 None 时用固定阈值
+    返回:
+        (ndarray, ndarray, ndarray): r_score, f_score, m_score
+    """
+    recency, frequency, monetary = (np.asarray(v, dtype=float) for v in (recency, frequency, monetary))
+    if bins is None:
+        # 注意：recency 未知(-1)时沿用原实现，落入 <=30 分支
+        r_score = np.select([recency <= 30, recency <= 90], [5, 3], default=1)
+        f_score = np.select([frequency >= 20, frequency >= 5], [5, 3], default=1)
+        m_score = np.select([monetary >= 10000, monetary >= 1000], [5, 3], default=1)
+        return r_score, f_score, m_score
+    # 分位数分档：不超过第一个分位点为1档（recency 越小越好，反向），recency 未知为最低档
+    r_score = np.where(recency < 0, 1, 5 - np.searchsorted(bins['recency'], recency, side='left'))
+    f_score = 1 + np.searchsorted(bins['frequency'], frequency, side='left')
+    m_score = 1 + np.searchsorted(bins['monetary'], monetary, side='left')
+    return r_score, f_score, m_score
+
+def rfm_total(r_score, f_score, m_score):
+    """加权总分"""
+    return np.round(r_score * RFM_WEIGHTS['recency'] + f_score * RFM_WEIGHTS['frequency']
+                    + m_score * RFM_WEIGHTS['monetary'], 2)
+
+def calculate_user_value_batch(consumption, activity, last_login, now=None, bins=None):
+    """批量RFM计算：整批共用一个参考时间 now；bins 为 None 时与 calculate_user_value 的阈值和权重一致"""
+    now = now or datetime.now(timezone.utc)
+    avg_price = pd.to_numeric(consumption['avg_price'], errors='coerce').fillna(0)
+    purchase_count = consumption['purchase_count'].fillna(0).astype('int64')
+    frequency = activity['login_count'].fillna(0).astype('int64')
+    monetary = avg_price * purchase_count
+
+    recency = (now - last_login).dt.days
+    recency = recency.where(last_login.notna(), -1).astype('int64')
+
+    return pd.DataFrame({
+        'rfm_score': rfm_total(*rfm_scores(recency, frequency, monetary, bins)),
+        'monetary': monetary,
+        'recency': recency.where(recency >= 0).astype('Int64'),
+        'frequency': frequency,
+    }, index=last_login.index)
+
+def parse_as_of(value=None):
+    """解析RFM参考时间（未指定时返回 None，处理时取当前时间）；指定后整次运行共用，结果可复现"""
+    if not value:
+        return None
+    as_of = ensure_tz_aware(parse_datetime(value))
+    if pd.isna(as_of):
+        raise ValueError(f"无法解析的参考时间: {value}")
+    return as_of
+
+def parse_histories_batch(df):
+    """对整个DataFrame逐行解码历史数据（每行一次），登录时间戳拼成一列批量解析"""
+    if is_nested(_column(df, 'purchase_history', '')) and is_nested(_column(df, 'login_history', '')):
+        return parse_nested_histories(df['purchase_history'], df['login_history'])
+    parsed = [
+        parse_histories(p, l, parse_times=False)
+        for p, l in zip(_column(df, 'purchase_history', ''), _column(df, 'login_history', ''))
+    ]
+    raw = [ts for p in parsed for ts in p["login"]["raw"]]
+    time_series = parse_datetime_series(raw) if raw else pd.Series(dtype='datetime64[us, UTC]')
+    times = list(time_series)
+    PARSE_STATS["datetime_parsed"] += len(raw)
+    matrices = login_activity_matrices(time_series, [p["login"]["raw_count"] for p in parsed])
+
+    start = 0
+    for p, matrix in zip(parsed, matrices):
+        login = p["login"]
+        end = start + login["raw_count"]
+        login["times"] = [t for t in times[start:end] if t is not pd.NaT]
+        login["raw"] = []
+        login["matrix"] = matrix
+        start = end
+    return parsed
+
+def is_nested(series):
+    """是否为压缩后的嵌套历史列（见 compact.py）"""
+    return isinstance(series.dtype, pd.ArrowDtype) and pa.types.is_struct(series.dtype.pyarrow_dtype)
+
+def _raw_text(value):
+    """原始历史字符串；压缩后的嵌套输入没有原始字符串，记为空"""
+    return None if isinstance(value, dict) else value
+
+def _struct_records(series, fields):
+    """嵌套列的指定字段转为逐行字典（空字段不出现，与JSON缺少该键一致；整行为空时为 {}）"""
+    columns = [pa.array(series.struct.field(f)).to_pylist() for f in fields]
+    valid = series.notna().to_numpy()
+    return [
+        {f: v for f, v in zip(fields, values) if v is not None} if ok else {}
+        for ok, values in zip(valid, zip(*columns))
+    ]
+
+def parse_nested_histories(purchase, login):
+    """
+    压缩后的嵌套历史列：直接取结构化字段，不做 JSON 和时间解析
+    返回:
+        list: 与 parse_histories_batch 相同结构的解析结果
+    """
+    purchases = _struct_records(purchase, purchase.dtype.pyarrow_dtype.names)
+    logins = _struct_records(login, ['devices', 'avg_session_duration'])
+    timestamps = pa.array(login.struct.field('timestamps'))
+    counts = pc.list_value_length(timestamps).fill_null(0).to_numpy()
+    time_series = pc.list_flatten(timestamps).to_pandas()
+    matrices = login_activity_matrices(time_series, counts)
+    # 直接转为 datetime 对象数组，按每人的区间切片（不逐个构造 Timestamp）
+    times = time_series.array.to_pydatetime()
+    is_valid = time_series.notna().to_numpy()
+    has_timestamps = timestamps.is_valid().to_numpy(zero_copy_only=False)
+    PARSE_STATS["compacted_rows"] += len(login)
+
+    parsed, start = [], 0
+    for data, count, present, matrix, purchase_data in zip(logins, counts, has_timestamps, matrices, purchases):
+        end = start + count
+        valid = times[start:end][is_valid[start:end]].tolist()
+        if present:
+            data['timestamps'] = valid
+        parsed.append({
+            "purchase": purchase_data,
+            "login": {"data": data, "times": valid, "raw": [], "raw_count": int(count), "error": None,
+                      "matrix": matrix},
+        })
+        start = end
+    return parsed
+
+# 登录活跃矩阵：每个用户 7x24（星期 x 小时，UTC）的登录次数
+HEATMAP_SLOTS = 7 * 24
+LOGIN_MATRIX_COLUMN = 'activity.login_matrix'
+
+def login_activity_matrices(times, counts):
+    """
+    对拼接后的登录时间一次 np.bincount，得到所有用户的 7x24 登录矩阵
+    参数:
+        times (Series): 各用户登录时间按顺序拼成的一列（UTC，可含 NaT）
+        counts (list): 每个用户的时间戳个数
+    返回:
+        ndarray: (用户数, 7, 24) uint16，计数超过 65535 的截断
+    """
+    users = np.repeat(np.arange(len(counts)), counts)
+    valid = times.notna().to_numpy()
+    slots = (users[valid] * HEATMAP_SLOTS
+             + times[valid].dt.weekday.to_numpy() * 24 + times[valid].dt.hour.to_numpy())
+    flat = np.bincount(slots, minlength=len(counts) * HEATMAP_SLOTS)
+    return np.minimum(flat, np.iinfo(np.uint16).max).astype(np.uint16).reshape(len(counts), 7, 24)
+
+def build_profiles_batch(df, now=None, parsed=None):
+    """
+    对整个DataFrame批量构建画像表
+    参数:
+        df (DataFrame): 原始用户数据
+        now (datetime): RFM与最近30天活跃的参考时间，默认为当前UTC时间
+        parsed (list): parse_histories_batch 的结果，缺省时内部解析
+    返回:
+        DataFrame: 每行一个用户，列名为 "basic.age_segment" 形式的扁平字段
+    """
+    now = now or datetime.now(timezone.utc)
+    purchase_raw = _column(df, 'purchase_history', '')
+    login_raw = _column(df, 'login_history', '')
+
+    last_login = parse_datetime_series(df['last_login'])
+
+    basic = pd.DataFrame({
+        'age_segment': get_age_segment_series(df['age']),
+        'income_level': get_income_level_series(df['income']),
+        'geo_group': get_geo_group_series(_column(df, 'country', '未知'), _column(df, 'address', '')),
+        'gender': _apply_unique(_column(df, 'gender', '未知'), lambda g: str(g).replace("'", "")),
+    }, index=df.index)
+
+    if parsed is None:
+        parsed = parse_histories_batch(df)
+    consumption = _section_frame(
+        [summarize_purchase(p["purchase"]) for p in parsed],
+        PROFILE_SECTIONS['consumption'], ['refund_rate', 'purchase_count'], df.index
+    )
+    activity = _section_frame(
+        [summarize_login(p["login"], ll, now) for p, ll in zip(parsed, last_login)],
+        PROFILE_SECTIONS['activity'], ['login_count', 'last_30d_logins'], df.index
+    )
+    value = calculate_user_value_batch(consumption, activity, last_login, now)
+    for p in parsed:
+        _mark_reused(p, json_calls=2)
+
+    sections = {'basic': basic, 'consumption': consumption, 'activity': activity, 'value': value}
+    table = pd.concat(
+        [frame.add_prefix(f"{name}.") for name, frame in sections.items()], axis=1
+    )
+    table.insert(0, 'user_id', df['id'].values)
+    table[LOGIN_MATRIX_COLUMN] = [p["login"].get("matrix") for p in parsed]
+    categorize_profile_columns(table)
+    table['_raw_login_history'] = None if is_nested(login_raw) else login_raw.values
+    table['_raw_purchase_history'] = None if is_nested(purchase_raw) else purchase_raw.values
+    return table.reset_index(drop=True)
+
+def _present(value):
+    """判断字段是否有值（列表型字段如 devices 视为有值，从 parquet 读回时为 ndarray）"""
+    return isinstance(value, (list, np.ndarray)) or pd.notna(value)
+
+def _to_python(value):
+    """把numpy标量和数组转换为原生Python类型"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value.item() if isinstance(value, np.generic) else value
+
+def profiles_from_table(table):
+    """把 build_profiles_batch 的画像表（或读回的 parquet 画像）还原为与 process_file 相同的嵌套记录"""
+    records = []
+    for row in table.to_dict('records'):
+        profile = {}
+        for section, fields in PROFILE_SECTIONS.items():
+            values = {f: row[f"{section}.{f}"] for f in fields}
+            if _present(values.get('error')):
+                profile[section] = {"error": values['error']}
+                continue
+            if section == 'value' and not _present(values['recency']):
+                values['recency'] = "未知"
+            profile[section] = {f: _to_python(v) for f, v in values.items() if f != 'error' and _present(v)}
+        profile['_raw_login_history'] = row.get('_raw_login_history')  # parquet 未保留原始列时为空
+        profile['_raw_purchase_history'] = row.get('_raw_purchase_history')
+        records.append({"user_id": _to_python(row['user_id']), "profile": profile})
+    return records
+
 # 可视化函数（保持不变）
-def generate_visualizations(user_id, profile, save_path):
-    """生成三种可视化方案（完整修正版）"""
+def build_figures(user_id, profile, parsed=None):
+    """
+    生成三种可视化方案（完整修正版）；parsed 为 parse_histories 的结果时复用已解析的登录时间
+    返回:
+        list: [(图表名, Figure)]，出错时只返回已生成的部分
+    """
+    figures = []
     if not profile:
-        print(f"警告: 用户 {user_id} 的画像数据为空")
-        return
+        METRICS.incr('render.empty_profile')
+        return figures
+    px, go = plotting()
 
     try:
         # 1. 基础属性雷达图
@@ -269,7 +773,7 @@ def generate_visualizations(user_id, profile, save_path):
             font=dict(size=12),
             margin=dict(l=50, r=50, b=50, t=50)
         )
-        fig1.write_html(f"{save_path}/radar_{user_id}.html")
+        figures.append(('radar', fig1))
         
         # 2. 消费-活跃度散点图（增强版）
         fig2 = px.scatter(
@@ -314,35 +818,26 @@ def generate_visualizations(user_id, profile, save_path):
             ],
             hovermode='closest'
         )
-        fig2.write_html(f"{save_path}/scatter_{user_id}.html")
+        figures.append(('scatter', fig2))
         
         # 3. 时间序列热力图（完整修正版）
-        if '_raw_login_history' in profile:
-            login_data = safe_json_parse(profile['_raw_login_history'])
+        if parsed is None and '_raw_login_history' in profile:
+            parsed = {"login": decode_login_history(profile['_raw_login_history'])}
+        elif parsed is not None:
+            _mark_reused(parsed, json_calls=1)
+        if parsed is not None:
+            login_data = parsed["login"]["data"]
             if login_data and 'timestamps' in login_data:
-                timestamps = []
-                for ts in login_data['timestamps']:
-                    dt = parse_datetime(ts)
-                    if pd.notna(dt):
-                        timestamps.append(dt)
+                timestamps = parsed["login"]["times"]
                 
                 if timestamps:
                     # 创建包含所有可能时间点的完整矩阵
                     weekday_names = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
                     
-                    # 初始化7x24的零矩阵
-                    heatmap_matrix = np.zeros((7, 24))
-                    
-                    # 填充实际数据
-                    login_df = pd.DataFrame({
-                        'weekday': [d.weekday() for d in timestamps],
-                        'hour': [d.hour for d in timestamps]
-                    })
-                    counts = login_df.groupby(['weekday', 'hour']).size()
-                    
-                    # 将计数填充到矩阵中
-                    for (weekday, hour), count in counts.items():
-                        heatmap_matrix[weekday, hour] = count
+                    # 7x24 登录矩阵：批量路径已预先计算，否则现场计算
+                    heatmap_matrix = parsed["login"].get("matrix")
+                    if heatmap_matrix is None:
+                        heatmap_matrix = login_activity_matrices(pd.Series(timestamps), [len(timestamps)])[0]
                     
                     # 生成热力图
                     fig3 = px.imshow(
@@ -389,72 +884,709 @@ def generate_visualizations(user_id, profile, save_path):
                         )
                         fig3.update_layout(annotations=annotations)
                     
-                    fig3.write_html(f"{save_path}/heatmap_{user_id}.html")
+                    figures.append(('heatmap', fig3))
 
     except Exception as e:
-        print(f"生成可视化失败 ({user_id}): {str(e)}")
-        # 调试信息
-        if 'heatmap_matrix' in locals():
-            print(f"热力图矩阵形状: {heatmap_matrix.shape}, 最大值: {heatmap_matrix.max()}")
-
-def process_file(file_path):
-    """处理单个文件并生成画像"""
-    df = pd.read_parquet(file_path)
-    profiles = []
-    
-    for _, row in df.iterrows():
+        METRICS.error('render', e, user_id)
+    return figures
+
+# 可视化输出：所有 HTML 引用输出目录下同一份 plotly.js，不再每个文件内嵌数MB的脚本
+PLOTLY_JS = 'plotly.min.js'
+
+def ensure_plotly_js(save_path):
+    """在输出目录写入共享的 plotly.js（已存在则跳过）"""
+    path = os.path.join(save_path, PLOTLY_JS)
+    if not os.path.exists(path):
+        from plotly.offline import get_plotlyjs
+        os.makedirs(save_path, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(get_plotlyjs())
+        os.replace(tmp_path, path)
+
+def generate_visualizations(user_id, profile, save_path, parsed=None):
+    """为单个用户写出三个独立的 HTML 图表"""
+    ensure_plotly_js(save_path)
+    with METRICS.timer('render'):
+        for name, fig in build_figures(user_id, profile, parsed):
+            fig.write_html(f"{save_path}/{name}_{user_id}.html", include_plotlyjs=PLOTLY_JS)
+
+def render_dashboard_section(user_id, profile, parsed=None):
+    """单个用户在合并仪表盘页面中的 HTML 片段"""
+    with METRICS.timer('render'):
+        figures = build_figures(user_id, profile, parsed)
+        if not figures:
+            return ''
+        body = ''.join(fig.to_html(full_html=False, include_plotlyjs=False) for _, fig in figures)
+    return f'<section><h2>用户 {user_id}</h2>{body}</section>\n'
+
+def dashboard_path(file_path, save_path=None):
+    """单个输入文件的合并仪表盘路径"""
+    return os.path.join(save_path or output_dir, f"dashboard_{os.path.splitext(os.path.basename(file_path))[0]}.html")
+
+class VisualizationQueue:
+    """
+    后台渲染队列：画像构建只提交任务，图表在线程池中生成，不阻塞后续批次
+    dashboard 为页面路径时，所有用户按提交顺序合并写入该页面；否则每个用户写三个独立文件
+    """
+
+    def __init__(self, save_path=None, workers=2, dashboard=None):
+        self.save_path = save_path or output_dir
+        self.dashboard = dashboard
+        self.submitted = 0
+        ensure_plotly_js(self.save_path)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._futures = []
+
+    def submit(self, user_id, profile, parsed=None):
+        """提交一个用户的渲染任务"""
+        # 渲染线程的计时记入提交时所在的文件
+        if self.dashboard:
+            future = self._pool.submit(METRICS.bind(render_dashboard_section), user_id, profile, parsed)
+        else:
+            future = self._pool.submit(METRICS.bind(generate_visualizations), user_id, profile, self.save_path, parsed)
+        self._futures.append(future)
+        self.submitted += 1
+
+    def submit_table(self, table, parsed, n):
+        """提交画像表前n个用户的渲染任务"""
+        for item, item_parsed in zip(profiles_from_table(table.head(n)), parsed):
+            self.submit(item['user_id'], item['profile'], item_parsed)
+
+    def close(self):
+        """等待全部渲染完成；合并模式下写出仪表盘页面"""
+        sections = []
+        for future in self._futures:
+            try:
+                sections.append(future.result())
+            except Exception as e:
+                METRICS.error('render', e)
+        self._pool.shutdown()
+        if self.dashboard and sections:
+            with open(self.dashboard, 'w', encoding='utf-8') as f:
+                f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                        f'<script src="{PLOTLY_JS}"></script></head><body>\n')
+                f.writelines(sections)
+                f.write('</body></html>\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def process_file(file_path, batch=True, row_groups=None, part=None, visualize=True, batch_size=None,
+                 output_format='parquet', keep_raw=False, viz_users=5, dashboard=False, as_of=None, rfm_bins='fixed',
+                 prefetch=dataset.PREFETCH_DEPTH):
+    """
+    处理单个文件并生成画像（batch=False 时走逐行 iterrows 路径，画像中的登录矩阵列为空）
+    参数:
+        row_groups (list): 只处理指定的行组（多进程拆分大文件时使用）
+        part (int): 分片编号，输出写入对应的分片文件
+        visualize (bool): 是否为前 viz_users 个用户生成可视化（后台线程渲染）
+        batch_size (int): 流式模式每批行数，内存占用只与批大小相关
+        output_format (str): 'parquet'（扁平列式）或 'json'（兼容旧版嵌套记录，不含登录矩阵）
+        keep_raw (bool): parquet 输出是否保留原始历史字符串列
+        viz_users (int): 生成可视化的用户数
+        dashboard (bool): 可视化合并写入该文件的一个仪表盘页面，而非每用户三个文件
+        as_of (datetime): RFM与最近30天活跃的参考时间；缺省时整个文件共用开始处理时的UTC时间
+        rfm_bins (str): 'quantile' 时这里仍按固定阈值评分，全部文件写出后由 apply_quantile_rfm 重算
+        prefetch (int): 流式模式下处理当前批时后台预读的批数（0 关闭）
+    返回:
+        int: 生成的画像数；各阶段计数和耗时记入 METRICS
+    """
+    parse_before = dict(PARSE_STATS)
+    as_of = as_of or datetime.now(timezone.utc)
+    with METRICS.file(_task_label((file_path, row_groups, part))):
+        visualize = visualize and viz_users > 0
+        if batch and batch_size:
+            count = process_file_streaming(file_path, batch_size, row_groups, part, visualize, output_format,
+                                           keep_raw, viz_users, dashboard, as_of, prefetch)
+        else:
+            count = _process_file_whole(file_path, batch, row_groups, part, visualize, output_format, keep_raw,
+                                        viz_users, dashboard, as_of)
+        METRICS.incr('profiles', count)
+        for key, value in PARSE_STATS.items():
+            METRICS.incr(f"parse.{key}", value - parse_before[key])
+    return count
+
+def _process_file_whole(file_path, batch, row_groups, part, visualize, output_format, keep_raw, viz_users, dashboard,
+                        as_of=None):
+    """整文件读入后批量或逐行构建画像"""
+    with METRICS.timer('read'):
+        table = dataset.read_arrow(file_path, PROFILE_INPUT_COLUMNS, row_groups=row_groups,
+                                   downcast=PROFILE_DOWNCAST_COLUMNS)
+        df = table.to_pandas(types_mapper=dataset.keep_nested)
+    METRICS.incr('rows', len(df))
+    with ProfileWriter(file_path, part, output_format, keep_raw) as writer, \
+            open_visualization_queue(file_path, visualize, dashboard) as queue:
+        if batch:
+            table, parsed = _build_batch(df, as_of)
+            if queue:
+                queue.submit_table(table, parsed, viz_users)
+            with METRICS.timer('write'):
+                writer.write(table)
+            return writer.count
+
+        profiles = []
+        with METRICS.timer('profile'):
+            for _, row in df.iterrows():
+                try:
+                    parsed = parse_histories(row.get('purchase_history'), row.get('login_history'))
+                    profile = build_user_profile(row, parsed, as_of)
+                    profiles.append({
+                        "user_id": row['id'],
+                        "profile": profile
+                    })
+
+                    # 为前 viz_users 个用户生成可视化
+                    if queue and queue.submitted < viz_users:
+                        queue.submit(row['id'], profile, parsed)
+
+                except Exception as e:
+                    METRICS.error('row', e, row.get('id', 'unknown'))
+
+        with METRICS.timer('write'):
+            writer.write_profiles(profiles)
+        return writer.count
+
+def _build_batch(df, as_of=None):
+    """解析历史并构建一批画像，解析与构建分别计时"""
+    with METRICS.timer('parse'):
+        parsed = parse_histories_batch(df)
+    with METRICS.timer('profile'):
+        table = build_profiles_batch(df, now=as_of, parsed=parsed)
+    return table, parsed
+
+def process_file_streaming(file_path, batch_size=100_000, row_groups=None, part=None, visualize=True,
+                           output_format='parquet', keep_raw=False, viz_users=5, dashboard=False, as_of=None,
+                           prefetch=dataset.PREFETCH_DEPTH):
+    """按记录批次流式读取、构建并写出画像，不在内存中保留整个文件；构建当前批时后台读取下一批"""
+    batches = dataset.prefetch(dataset.iter_arrow(file_path, PROFILE_INPUT_COLUMNS, row_groups=row_groups,
+                                                  batch_size=batch_size, downcast=PROFILE_DOWNCAST_COLUMNS), prefetch)
+    with ProfileWriter(file_path, part, output_format, keep_raw) as writer, \
+            open_visualization_queue(file_path, visualize, dashboard) as queue:
+        for df in dataset.timed_batches(batches):
+            table, parsed = _build_batch(df, as_of)
+            if queue and queue.submitted < viz_users:
+                queue.submit_table(table, parsed, viz_users - queue.submitted)
+            with METRICS.timer('write'):
+                writer.write(table)
+            del df, parsed, table
+        return writer.count
+
+def open_visualization_queue(file_path, visualize=True, dashboard=False):
+    """visualize 为真时返回该文件的渲染队列，否则返回空上下文（as 得到 None）"""
+    if not visualize:
+        return contextlib.nullcontext()
+    return VisualizationQueue(dashboard=dashboard_path(file_path) if dashboard else None)
+
+# 画像输出：parquet 为扁平的类型化列（basic.* / consumption.* / activity.* / value.*）
+PROFILE_ARROW_TYPES = {
+    'consumption.avg_price': pa.float64(),
+    'consumption.refund_rate': pa.int64(),
+    'consumption.purchase_count': pa.int64(),
+    'activity.login_count': pa.int64(),
+    'activity.devices': pa.list_(pa.string()),
+    'activity.last_30d_logins': pa.int64(),
+    'activity.avg_session_duration': pa.float64(),
+    'value.rfm_score': pa.float64(),
+    'value.monetary': pa.float64(),
+    'value.recency': pa.int64(),  # 空值表示"未知"
+    'value.frequency': pa.int64(),
+    LOGIN_MATRIX_COLUMN: pa.list_(pa.uint16(), HEATMAP_SLOTS),  # 按行展开的 7x24 矩阵
+    # 低基数字段按字典编码写出，读回时直接得到分类列
+    **{column: pa.dictionary(pa.int32(), pa.string()) for column in CATEGORICAL_PROFILE_COLUMNS},
+}
+RAW_HISTORY_COLUMNS = ['_raw_login_history', '_raw_purchase_history']
+PROFILE_ROW_GROUP_SIZE = 16_384  # 行组较小，按索引点查单个用户时只需读取一个小行组
+
+def profile_schema(id_type=pa.int64(), keep_raw=False):
+    """画像表的 Arrow schema"""
+    fields = [pa.field('user_id', id_type)]
+    for section, names in PROFILE_SECTIONS.items():
+        for name in names:
+            column = f"{section}.{name}"
+            fields.append(pa.field(column, PROFILE_ARROW_TYPES.get(column, pa.string())))
+    fields.append(pa.field(LOGIN_MATRIX_COLUMN, PROFILE_ARROW_TYPES[LOGIN_MATRIX_COLUMN]))
+    if keep_raw:
+        fields += [pa.field(column, pa.string()) for column in RAW_HISTORY_COLUMNS]
+    return pa.schema(fields)
+
+def profile_table_to_arrow(table, schema):
+    """把 build_profiles_batch 的画像表按 schema 转为 Arrow 表"""
+    frame = table[schema.names].copy()
+    frame['activity.devices'] = [
+        [str(d) for d in v] if isinstance(v, list) else None for v in frame['activity.devices']
+    ]
+    matrices = frame.pop(LOGIN_MATRIX_COLUMN)
+    arrow = pa.Table.from_pandas(frame, schema=schema.remove(schema.get_field_index(LOGIN_MATRIX_COLUMN)),
+                                 preserve_index=False)
+    return arrow.add_column(schema.get_field_index(LOGIN_MATRIX_COLUMN), schema.field(LOGIN_MATRIX_COLUMN),
+                            login_matrix_array(matrices))
+
+def login_matrix_array(matrices):
+    """把每行的 7x24 矩阵转为定长 uint16 列表列（逐行路径没有矩阵，写为空值）"""
+    matrix_type = PROFILE_ARROW_TYPES[LOGIN_MATRIX_COLUMN]
+    if all(m is not None for m in matrices):
+        flat = np.stack(list(matrices)).reshape(-1) if len(matrices) else np.zeros(0, np.uint16)
+        return pa.FixedSizeListArray.from_arrays(pa.array(flat, pa.uint16()), HEATMAP_SLOTS)
+    return pa.array([None if m is None else m.reshape(-1) for m in matrices], matrix_type)
+
+def read_login_matrices(profile_path, columns=()):
+    """
+    从 parquet 画像文件读取登录矩阵，不再重新解析时间戳
+    返回:
+        (ndarray, DataFrame): (用户数, 7, 24) 矩阵（空值为全零）与 columns 指定的画像列
+    """
+    table = pq.read_table(profile_path, columns=[LOGIN_MATRIX_COLUMN, *columns])
+    column = table.column(LOGIN_MATRIX_COLUMN).combine_chunks().fill_null([0] * HEATMAP_SLOTS)
+    matrices = column.values.to_numpy(zero_copy_only=False).reshape(-1, 7, 24)
+    return matrices, table.drop([LOGIN_MATRIX_COLUMN]).to_pandas()
+
+def cohort_login_heatmaps(profile_paths, by='basic.age_segment'):
+    """
+    按画像字段分组汇总登录矩阵（群体热力图）
+    只有批量路径写出的 parquet 画像带登录矩阵，逐行路径的画像矩阵为空、按全零计
+    返回:
+        dict: 分组值 -> 7x24 登录次数之和
+    """
+    totals = {}
+    for path in profile_paths:
+        matrices, frame = read_login_matrices(path, [by])
+        groups = frame[by].astype('category')  # 字典编码列读回即为分类列，直接按编码分组
+        codes, valid = groups.cat.codes.to_numpy(), groups.notna().to_numpy()
+        sums = np.zeros((len(groups.cat.categories), 7, 24), dtype=np.int64)
+        np.add.at(sums, codes[valid], matrices[valid])
+        present = np.bincount(codes[valid], minlength=len(sums)) > 0
+        for group, total in zip(groups.cat.categories[present], sums[present]):
+            totals[group] = totals[group] + total if group in totals else total
+    return totals
+
+# 分位数RFM：画像写出后在全部画像文件上计算分位点并重算 rfm_score
+def rfm_sketches(profile_path, relative_accuracy=0.01):
+    """单个画像文件的 R/F/M 分位数草图（只读取三列，逐行组更新）"""
+    sketches = {name: QuantileSketch(relative_accuracy) for name in RFM_COLUMNS}
+    for batch in pq.ParquetFile(profile_path).iter_batches(columns=list(RFM_COLUMNS.values())):
+        for name, column in RFM_COLUMNS.items():
+            sketches[name].update(batch.column(column).to_numpy(zero_copy_only=False))
+    return sketches
+
+def rfm_bins(sketches):
+    """由合并后的草图得到各指标的五分位点"""
+    bins = {}
+    for name, sketch in sketches.items():
+        edges = np.array(sketch.quantiles(RFM_QUANTILES)) if sketch.count else np.full(len(RFM_QUANTILES), np.inf)
+        bins[name] = np.round(edges) if name in RFM_INTEGER_METRICS else edges
+    return bins
+
+def rescore_rfm(profile_path, bins):
+    """
+    按分位点重算画像文件的 value.rfm_score（逐行组重写到临时文件后替换）
+    分数全部未变时不重写文件，文件的修改时间不变，点查索引也无需重建
+    返回:
+        bool: 是否重写了文件
+    """
+    parquet_file = pq.ParquetFile(profile_path)
+    schema = parquet_file.schema_arrow
+    index = schema.get_field_index('value.rfm_score')
+    scores, changed = [], False
+    for i in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(i, columns=[*RFM_COLUMNS.values(), 'value.rfm_score'])
+        metrics = [table.column(c).to_numpy(zero_copy_only=False) for c in RFM_COLUMNS.values()]
+        metrics[0] = np.nan_to_num(metrics[0], nan=-1)  # 空值为 recency 未知
+        score = rfm_total(*rfm_scores(*metrics, bins))
+        old = table.column('value.rfm_score').to_numpy(zero_copy_only=False).astype(float)
+        changed = changed or not np.array_equal(score, old, equal_nan=True)
+        scores.append(score)
+    if not changed:
+        return False
+    tmp_path = f"{profile_path}.tmp"
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for i, score in enumerate(scores):
+            table = parquet_file.read_row_group(i)
+            writer.write_table(table.set_column(index, schema.field(index), pa.array(score, pa.float64())))
+    os.replace(tmp_path, profile_path)
+    return True
+
+def apply_quantile_rfm(profile_paths, bins_path=None):
+    """
+    分位数RFM：第一遍读取各画像文件的 R/F/M 列并合并草图（不排序全量数据），
+    第二遍按得到的五分位点重算每个文件的 rfm_score
+    参数:
+        bins_path (str): 分位点与草图的 JSON 输出路径，缺省为输出目录下的 rfm_bins.json
+    返回:
+        dict: 各指标的分位点（重写的文件数计入 METRICS 的 rfm.rescored）
+    """
+    with METRICS.timer('rfm'):
+        total = {name: QuantileSketch() for name in RFM_COLUMNS}
+        for path in profile_paths:
+            for name, sketch in rfm_sketches(path).items():
+                total[name].merge(sketch)
+        bins = rfm_bins(total)
+        for path in profile_paths:
+            METRICS.incr('rfm.rescored', int(rescore_rfm(path, bins)))
+    with open(bins_path or os.path.join(output_dir, 'rfm_bins.json'), 'w', encoding='utf-8') as f:
+        json.dump({"quantiles": RFM_QUANTILES, "bins": {k: v.tolist() for k, v in bins.items()},
+                   "sketches": {k: v.to_dict() for k, v in total.items()}}, f, ensure_ascii=False)
+    return bins
+
+def table_from_profiles(profiles):
+    """把嵌套画像记录（逐行路径的结果）展开为与 build_profiles_batch 相同的画像表"""
+    rows = []
+    for item in profiles:
+        profile = item['profile'] or {}
+        row = {'user_id': item['user_id']}
+        for section, names in PROFILE_SECTIONS.items():
+            values = profile.get(section, {})
+            for name in names:
+                row[f"{section}.{name}"] = values.get(name)
+        if row['value.recency'] == "未知":
+            row['value.recency'] = None
+        row[LOGIN_MATRIX_COLUMN] = None
+        for column in RAW_HISTORY_COLUMNS:
+            row[column] = profile.get(column)
+        rows.append(row)
+    return categorize_profile_columns(pd.DataFrame(rows, columns=profile_schema(keep_raw=True).names))
+
+class ProfileWriter:
+    """单个输入文件（或分片）的画像输出，按批追加写入 parquet 或 json"""
+
+    def __init__(self, file_path, part=None, output_format='parquet', keep_raw=False):
+        self.path = profiles_path(file_path, part, output_format)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.output_format = output_format
+        self.count = 0
+        if output_format == 'parquet':
+            id_type = pq.ParquetFile(file_path).schema_arrow.field('id').type
+            self.schema = profile_schema(id_type, keep_raw)
+            self._writer = pq.ParquetWriter(self.path, self.schema)
+        else:
+            self._out = open(self.path, 'w', encoding='utf-8')
+            self._out.write('[')
+
+    def write(self, table):
+        """追加一批画像表"""
+        if self.output_format == 'parquet':
+            self._writer.write_table(profile_table_to_arrow(table, self.schema), row_group_size=PROFILE_ROW_GROUP_SIZE)
+            self.count += len(table)
+        else:
+            self.write_profiles(profiles_from_table(table))
+
+    def write_profiles(self, profiles):
+        """追加一批嵌套画像记录"""
+        if self.output_format == 'parquet':
+            return self.write(table_from_profiles(profiles))
+        body = _json_array_body(pd.DataFrame(profiles).to_json(orient='records', force_ascii=False))
+        if body:
+            self._out.write(body if self.count == 0 else ',' + body)
+        self.count += len(profiles)
+
+    def close(self):
+        if self.output_format == 'parquet':
+            self._writer.close()
+        else:
+            self._out.write(']')
+            self._out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _json_array_body(text):
+    """去掉JSON数组两端的方括号，便于拼接"""
+    return text.strip()[1:-1]
+
+def profiles_path(file_path, part=None, output_format='parquet'):
+    """画像输出文件路径（分片文件带 .partN 后缀）"""
+    filename = os.path.basename(file_path)
+    suffix = "" if part is None else f".part{part}"
+    return f"{output_dir}/{filename}_profiles{suffix}.{output_format}"
+
+# 多进程调度：按文件（大文件按行组）拆分任务
+def plan_tasks(file_paths, rows_per_task=1_000_000):
+    """
+    生成任务列表
+    返回:
+        list: 每个任务为 (file_path, row_groups, part)，不拆分的文件 row_groups/part 为 None
+    """
+    tasks = []
+    for file_path in file_paths:
+        metadata = pq.ParquetFile(file_path).metadata
+        if metadata.num_rows <= rows_per_task or metadata.num_row_groups <= 1:
+            tasks.append((file_path, None, None))
+            continue
+        chunks, chunk, chunk_rows = [], [], 0
+        for i in range(metadata.num_row_groups):
+            chunk.append(i)
+            chunk_rows += metadata.row_group(i).num_rows
+            if chunk_rows >= rows_per_task:
+                chunks.append(chunk)
+                chunk, chunk_rows = [], 0
+        if chunk:
+            chunks.append(chunk)
+        tasks.extend((file_path, tuple(chunk), part) for part, chunk in enumerate(chunks))
+    return tasks
+
+def _run_task(task, options):
+    """工作进程入口：处理一个任务并返回统计信息（options 透传给 process_file）"""
+    file_path, row_groups, part = task
+    stats_before = dict(PARSE_STATS)
+    start = time.time()
+    count = process_file(file_path, row_groups=row_groups, part=part, visualize=part in (None, 0), **options)
+    return {
+        "pid": os.getpid(),
+        "rows": count,
+        "seconds": time.time() - start,
+        "parse_stats": {k: PARSE_STATS[k] - stats_before[k] for k in PARSE_STATS},
+        "metrics": METRICS.pop(),
+    }
+
+def merge_parts(file_path, parts, output_format='parquet'):
+    """把分片画像文件按顺序合并为 {filename}_profiles.parquet/json"""
+    part_paths = [profiles_path(file_path, p, output_format) for p in sorted(parts)]
+    if output_format == 'parquet':
+        schema = pq.ParquetFile(part_paths[0]).schema_arrow
+        with pq.ParquetWriter(profiles_path(file_path, None, output_format), schema) as writer:
+            for path in part_paths:
+                part_file = pq.ParquetFile(path)
+                for i in range(part_file.num_row_groups):
+                    writer.write_table(part_file.read_row_group(i))
+        for path in part_paths:
+            os.remove(path)
+        return
+
+    with open(profiles_path(file_path, None, output_format), 'w', encoding='utf-8') as out:
+        out.write('[')
+        first = True
+        for path in part_paths:
+            with open(path, encoding='utf-8') as f:
+                body = _json_array_body(f.read())
+            if body:
+                out.write(body if first else ',' + body)
+                first = False
+        out.write(']')
+    for path in part_paths:
+        os.remove(path)
+
+def _task_label(task):
+    """任务显示名"""
+    return os.path.basename(task[0]) + ("" if task[2] is None else f"#part{task[2]}")
+
+def profile_params(options):
+    """影响画像产出的参数（参数变化时清单中的记录失效）"""
+    as_of = options.get('as_of')
+    return {"output_format": options.get('output_format', 'parquet'), "keep_raw": options.get('keep_raw', False),
+            "login_matrix": True, "as_of": as_of.isoformat() if as_of else None,
+            "rfm_bins": options.get('rfm_bins', 'fixed')}
+
+def record_profile(manifest, file_path, count, options):
+    """在处理清单中记录该文件的画像阶段已完成"""
+    if manifest is None:
+        return
+    params = profile_params(options)
+    output = profiles_path(file_path, None, params["output_format"])
+    manifest.record(file_path, 'profile', [output], {"count": count}, params)
+
+def _collect(futures, results, failed, on_done=None):
+    """收集任务结果；返回因工作进程崩溃而未完成的任务"""
+    crashed = []
+    for future in as_completed(futures):
+        task = futures[future]
         try:
-            profile = build_user_profile(row)
-            profiles.append({
-                "user_id": row['id'],
-                "profile": profile
-            })
-            
-            # 为前5个用户生成可视化
-            if len(profiles) <= 5:
-                generate_visualizations(
-                    row['id'], 
-                    profile,
-                    output_dir
-                )
-                
+            results[task] = future.result()
+            print(f"✓ {_task_label(task)}: {results[task]['rows']} 个画像 | {results[task]['seconds']:.1f}s")
+            if on_done:
+                on_done(task)
+        except BrokenProcessPool:
+            crashed.append(task)
         except Exception as e:
-            print(f"处理用户 {row.get('id', 'unknown')} 时出错: {e}")
-    
-    # 保存所有画像数据
-    filename = os.path.basename(file_path)
-    pd.DataFrame(profiles).to_json(
-        f"{output_dir}/{filename}_profiles.json",
-        orient='records',
-        force_ascii=False
-    )
-    
-    return len(profiles)
+            print(f"✗ {_task_label(task)}: 处理失败: {e}")
+            failed.append(task)
+    return crashed
 
+def run_parallel(file_paths, workers, rows_per_task=1_000_000, manifest=None, **options):
+    """
+    多进程处理文件列表
+    单个任务抛出异常时记录失败并继续；工作进程崩溃会使整个进程池失效，
+    此时把受影响的任务放到各自独立的单进程池中重试，只放弃真正崩溃的任务。
+    传入 manifest 时每个文件完成后立即记录，中断后重跑可跳过
+    返回:
+        (int, list): 生成的画像总数, 失败的任务列表
+    """
+    tasks = plan_tasks(file_paths, rows_per_task)
+    results, failed = {}, []
+
+    def on_done(task):
+        if task[2] is None:
+            record_profile(manifest, task[0], results[task]["rows"], options)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_output_dir, initargs=(output_dir,)) as pool:
+        crashed = _collect({pool.submit(_run_task, task, options): task for task in tasks}, results, failed, on_done)
+
+    if crashed:
+        print(f"工作进程崩溃，隔离重试 {len(crashed)} 个任务")
+    for i in range(0, len(crashed), workers):
+        pools = {task: ProcessPoolExecutor(max_workers=1, initializer=set_output_dir, initargs=(output_dir,))
+                 for task in crashed[i:i + workers]}
+        futures = {pool.submit(_run_task, task, options): task for task, pool in pools.items()}
+        for task in _collect(futures, results, failed, on_done):
+            print(f"✗ {_task_label(task)}: 工作进程崩溃，放弃该任务")
+            failed.append(task)
+        for pool in pools.values():
+            pool.shutdown()
+
+    # 合并拆分文件的分片输出（有分片失败的文件不合并）
+    failed_files = {task[0] for task in failed}
+    split_parts = {}
+    for file_path, _, part in results:
+        if part is not None:
+            split_parts.setdefault(file_path, []).append(part)
+    for file_path, parts in split_parts.items():
+        if file_path not in failed_files:
+            merge_parts(file_path, parts, options.get('output_format', 'parquet'))
+            count = sum(r["rows"] for task, r in results.items() if task[0] == file_path)
+            record_profile(manifest, file_path, count, options)
+
+    for result in results.values():
+        for k, v in result["parse_stats"].items():
+            PARSE_STATS[k] += v
+        METRICS.merge(result["metrics"])
+    print_worker_summary(results.values())
+    return sum(r["rows"] for r in results.values()), failed
+
+def print_worker_summary(results):
+    """按工作进程汇总吞吐量"""
+    per_worker = {}
+    for r in results:
+        w = per_worker.setdefault(r["pid"], {"tasks": 0, "rows": 0, "seconds": 0.0})
+        w["tasks"] += 1
+        w["rows"] += r["rows"]
+        w["seconds"] += r["seconds"]
+    print("\n工作进程吞吐量:")
+    for pid, w in sorted(per_worker.items()):
+        rate = w["rows"] / w["seconds"] if w["seconds"] else 0
+        print(f"- PID {pid}: {w['tasks']} 个任务, {w['rows']} 行, {w['seconds']:.1f}s, {rate:.0f} 行/秒")
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="用户画像生成")
+    arg_parser.add_argument('--workers', type=int, default=1, help="并行工作进程数（1为单进程）")
+    arg_parser.add_argument('--limit', type=int, default=3, help="最多处理的文件数（0为不限制）")
+    arg_parser.add_argument('--rows-per-task', type=int, default=1_000_000,
+                            help="多进程模式下大文件按行组拆分的每任务行数")
+    arg_parser.add_argument('--batch-size', type=int, default=0,
+                            help="流式模式每批读取的行数（0为整文件读取）")
+    arg_parser.add_argument('--prefetch', type=int, default=dataset.PREFETCH_DEPTH,
+                            help="流式模式预读深度：构建当前批时后台提前读取的批数（0 关闭）")
+    arg_parser.add_argument('--format', choices=['parquet', 'json'], default='parquet',
+                            help="画像输出格式（json 为兼容旧版的嵌套记录，不含 7x24 登录矩阵，"
+                                 "群体热力图只能用 parquet 画像）")
+    arg_parser.add_argument('--keep-raw', action='store_true', help="parquet 输出保留原始历史字符串列")
+    arg_parser.add_argument('--viz-users', type=int, default=5, help="每个文件生成可视化的用户数（0为不生成）")
+    arg_parser.add_argument('--dashboard', action='store_true', help="可视化合并为每个文件一个仪表盘页面")
+    arg_parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help="处理清单路径（增量/断点续跑）")
+    arg_parser.add_argument('--force', action='store_true', help="忽略处理清单，全部重新处理")
+    arg_parser.add_argument('--metrics', default='profile_metrics.json', help="运行指标 JSON 输出路径")
+    arg_parser.add_argument('--profile', metavar='PATH', help="开启性能剖析并把结果写入 PATH（仅主进程）")
+    arg_parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile', help="剖析工具")
+    arg_parser.add_argument('--input-dir', default=parquet_dir, help="输入 Parquet 目录")
+    arg_parser.add_argument('--output-dir', default=output_dir, help="画像与可视化输出目录")
+    arg_parser.add_argument('--no-viz', action='store_true', help="无界面模式：不生成可视化，也不加载绘图库")
+    arg_parser.add_argument('--as-of', help="RFM参考时间（如 2025-01-01T00:00:00Z），指定后结果可复现；"
+                                            "缺省为各文件开始处理的时间")
+    arg_parser.add_argument('--rfm-bins', choices=['fixed', 'quantile'], default='fixed',
+                            help="RFM分档方式：固定阈值，或全量数据集的五分位点（仅 parquet 输出，需同时指定 --as-of）")
+    arg_parser.add_argument('--no-index', action='store_true', help="不更新按 user_id 的画像点查索引")
+    args = arg_parser.parse_args(argv)
+    set_output_dir(args.output_dir)
+    try:
+        as_of = parse_as_of(args.as_of)
+    except ValueError as e:
+        arg_parser.error(str(e))
+    if args.rfm_bins == 'quantile' and args.format != 'parquet':
+        arg_parser.error("分位数RFM只支持 parquet 输出")
+    if args.rfm_bins == 'quantile' and as_of is None:
+        # 沿用缓存的画像按以前运行时的时间计算 recency，与新画像混在同一组分位点里会错档
+        arg_parser.error("分位数RFM需要用 --as-of 固定参考时间")
+    input_dir = args.input_dir
+    profiler = start_profiler(args.profile, args.profiler)
+    options = {"batch_size": args.batch_size, "output_format": args.format, "keep_raw": args.keep_raw,
+               "viz_users": 0 if args.no_viz else args.viz_users, "dashboard": args.dashboard, "as_of": as_of,
+               "rfm_bins": args.rfm_bins, "prefetch": args.prefetch}
+    manifest = Manifest(args.manifest)
 
-if __name__ == "__main__":
     print("=== 用户画像生成系统 ===")
-    print(f"输入目录: {parquet_dir}")
+    print(f"输入目录: {input_dir}")
     print(f"输出目录: {output_dir}")
+    if as_of:
+        print(f"RFM参考时间: {as_of.isoformat()}")
     
     total_start = time.time()
-    parquet_files = [f for f in os.listdir(parquet_dir) 
-                    if f.endswith('.parquet')][:3]  # 限制文件数用于测试
+    parquet_files = [f for f in sorted(os.listdir(input_dir)) 
+                    if f.endswith('.parquet')]
+    if args.limit:
+        parquet_files = parquet_files[:args.limit]  # 限制文件数用于测试
+    all_files = parquet_files
     
+    total_profiles = 0
     if not parquet_files:
         print("错误: 未找到Parquet文件")
+    params = profile_params(options)
+    if parquet_files and not args.force:
+        # 内容未变化且产出仍在的文件直接沿用上次结果
+        cached = [f for f in parquet_files
+                  if manifest.is_current(os.path.join(input_dir, f), 'profile', params,
+                                         [profiles_path(f, None, params["output_format"])])]
+        for f in cached:
+            total_profiles += manifest.result(os.path.join(input_dir, f), 'profile')["count"]
+        if cached:
+            print(f"跳过 {len(cached)} 个未变化的文件（沿用 {total_profiles} 个已生成画像）")
+        parquet_files = [f for f in parquet_files if f not in cached]
+
+    if parquet_files and args.workers > 1:
+        print(f"多进程模式: {args.workers} 个工作进程")
+        count, failed = run_parallel(
+            [os.path.join(input_dir, f) for f in parquet_files],
+            args.workers, args.rows_per_task, manifest, **options
+        )
+        total_profiles += count
+        if failed:
+            print(f"警告: {len(failed)} 个任务失败: {sorted({os.path.basename(t[0]) for t in failed})}")
     else:
-        total_profiles = 0
         for file in parquet_files:
             file_start = time.time()
-            file_path = os.path.join(parquet_dir, file)
+            file_path = os.path.join(input_dir, file)
             print(f"\n▶ 正在处理: {file}")
             
-            count = process_file(file_path)
+            count = process_file(file_path, **options)
             total_profiles += count
+            record_profile(manifest, file_path, count, options)
             
             print(f"✓ 生成 {count} 个画像 | 耗时: {time.time()-file_start:.1f}s")
     
+    if args.rfm_bins == 'quantile' and all_files:
+        # 每次都在全部文件（含沿用缓存的文件）上重新计算分位点
+        bins = apply_quantile_rfm([p for p in (profiles_path(f) for f in all_files) if os.path.exists(p)])
+        print("RFM五分位点: " + " | ".join(f"{k} {np.round(v, 2).tolist()}" for k, v in bins.items()))
+    if all_files and not args.no_index:
+        # 只为新增或变化的画像文件重建点查索引条目
+        with METRICS.timer('index'):
+            indexed = update_index(output_dir, [p for p in (profiles_path(f, None, args.format) for f in all_files)
+                                                if os.path.exists(p)])
+        if indexed:
+            print(f"点查索引已更新 {indexed} 个画像文件")
+
     print(f"\n处理完成! 总生成 {total_profiles} 个用户画像")
+    report_parse_stats()
+    dataset.report_read_stats()
+    METRICS.report()
+    METRICS.save(args.metrics)
+    stop_profiler(profiler)
     print(f"总耗时: {time.time()-total_start:.1f}秒")
     print(f"结果保存在: {os.path.abspath(output_dir)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import analysis
+import check
+import dataset
+import show
+from generate_data import generate_file
+from streaming_stats import RunningStats
+
+# 性能基准：在合成数据上计时画像构建、解析、异常检测和分布统计的热点函数，
+# 结果写成 JSON，可与之前的结果对比发现性能回退
+
+DEFAULT_SIZES = [10_000, 1_000_000, 10_000_000]
+
+def dataset_path(data_dir, rows, seed=0):
+    """基准数据文件路径，不存在时生成（同样的行数和种子只生成一次）"""
+    path = os.path.join(data_dir, f"bench_{rows}_s{seed}.parquet")
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        print(f"生成基准数据: {path}")
+        generate_file(path, rows, seed)
+    return path
+
+def _batches(path, batch_size, columns=None, limit=None):
+    """按批读取（limit 限制总行数）"""
+    remaining = limit
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+        df = batch.to_pandas()
+        if remaining is not None:
+            df = df.iloc[:remaining]
+            remaining -= len(df)
+        yield df
+        if remaining is not None and remaining <= 0:
+            break
+
+# 每个用例: (path, batch_size, scalar_limit) -> (计时秒数, 处理条数)；只计函数本身的耗时，不含读取
+def bench_safe_json_parse(path, batch_size, scalar_limit):
+    seconds, rows = 0.0, 0
+    for df in _batches(path, batch_size, ['purchase_history', 'login_history'], scalar_limit):
+        values = df['purchase_history'].tolist() + df['login_history'].tolist()
+        start = time.perf_counter()
+        for value in values:
+            analysis.safe_json_parse(value)
+        seconds += time.perf_counter() - start
+        rows += len(values)
+    return seconds, rows
+
+def bench_parse_datetime(path, batch_size, scalar_limit):
+    seconds, rows = 0.0, 0
+    for df in _batches(path, batch_size, ['last_login', 'registration_date'], scalar_limit):
+        values = df['last_login'].tolist() + df['registration_date'].tolist()
+        start = time.perf_counter()
+        for value in values:
+            analysis.parse_datetime(value)
+        seconds += time.perf_counter() - start
+        rows += len(values)
+    return seconds, rows
+
+def bench_build_user_profile(path, batch_size, scalar_limit):
+    seconds, rows = 0.0, 0
+    for df in _batches(path, batch_size, limit=scalar_limit):
+        start = time.perf_counter()
+        for _, row in df.iterrows():
+            analysis.build_user_profile(row)
+        seconds += time.perf_counter() - start
+        rows += len(df)
+    return seconds, rows
+
+def bench_build_profiles_batch(path, batch_size, scalar_limit):
+    seconds, rows = 0.0, 0
+    now = pd.Timestamp('2025-01-01', tz='UTC')
+    for df in _batches(path, batch_size):
+        start = time.perf_counter()
+        analysis.build_profiles_batch(df, now=now)
+        seconds += time.perf_counter() - start
+        rows += len(df)
+    return seconds, rows
+
+def bench_detect_anomalies(path, batch_size, scalar_limit):
+    seconds, rows = 0.0, 0
+    stats = RunningStats.from_dict(check.collect_income_stats(path)["stats"])
+    threshold = stats.mean + 3 * stats.std()
+    # 与 check.py 相同的读取方式（类型收窄、时间列在读取时解析），只计检测本身
+    for df in dataset.iter_batches(path, check.CHECK_COLUMNS, batch_size=batch_size, parse_dates=check.DATE_COLUMNS):
+        start = time.perf_counter()
+        check.detect_anomalies(df, threshold)
+        seconds += time.perf_counter() - start
+        rows += len(df)
+    return seconds, rows
+
+def bench_show_aggregate(path, batch_size, scalar_limit):
+    start = time.perf_counter()
+    dist = show.aggregate_file(path, batch_size)
+    return time.perf_counter() - start, int(dist.age_counts.sum())
+
+# 逐行（标量）用例在大规模下只测前 scalar_limit 行，按吞吐量比较
+CASES = {
+    'safe_json_parse': bench_safe_json_parse,
+    'parse_datetime': bench_parse_datetime,
+    'build_user_profile': bench_build_user_profile,
+    'build_profiles_batch': bench_build_profiles_batch,
+    'detect_anomalies': bench_detect_anomalies,
+    'show_aggregate': bench_show_aggregate,
+}
+SCALAR_CASES = {'safe_json_parse', 'parse_datetime', 'build_user_profile'}
+
+def environment():
+    """运行环境信息（写入结果便于对比）"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "pyarrow": pa.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def run_benchmarks(sizes, cases, data_dir, batch_size=100_000, scalar_limit=100_000, repeat=1, seed=0):
+    """
+    运行基准测试
+    返回:
+        list: 每个 (用例, 数据规模) 一条结果，重复多次时取最快一次
+    """
+    results = []
+    for size in sizes:
+        path = dataset_path(data_dir, size, seed)
+        for name in cases:
+            runs = [CASES[name](path, batch_size, scalar_limit) for _ in range(repeat)]
+            seconds, rows = min(runs)
+            result = {
+                "case": name,
+                "size": size,
+                "rows": rows,
+                "seconds": round(seconds, 6),
+                "rows_per_sec": round(rows / seconds, 1) if seconds else None,
+            }
+            results.append(result)
+            print(f"{name:<22} {size:>10} 行数据 | 处理 {rows} 行 | {seconds:.3f}s | "
+                  f"{result['rows_per_sec'] or 0:.0f} 行/秒")
+    return results
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    与基准结果对比吞吐量
+    返回:
+        list: 吞吐量下降超过 tolerance 的 (用例, 规模, 比值)
+    """
+    previous = {(r["case"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    print("\n与基准结果对比（吞吐量比值）:")
+    for r in results:
+        old = previous.get((r["case"], r["size"]))
+        if not old or not old.get("rows_per_sec") or not r["rows_per_sec"]:
+            continue
+        ratio = r["rows_per_sec"] / old["rows_per_sec"]
+        flag = " ← 性能回退" if ratio < 1 - tolerance else ""
+        print(f"- {r['case']} @ {r['size']}: {ratio:.2f}x{flag}")
+        if flag:
+            regressions.append((r["case"], r["size"], ratio))
+    return regressions
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="画像构建与数据检查热点函数的性能基准")
+    arg_parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES), help="数据规模（行数，逗号分隔）")
+    arg_parser.add_argument('--cases', default=','.join(CASES), help=f"要运行的用例（可选: {', '.join(CASES)}）")
+    arg_parser.add_argument('--data-dir', default='bench_data', help="合成数据缓存目录")
+    arg_parser.add_argument('--batch-size', type=int, default=100_000, help="每批读取的行数")
+    arg_parser.add_argument('--scalar-limit', type=int, default=100_000, help="逐行用例最多测试的行数")
+    arg_parser.add_argument('--repeat', type=int, default=1, help="每个用例重复次数（取最快一次）")
+    arg_parser.add_argument('--seed', type=int, default=0, help="合成数据随机种子")
+    arg_parser.add_argument('--output', default='benchmark_results.json', help="结果 JSON 路径")
+    arg_parser.add_argument('--compare', help="对比的基准结果 JSON，吞吐量下降超过阈值时返回非零退出码")
+    arg_parser.add_argument('--tolerance', type=float, default=0.2, help="允许的吞吐量下降比例")
+    args = arg_parser.parse_args()
+
+    cases = [c.strip() for c in args.cases.split(',') if c.strip()]
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        arg_parser.error(f"未知的用例: {', '.join(unknown)}")
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+
+    results = run_benchmarks(sizes, cases, args.data_dir, args.batch_size, args.scalar_limit, args.repeat, args.seed)
+    report = {
+        "environment": environment(),
+        "settings": {"batch_size": args.batch_size, "scalar_limit": args.scalar_limit,
+                     "repeat": args.repeat, "seed": args.seed, "scalar_cases": sorted(SCALAR_CASES & set(cases))},
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"\n结果已保存至: {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
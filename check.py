@@ -1,153 +1,573 @@
 import os
 import pandas as pd
 import numpy as np
-from datetime import datetime
 import time
+import json
+import shutil
+import argparse
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import dataset
+from manifest import Manifest, DEFAULT_MANIFEST
+from streaming_stats import RunningStats, QuantileSketch
 
-# 指定Parquet文件目录
+# 指定Parquet文件目录（命令行 --input-dir 可覆盖）
 parquet_dir = '/Users/aurora/Downloads/DATA/10G_data_new'
 
-# 设置Pandas显示选项
-pd.set_option('display.max_columns', None)
-pd.set_option('display.max_colwidth', None)
-pd.set_option('display.width', 1000)
-pd.set_option('display.max_rows', 10)
-
-# 输出文件
+# 输出文件（命令行 --output-dir 可改变所在目录）
+output_dir = '.'
+anomaly_file = 'anomalies.parquet'  # 每行异常记录: (file, id, mask)
+counts_file = 'anomaly_counts.json'  # 各规则命中数
 problem_file = 'problem.txt'
 need_delete_file = 'need_delete.txt'
+income_stats_file = 'income_stats.json'  # 全量收入统计（两阶段模式）
+# 每个文件的检测结果缓存（增量运行时未变化的文件直接复用）
+partial_dir = 'check_partials'
+duplicates_file = 'duplicates.parquet'  # 跨文件重复键涉及的行: (key_type, key, file, row, group_size)
+duplicate_summary_file = 'duplicate_summary.json'
+duplicate_dir = 'duplicate_buckets'  # 查重第一遍的分桶中间文件（每个输入文件一个）
+
+def set_output_dir(path):
+    """把所有输出文件和检测结果缓存放到 path 目录下"""
+    global output_dir, anomaly_file, counts_file, problem_file, need_delete_file, income_stats_file, partial_dir
+    global duplicates_file, duplicate_summary_file, duplicate_dir
+    output_dir = path
+    anomaly_file = os.path.join(path, 'anomalies.parquet')
+    counts_file = os.path.join(path, 'anomaly_counts.json')
+    problem_file = os.path.join(path, 'problem.txt')
+    need_delete_file = os.path.join(path, 'need_delete.txt')
+    income_stats_file = os.path.join(path, 'income_stats.json')
+    partial_dir = os.path.join(path, 'check_partials')
+    duplicates_file = os.path.join(path, 'duplicates.parquet')
+    duplicate_summary_file = os.path.join(path, 'duplicate_summary.json')
+    duplicate_dir = os.path.join(path, 'duplicate_buckets')
+    os.makedirs(partial_dir, exist_ok=True)
+
+# 异常规则及其位掩码（mask 的每一位对应一条规则）
+ANOMALY_RULES = {
+    'null_id_or_email': 1 << 0,      # ID或邮箱为空
+    'register_after_login': 1 << 1,  # 注册日期晚于最后登录时间
+    'income_over_3sigma': 1 << 2,    # 收入超过3σ
+    'age_out_of_range': 1 << 3,      # 年龄<0或>120
+    'invalid_gender': 1 << 4,        # 性别非'男'/'女'
+    'invalid_email': 1 << 5,         # 邮箱格式不正确
+    'non_bool_is_active': 1 << 6,    # is_active非布尔值
+}
+# 严重异常（建议删除）的规则
+SEVERE_MASK = ANOMALY_RULES['null_id_or_email'] | ANOMALY_RULES['register_after_login'] | ANOMALY_RULES['income_over_3sigma']
+NORMAL_MASK = sum(ANOMALY_RULES.values()) & ~SEVERE_MASK
+RULE_LABELS = {
+    'null_id_or_email': "ID或邮箱为空",
+    'register_after_login': "注册日期晚于最后登录时间",
+    'income_over_3sigma': "收入超过3σ原则",
+    'age_out_of_range': "年龄异常(<0或>120)",
+    'invalid_gender': "性别字段异常(非'男'/'女')",
+    'invalid_email': "邮箱格式不正确",
+    'non_bool_is_active': "is_active非布尔值",
+}
+# 检测用到的列
+CHECK_COLUMNS = ['id', 'email', 'last_login', 'registration_date', 'income', 'age', 'gender', 'is_active']
+DATE_COLUMNS = ['last_login', 'registration_date']
+EMAIL_PATTERN = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+# 跨文件查重的键；邮箱去掉首尾空白并转小写后比较
+DUPLICATE_KEYS = ['id', 'email']
+DUPLICATE_BUCKETS = 64
+DUPLICATE_SCHEMA = pa.schema([('key_type', pa.string()), ('key', pa.string()), ('file', pa.string()),
+                              ('row', pa.int64()), ('group_size', pa.int32())])
+# 查重第一遍的分桶文件：每个输入文件一个，按 bucket 排序，第 i 个行组即第 i 个桶
+DUPLICATE_BUCKET_SCHEMA = pa.schema([('bucket', pa.int32()), ('key_type', pa.string()),
+                                     ('key', pa.string()), ('row', pa.int64())])
+
+def mask_schema(id_type=pa.int64()):
+    """异常输出表的 schema（id 类型与输入数据一致）"""
+    return pa.schema([('file', pa.string()), ('id', id_type), ('mask', pa.uint8())])
+
+def income_threshold(df):
+    """按3σ原则计算收入上限"""
+    return df['income'].mean() + 3 * df['income'].std()
+
+def detect_anomalies(df, threshold=None):
+    """
+    向量化检测异常值，一次计算所有规则
+    参数:
+        threshold (float): 收入异常上限，缺省时按本文件计算3σ
+    返回:
+        Series: 每行的规则位掩码(uint8)，0表示无异常
+    """
+    mask = np.zeros(len(df), dtype=np.uint8)
+
+    def flag(rule, hit):
+        np.bitwise_or(mask, np.where(np.asarray(hit, dtype=bool), ANOMALY_RULES[rule], 0).astype(np.uint8), out=mask)
 
-# 清空或创建输出文件
-with open(problem_file, 'w') as f:
-    f.write("常规异常值记录:\n")
-with open(need_delete_file, 'w') as f:
-    f.write("严重异常值记录(建议删除):\n")
-
-def detect_anomalies(df):
-    """检测数据中的异常值"""
-    problem_records = []
-    delete_records = []
-    
-    # 1. 严重异常值检测
-    # 检查ID或邮箱为空
-    null_id_or_email = df[df['id'].isna() | df['email'].isna()]
-    if not null_id_or_email.empty:
-        delete_records.append("ID或邮箱为空的记录:\n" + null_id_or_email.to_string() + "\n")
-    
-    # 检查注册日期大于最后登录时间
+    # 1. 严重异常值
+    flag('null_id_or_email', df['id'].isna() | df['email'].isna())
+    last_login = dataset.parse_date_column(df['last_login'])
+    registration = dataset.parse_date_column(df['registration_date'])
+    flag('register_after_login', registration > last_login)
+    if threshold is None:
+        threshold = income_threshold(df)
+    flag('income_over_3sigma', df['income'] > threshold)
+
+    # 2. 常规异常值
+    flag('age_out_of_range', (df['age'] < 0) | (df['age'] > 120))
+    flag('invalid_gender', ~df['gender'].isin(['男', '女']))
+    flag('invalid_email', ~df['email'].str.contains(EMAIL_PATTERN, na=False))
+    flag('non_bool_is_active', non_bool(df['is_active']))
+
+    return pd.Series(mask, index=df.index, name='mask')
+
+def non_bool(values):
+    """非布尔值：bool 列只有缺失值算，object 列逐个检查类型（0/1、0.0/1.0 不算布尔），其他类型的列全部算"""
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return values.isna().to_numpy()
+    if values.dtype == object:
+        return np.fromiter((not isinstance(x, (bool, np.bool_)) for x in values), dtype=bool, count=len(values))
+    return np.ones(len(values), dtype=bool)
+
+def id_type(file_paths):
+    """所有输入文件 id 列的统一类型（类型不兼容时退回字符串）"""
+    types = [pq.read_schema(path).field('id').type for path in file_paths]
     try:
-        df['last_login_dt'] = pd.to_datetime(df['last_login'])
-        df['registration_dt'] = pd.to_datetime(df['registration_date'])
-        invalid_dates = df[df['registration_dt'] > df['last_login_dt']]
-        if not invalid_dates.empty:
-            delete_records.append("注册日期晚于最后登录时间的记录:\n" + invalid_dates[['id', 'last_login', 'registration_date']].to_string() + "\n")
-    except Exception as e:
-        problem_records.append(f"日期转换错误: {e}\n")
-    
-    # 检查收入异常(3σ原则)
+        return pa.unify_schemas([pa.schema([('id', t)]) for t in types], promote_options='permissive').field('id').type
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return pa.string()
+
+def count_rules(mask):
+    """统计各规则命中行数"""
+    mask = np.asarray(mask)
+    return {rule: int(np.count_nonzero(mask & bit)) for rule, bit in ANOMALY_RULES.items()}
+
+def anomaly_table(file, df, mask, schema):
+    """只保留有异常的行，生成 (file, id, mask) 表"""
+    hit = mask.to_numpy() != 0
+    return pa.table({
+        'file': pa.array([file] * int(hit.sum()), pa.string()),
+        'id': pa.array(df['id'][hit], from_pandas=True).cast(schema.field('id').type),
+        'mask': pa.array(mask.to_numpy()[hit], pa.uint8()),
+    }, schema=schema)
+
+def write_text_summary(file_counts):
+    """输出文本摘要：每个文件各规则的命中数"""
+    with open(problem_file, 'w') as problem_out, open(need_delete_file, 'w') as delete_out:
+        problem_out.write("常规异常值统计:\n")
+        delete_out.write("严重异常值统计(建议删除):\n")
+        for file, counts in file_counts.items():
+            problem_out.write(f"\n=== 文件 {file} 的常规异常 ===\n")
+            delete_out.write(f"\n=== 文件 {file} 的严重异常 ===\n")
+            for rule, count in counts.items():
+                if count:
+                    out = delete_out if ANOMALY_RULES[rule] & SEVERE_MASK else problem_out
+                    out.write(f"{RULE_LABELS[rule]}: {count} 条\n")
+
+def check_partial_paths(file):
+    """单个文件检测结果的缓存路径: (异常行表, 规则计数)"""
+    return os.path.join(partial_dir, f"{file}.parquet"), os.path.join(partial_dir, f"{file}.counts.json")
+
+def save_check_partial(file_path, table, counts, manifest, params):
+    """保存单个文件的检测结果并在处理清单中记录"""
+    partial_path, counts_path = check_partial_paths(os.path.basename(file_path))
+    pq.write_table(table, partial_path)
+    with open(counts_path, 'w', encoding='utf-8') as f:
+        json.dump(counts, f)
+    manifest.record(file_path, 'check', [partial_path, counts_path], params=params)
+
+def load_check_partial(file, schema):
+    """读取单个文件缓存的检测结果"""
+    partial_path, counts_path = check_partial_paths(file)
+    with open(counts_path, encoding='utf-8') as f:
+        counts = json.load(f)
+    return pq.read_table(partial_path, schema=schema), counts
+
+def write_check_outputs(files, schema, text_report=False, errors=None):
+    """
+    由各文件的检测结果汇总输出 anomalies.parquet、anomaly_counts.json（及可选文本摘要）
+    返回:
+        dict: 各规则命中总数
+    """
+    file_counts = {}
+    with pq.ParquetWriter(anomaly_file, schema) as writer:
+        for file in files:
+            table, file_counts[file] = load_check_partial(file, schema)
+            writer.write_table(table)
+    totals = {rule: sum(c.get(rule, 0) for c in file_counts.values()) for rule in ANOMALY_RULES}
+    with open(counts_file, 'w', encoding='utf-8') as f:
+        json.dump({"rules": ANOMALY_RULES, "total": totals, "files": {**file_counts, **(errors or {})}},
+                  f, ensure_ascii=False, indent=1)
+    if text_report:
+        write_text_summary(file_counts)
+    return totals
+
+def read_check_input(file_path):
+    """
+    读取一个文件待检测的列（在预读线程中运行，与上一个文件的检测重叠；不访问处理清单）
+    返回:
+        (DataFrame, str, Exception): 数据、本次读取的摘要、读取出错时的异常
+    """
+    counters = Counter()
     try:
-        income_mean = df['income'].mean()
-        income_std = df['income'].std()
-        threshold = income_mean + 3 * income_std
-        abnormal_income = df[df['income'] > threshold]
-        if not abnormal_income.empty:
-            delete_records.append(f"收入超过3σ原则(>{threshold:.2f})的记录:\n" + abnormal_income[['id', 'income']].to_string() + "\n")
+        df = dataset.read(file_path, CHECK_COLUMNS, parse_dates=DATE_COLUMNS, counters=counters)
+        return df, dataset.describe_read(counters), None
     except Exception as e:
-        problem_records.append(f"收入异常检测错误: {e}\n")
-    
-    # 2. 常规异常值检测
-    # 检查年龄异常
-    abnormal_age = df[(df['age'] < 0) | (df['age'] > 120)]
-    if not abnormal_age.empty:
-        problem_records.append("年龄异常(<0或>120)的记录:\n" + abnormal_age[['id', 'age']].to_string() + "\n")
-    
-    # 检查性别字段
-    abnormal_gender = df[~df['gender'].isin(['男', '女'])]
-    if not abnormal_gender.empty:
-        problem_records.append("性别字段异常(非'男'/'女')的记录:\n" + abnormal_gender[['id', 'gender']].to_string() + "\n")
-    
-    # 检查邮箱格式
-    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    invalid_emails = df[~df['email'].str.contains(email_pattern, na=False)]
-    if not invalid_emails.empty:
-        problem_records.append("邮箱格式不正确的记录:\n" + invalid_emails[['id', 'email']].to_string() + "\n")
-    
-    # 检查is_active是否为布尔值
-    if df['is_active'].dtype != 'bool':
-        problem_records.append("is_active列包含非布尔值\n")
-    
-    return problem_records, delete_records
-
-# 记录总开始时间
-total_start_time = time.time()
-
-# 1. 列出目录中的所有Parquet文件
-parquet_files = [f for f in os.listdir(parquet_dir) if f.endswith('.parquet')]
-
-if not parquet_files:
-    print("该目录中没有找到Parquet文件")
-else:
+        return None, '', e
+
+def collect_income_stats(file_path):
+    """第一阶段：只读取 income 列，返回该文件可合并的统计量"""
+    income = dataset.read(file_path, ['income'])['income']
+    income = pd.to_numeric(income, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    return {
+        "stats": RunningStats().update(income).to_dict(),
+        "sketch": QuantileSketch().update(income).to_dict(),
+    }
+
+def global_income_stats(file_paths, manifest, workers=1):
+    """
+    第一阶段：并行收集所有文件的收入统计并合并
+    每个文件的统计结果缓存在 partial_dir 中，内容未变化的文件不再重新读取
+    返回:
+        (RunningStats, QuantileSketch): 全量数据集的统计量
+    """
+    partials, todo = {}, []
+    for file_path in file_paths:
+        partial_path = os.path.join(partial_dir, f"{os.path.basename(file_path)}.stats.json")
+        if manifest.is_current(file_path, 'income_stats', outputs=[partial_path]):
+            with open(partial_path, encoding='utf-8') as f:
+                partials[file_path] = json.load(f)
+        else:
+            todo.append(file_path)
+    print(f"收入统计: {len(partials)} 个文件沿用缓存, {len(todo)} 个文件需要计算")
+
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(collect_income_stats, file_path): file_path for file_path in todo}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                partials[file_path] = future.result()
+            except Exception as e:
+                print(f"统计文件 {os.path.basename(file_path)} 的收入时出错: {e}")
+                continue
+            partial_path = os.path.join(partial_dir, f"{os.path.basename(file_path)}.stats.json")
+            with open(partial_path, 'w', encoding='utf-8') as f:
+                json.dump(partials[file_path], f)
+            manifest.record(file_path, 'income_stats', [partial_path])
+
+    stats, sketch = RunningStats(), QuantileSketch()
+    for file_path in file_paths:
+        if file_path in partials:
+            stats.merge(RunningStats.from_dict(partials[file_path]["stats"]))
+            sketch.merge(QuantileSketch.from_dict(partials[file_path]["sketch"]))
+    return stats, sketch
+
+def duplicate_bucket_path(file):
+    """某个文件的分桶中间文件"""
+    return os.path.join(duplicate_dir, f"{file}.parquet")
+
+def duplicate_key_column(table, key):
+    """
+    取出查重用的键（统一为字符串）及其行号，空值和空邮箱跳过
+    含空值的整数 id 可能被存成浮点，先还原为整数，保证各文件的键写法一致
+    返回:
+        (Array, ndarray): 键与对应的文件内行号
+    """
+    column = table.column(key).combine_chunks()
+    if pa.types.is_floating(column.type):
+        try:
+            column = column.cast(pa.int64())
+        except pa.ArrowInvalid:
+            pass
+    column = column.cast(pa.string())
+    if key == 'email':
+        column = pc.utf8_lower(pc.utf8_trim_whitespace(column))
+        column = pc.if_else(pc.equal(column, ''), pa.scalar(None, column.type), column)
+    valid = column.is_valid().to_numpy(zero_copy_only=False)
+    return column.filter(valid), np.flatnonzero(valid)
+
+def write_duplicate_buckets(file_path, buckets):
+    """
+    查重第一遍：只读取 id/email 列，按键的哈希把 (key, row) 分桶，写成一个按 bucket 排序的文件
+    每个桶单独一个行组（空桶也写空行组），第二遍按行组号只读取所需的桶；
+    同一个键无论出现在哪个文件都落在同一个桶里，第二遍逐桶查找即可
+    """
+    table = dataset.read_arrow(file_path, DUPLICATE_KEYS)
+    parts = []
+    for key in DUPLICATE_KEYS:
+        values, rows = duplicate_key_column(table, key)
+        hashes = pd.util.hash_array(values.to_numpy(zero_copy_only=False))
+        parts.append(pa.table({
+            'bucket': pa.array((hashes % np.uint64(buckets)).astype(np.int32), pa.int32()),
+            'key_type': pa.array([key] * len(values), pa.string()),
+            'key': values,
+            'row': pa.array(rows, pa.int64()),
+        }, schema=DUPLICATE_BUCKET_SCHEMA))
+    part = pa.concat_tables(parts)
+    bucket_ids = part.column('bucket').to_numpy()
+    order = np.argsort(bucket_ids, kind='stable')
+    bounds = np.searchsorted(bucket_ids[order], np.arange(buckets + 1))
+    part = part.take(order)
+    os.makedirs(duplicate_dir, exist_ok=True)
+    with pq.ParquetWriter(duplicate_bucket_path(os.path.basename(file_path)), DUPLICATE_BUCKET_SCHEMA) as writer:
+        for bucket in range(buckets):
+            size = int(bounds[bucket + 1] - bounds[bucket])
+            writer.write_table(part.slice(bounds[bucket], size), row_group_size=max(1, size))
+
+def find_bucket_duplicates(bucket, files):
+    """
+    查重第二遍：读取所有文件分桶文件中该桶的行组，找出出现不止一次的键
+    返回:
+        (Table, dict): 重复键涉及的全部行，以及各键类型的重复组数、行数、跨文件组数
+    """
+    bucket_parts = [pq.ParquetFile(duplicate_bucket_path(file)).read_row_group(bucket, columns=['key_type', 'key', 'row'])
+                    for file in files]
+    tables, summary = [], {}
+    for key in DUPLICATE_KEYS:
+        parts = [part.filter(pc.equal(part.column('key_type'), key)) for part in bucket_parts]
+        df = pd.DataFrame({
+            'key': pd.concat([part.column('key').to_pandas() for part in parts], ignore_index=True),
+            'file': pd.Categorical.from_codes(np.repeat(np.arange(len(files)), [len(part) for part in parts]), files),
+            'row': np.concatenate([part.column('row').to_numpy() for part in parts]),
+        })
+        df = df[df['key'].duplicated(keep=False)]
+        groups = df.groupby('key', sort=True, observed=True)
+        df = df.assign(group_size=groups['row'].transform('size').astype(np.int32)).sort_values(['key', 'file', 'row'])
+        file_counts = groups['file'].nunique()
+        summary[key] = {"groups": len(file_counts), "rows": len(df),
+                        "cross_file_groups": int((file_counts > 1).sum())}
+        tables.append(pa.table({
+            'key_type': pa.array([key] * len(df), pa.string()),
+            'key': pa.array(df['key'], pa.string()),
+            'file': pa.array(df['file'].astype(str), pa.string()),
+            'row': pa.array(df['row'], pa.int64()),
+            'group_size': pa.array(df['group_size'], pa.int32()),
+        }, schema=DUPLICATE_SCHEMA))
+    return pa.concat_tables(tables), summary
+
+def prune_duplicate_buckets(files):
+    """
+    删除不再需要的分桶中间文件：已不在输入目录中的文件的分桶文件，以及旧的按键/桶分目录的中间文件
+    其余分桶文件保留，下次运行时未变化的文件直接沿用（不需要时可整个删除 duplicate_buckets 目录）
+    返回:
+        int: 删除的文件数
+    """
+    if not os.path.isdir(duplicate_dir):
+        return 0
+    removed = 0
+    files = {f"{file}.parquet" for file in files}
+    for name in os.listdir(duplicate_dir):
+        path = os.path.join(duplicate_dir, name)
+        if os.path.isdir(path):
+            removed += sum(len(names) for _, _, names in os.walk(path))
+            shutil.rmtree(path)
+        elif name not in files:
+            os.remove(path)
+            removed += 1
+    return removed
+
+def find_duplicates(file_paths, manifest, workers=1, buckets=DUPLICATE_BUCKETS):
+    """
+    跨文件检测重复的 id/email：第一遍按文件并行分桶写出，第二遍按桶并行查找
+    内存只需容纳单个桶（约为全部键的 1/buckets），未变化文件的分桶结果沿用缓存；
+    分桶中间文件（每个输入文件一个，每桶一个行组）保留在 duplicate_buckets 下供增量运行，
+    分桶数变化时按清单重新分桶，输入文件删除后多余的部分由 prune_duplicate_buckets 清理
+    返回:
+        dict: 各键类型的重复组数、行数、跨文件组数
+    """
+    params, files, todo = {"buckets": buckets}, [], []
+    for file_path in file_paths:
+        file = os.path.basename(file_path)
+        if manifest.is_current(file_path, 'duplicate_buckets', params, [duplicate_bucket_path(file)]):
+            files.append(file)
+        else:
+            todo.append(file_path)
+    print(f"跨文件查重: {len(files)} 个文件沿用分桶缓存, {len(todo)} 个文件需要分桶")
+
+    # 工作进程按输出目录初始化，不依赖 fork 继承主进程的全局变量
+    with ProcessPoolExecutor(max_workers=max(1, workers), initializer=set_output_dir,
+                             initargs=(output_dir,)) as pool:
+        futures = {pool.submit(write_duplicate_buckets, file_path, buckets): file_path for file_path in todo}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"文件 {os.path.basename(file_path)} 分桶时出错: {e}")
+                continue
+            file = os.path.basename(file_path)
+            files.append(file)
+            manifest.record(file_path, 'duplicate_buckets', [duplicate_bucket_path(file)], params=params)
+
+        files.sort()
+        removed = prune_duplicate_buckets(files)
+        if removed:
+            print(f"已清理 {removed} 个不再需要的分桶中间文件")
+        totals = {key: {"groups": 0, "rows": 0, "cross_file_groups": 0} for key in DUPLICATE_KEYS}
+        file_rows = {file: dict.fromkeys(DUPLICATE_KEYS, 0) for file in files}
+        with pq.ParquetWriter(duplicates_file, DUPLICATE_SCHEMA) as writer:
+            for table, summary in pool.map(find_bucket_duplicates, range(buckets), [files] * buckets):
+                writer.write_table(table)
+                for key, counts in summary.items():
+                    for name, count in counts.items():
+                        totals[key][name] += count
+                for row in table.group_by(['file', 'key_type']).aggregate([([], 'count_all')]).to_pylist():
+                    file_rows[row['file']][row['key_type']] += row['count_all']
+
+    with open(duplicate_summary_file, 'w', encoding='utf-8') as f:
+        json.dump({"buckets": buckets, "total": totals, "files": file_rows}, f, ensure_ascii=False, indent=1)
+    return totals
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="数据异常检测")
+    arg_parser.add_argument('--text-report', action='store_true',
+                            help="额外输出文本摘要（problem.txt / need_delete.txt）")
+    arg_parser.add_argument('--global-stats', action='store_true',
+                            help="两阶段模式：先统计全量数据集的收入分布，再按统一的3σ阈值检测")
+    arg_parser.add_argument('--duplicates', action='store_true',
+                            help="跨文件检测重复的 id/email（按哈希分桶，内存占用有界；"
+                                 "分桶中间文件保留在输出目录的 duplicate_buckets 下供增量运行）")
+    arg_parser.add_argument('--buckets', type=int, default=DUPLICATE_BUCKETS, help="跨文件查重的分桶数")
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help="全量收入统计和跨文件查重的并行进程数")
+    arg_parser.add_argument('--prefetch', type=int, default=dataset.PREFETCH_DEPTH,
+                            help="预读深度：检测当前文件时后台提前读取的文件数（0 关闭）")
+    arg_parser.add_argument('--input-dir', default=parquet_dir, help="输入 Parquet 目录")
+    arg_parser.add_argument('--output-dir', default='.', help="检测结果输出目录")
+    arg_parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help="处理清单路径（增量运行）")
+    args = arg_parser.parse_args(argv)
+    input_dir = args.input_dir
+
+    set_output_dir(args.output_dir)
+    manifest = Manifest(args.manifest)
+
+    # 记录总开始时间
+    total_start_time = time.time()
+
+    # 1. 列出目录中的所有Parquet文件
+    parquet_files = [f for f in sorted(os.listdir(input_dir)) if f.endswith('.parquet')]
+
+    if not parquet_files:
+        print("该目录中没有找到Parquet文件")
+        return
+
     print(f"找到 {len(parquet_files)} 个Parquet文件:")
     for i, f in enumerate(parquet_files[:5]):
         print(f"{i+1}. {f}")
     if len(parquet_files) > 5:
         print(f"...以及另外 {len(parquet_files)-5} 个文件")
-    
+
     # 初始化统计信息
     total_problems = 0
     total_deletes = 0
     total_files = 0
-    
-    # 2. 处理每个文件
+    done_files, errors = [], {}
+
+    # 两阶段模式：第一阶段合并全量数据集的收入统计，得到统一的3σ阈值
+    threshold = None
+    if args.global_stats:
+        stage_start = time.time()
+        stats, sketch = global_income_stats(
+            [os.path.join(input_dir, f) for f in parquet_files], manifest, args.workers
+        )
+        threshold = stats.mean + 3 * stats.std()
+        quantiles = dict(zip(['p50', 'p90', 'p99', 'p99.9'], sketch.quantiles([0.5, 0.9, 0.99, 0.999])))
+        with open(income_stats_file, 'w', encoding='utf-8') as f:
+            json.dump({**stats.to_dict(), "std": stats.std(), "threshold": threshold, "quantiles": quantiles}, f, indent=1)
+        print(f"全量收入统计: {stats.count} 行, 均值 {stats.mean:.2f}, 标准差 {stats.std():.2f}, "
+              f"3σ阈值 {threshold:.2f} | 耗时 {time.time()-stage_start:.2f} 秒")
+        print("收入分位数(近似): " + ", ".join(f"{k}={v:.2f}" for k, v in quantiles.items()))
+    params = {"income_threshold": threshold}
+
+    # 2. 处理每个文件（后台线程提前读取下一个文件）
+    schema = mask_schema(id_type([os.path.join(input_dir, f) for f in parquet_files]))
+    # 处理清单只在主线程中访问：先确定沿用缓存的文件，预读线程只读取需要检测的文件
+    cached = {f for f in parquet_files
+              if manifest.is_current(os.path.join(input_dir, f), 'check', params, check_partial_paths(f))}
+    reads = dataset.prefetch((read_check_input(os.path.join(input_dir, f)) for f in parquet_files if f not in cached),
+                             args.prefetch)
     for file in parquet_files:
         file_start_time = time.time()
-        file_path = os.path.join(parquet_dir, file)
+        file_path = os.path.join(input_dir, file)
         print(f"\n开始处理文件: {file}")
-        
+
         try:
-            df = pd.read_parquet(file_path)
-            
-            # 检测异常值
-            problems, deletes = detect_anomalies(df)
-            
-            # 写入结果文件
-            with open(problem_file, 'a') as f:
-                f.write(f"\n=== 文件 {file} 的常规异常 ===\n")
-                f.write("\n".join(problems))
-                total_problems += len(problems)
-            
-            with open(need_delete_file, 'a') as f:
-                f.write(f"\n=== 文件 {file} 的严重异常 ===\n")
-                f.write("\n".join(deletes))
-                total_deletes += len(deletes)
-            
+            if file in cached:
+                # 文件未变化，沿用上次的检测结果
+                table, counts = load_check_partial(file, schema)
+                print("文件未变化，沿用缓存结果")
+            else:
+                df, read_summary, read_error = next(reads)
+                if read_error is not None:
+                    raise read_error
+                print(f"读取: {read_summary}")
+
+                # 检测异常值
+                mask = detect_anomalies(df, threshold)
+                table = anomaly_table(file, df, mask, schema)
+                counts = count_rules(mask)
+                save_check_partial(file_path, table, counts, manifest, params)
+                del df
+
+            done_files.append(file)
+            masks = table.column('mask').to_numpy()
+            problems = int(np.count_nonzero(masks & NORMAL_MASK))
+            deletes = int(np.count_nonzero(masks & SEVERE_MASK))
+            total_problems += problems
+            total_deletes += deletes
+
             # 计算文件处理时间
             file_time = time.time() - file_start_time
             total_files += 1
-            
+
             # 显示当前文件处理信息
-            print(f"处理完成: 发现 {len(problems)} 条常规异常, {len(deletes)} 条严重异常")
+            print(f"处理完成: 发现 {problems} 行常规异常, {deletes} 行严重异常")
             print(f"处理时间: {file_time:.2f} 秒")
-            
+
         except Exception as e:
             file_time = time.time() - file_start_time
             print(f"处理文件 {file} 时出错: {e}")
             print(f"错误处理时间: {file_time:.2f} 秒")
-            with open(problem_file, 'a') as f:
-                f.write(f"\n处理文件 {file} 时出错: {e}\n")
+            errors[file] = {"error": str(e)}
+
+    # 汇总输出各文件结果及各规则命中数
+    totals = write_check_outputs(done_files, schema, args.text_report, errors)
+
+    # 跨文件查重
+    duplicate_totals = None
+    if args.duplicates:
+        stage_start = time.time()
+        duplicate_totals = find_duplicates(
+            [os.path.join(input_dir, f) for f in parquet_files], manifest, args.workers, args.buckets
+        )
+        print(f"跨文件查重完成 | 耗时 {time.time()-stage_start:.2f} 秒")
 
     # 计算总处理时间
     total_time = time.time() - total_start_time
-    
+
     # 打印汇总统计
     print("\n" + "="*50)
     print("处理完成! 汇总统计:")
     print(f"- 处理文件总数: {total_files}/{len(parquet_files)}")
-    print(f"- 发现常规异常总数: {total_problems}")
-    print(f"- 发现严重异常总数: {total_deletes}")
+    print(f"- 常规异常行数: {total_problems}")
+    print(f"- 严重异常行数: {total_deletes}")
+    for rule, count in totals.items():
+        print(f"  · {RULE_LABELS[rule]}: {count}")
+    if duplicate_totals:
+        for key, counts in duplicate_totals.items():
+            print(f"- 重复 {key}: {counts['groups']} 组 (跨文件 {counts['cross_file_groups']} 组), "
+                  f"涉及 {counts['rows']} 行")
+    dataset.report_read_stats()
     print(f"- 总处理时间: {total_time:.2f} 秒")
     print(f"- 平均每个文件处理时间: {total_time/max(1, total_files):.2f} 秒")
     print("结果已保存到:")
-    print(f"- 常规异常: {problem_file}")
-    print(f"- 严重异常: {need_delete_file}")
+    print(f"- 异常位掩码: {anomaly_file}")
+    print(f"- 规则统计: {counts_file}")
+    if args.text_report:
+        print(f"- 常规异常摘要: {problem_file}")
+        print(f"- 严重异常摘要: {need_delete_file}")
+    if duplicate_totals:
+        print(f"- 重复键明细: {duplicates_file}")
+        print(f"- 查重统计: {duplicate_summary_file}")
     print("="*50)
+
+if __name__ == "__main__":
+    main()
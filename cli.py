@@ -0,0 +1,35 @@
+import sys
+import importlib
+
+# 统一命令行入口：python cli.py <子命令> [参数]
+# 只导入所选子命令的模块，绘图库在各模块中按需加载，短任务和无界面运行启动更快
+COMMANDS = {
+    'compact': ('compact', "历史字段压缩为嵌套列（一次性预处理，下游免解析）"),
+    'profile': ('analysis', "生成用户画像"),
+    'check': ('check', "数据异常检测"),
+    'show': ('show', "用户数据分布图表"),
+    'pipeline': ('pipeline', "单次扫描流水线（检测、分布统计、画像一次读取完成）"),
+    'index': ('profile_index', "画像点查索引（build 建立/更新，lookup 按 user_id 查询）"),
+}
+
+def usage():
+    lines = ["用法: python cli.py <子命令> [参数]（子命令后加 -h 查看参数）", "", "子命令:"]
+    lines += [f"  {name:<10} {description}" for name, (_, description) in COMMANDS.items()]
+    return "\n".join(lines)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0
+    command, rest = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(f"未知的子命令: {command}\n\n{usage()}", file=sys.stderr)
+        return 2
+    sys.argv[0] = f"cli.py {command}"  # 子命令帮助信息中显示的程序名
+    # 子命令的返回值作为退出码（返回 None 视为成功）；子命令中的 SystemExit 直接向外传递
+    result = importlib.import_module(COMMANDS[command][0]).main(rest)
+    return result if isinstance(result, int) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from analysis import safe_json_parse, parse_datetime_series
+from manifest import Manifest, DEFAULT_MANIFEST
+from metrics import METRICS, start_profiler, stop_profiler
+
+# 历史字段一次性压缩：把 purchase_history / login_history 的类JSON字符串转为 Arrow 嵌套列，
+# 写出压缩副本（其余列原样保留）；下游读取压缩副本时不再做 JSON 和时间解析
+# 无法解析的历史记录写入隔离表，压缩副本中该字段为空（与原先解析失败时按空记录处理一致）
+
+# 文件路径配置（命令行 --input-dir / --output-dir 可覆盖）
+parquet_dir = '/work/share/acf6pa03fy/liyanjie/data/10G_data_new'
+output_dir = 'compacted'
+
+PURCHASE_TYPE = pa.struct([
+    ('avg_price', pa.float64()),
+    ('categories', pa.string()),
+    ('payment_method', pa.string()),
+    ('payment_status', pa.string()),
+    ('items', pa.list_(pa.string())),  # 每个商品一条紧凑JSON（下游只用到商品个数）
+])
+LOGIN_TYPE = pa.struct([
+    ('timestamps', pa.list_(pa.timestamp('us', 'UTC'))),  # 无法解析的时间戳为空值，保留原始个数
+    ('devices', pa.list_(pa.string())),
+    ('avg_session_duration', pa.float64()),
+])
+HISTORY_TYPES = {'purchase_history': PURCHASE_TYPE, 'login_history': LOGIN_TYPE}
+QUARANTINE_DIR = '_quarantine'  # 压缩输出目录下的子目录，每个输入文件一个隔离文件，整个目录可作为一张表读取
+
+def quarantine_schema(id_type=pa.int64()):
+    """隔离表的 Arrow schema"""
+    return pa.schema([
+        ('file', pa.string()), ('row', pa.int64()), ('id', id_type),
+        ('column', pa.string()), ('reason', pa.string()), ('value', pa.string()),
+    ])
+
+def decode_history(value):
+    """
+    按 safe_json_parse 的规则解码一条历史记录，但区分空值与解析失败
+    返回:
+        (dict, str): 解码后的字典（空值或空对象为 None）与失败原因（成功为 None）
+    """
+    if not isinstance(value, str) or not value:
+        return None, None
+    try:
+        data = json.loads(value.replace("'", '"').replace("None", "null"))
+    except json.JSONDecodeError as e:
+        return None, f"invalid_json: {e}"
+    if not isinstance(data, dict):
+        return None, f"not_object: {type(data).__name__}"
+    return data or None, None
+
+def _items(items):
+    """商品列表规范化为每项一条JSON（与 summarize_purchase 计数规则一致）"""
+    if isinstance(items, str):
+        items = safe_json_parse(items) or []
+    if isinstance(items, dict):
+        items = [{k: v} for k, v in items.items()]
+    if not isinstance(items, list):
+        return []
+    return [json.dumps(item, ensure_ascii=False) for item in items]
+
+def purchase_record(data):
+    """购买历史字典 -> PURCHASE_TYPE 的一行；只填原字典中出现的键，类型不符时抛出异常"""
+    record = {}
+    if 'avg_price' in data:
+        record['avg_price'] = float(data['avg_price'])
+    for key in ('categories', 'payment_method', 'payment_status'):
+        if key in data:
+            record[key] = str(data[key])
+    if 'items' in data:
+        record['items'] = _items(data['items'])
+    return record
+
+def login_record(data):
+    """登录历史字典 -> LOGIN_TYPE 的一行（timestamps 仍为原始值，由调用方整批解析）"""
+    record = {}
+    if 'timestamps' in data:
+        timestamps = data['timestamps']
+        if isinstance(timestamps, str):
+            timestamps = safe_json_parse(timestamps) or []
+        if not isinstance(timestamps, list):
+            raise TypeError(f"timestamps 不是列表: {type(timestamps).__name__}")
+        record['timestamps'] = timestamps
+    if 'devices' in data:
+        if not isinstance(data['devices'], list):
+            raise TypeError(f"devices 不是列表: {type(data['devices']).__name__}")
+        record['devices'] = [str(d) for d in data['devices']]
+    if 'avg_session_duration' in data:
+        record['avg_session_duration'] = float(data['avg_session_duration'])
+    return record
+
+def _convert(values, to_record):
+    """
+    逐条解码并转为记录
+    返回:
+        (list, list): 每行的记录（空值或失败为 None），以及 (行号, 失败原因) 列表
+    """
+    records, failures = [], []
+    for i, value in enumerate(values):
+        data, reason = decode_history(value)
+        record = None
+        if data is not None:
+            try:
+                record = to_record(data)
+            except (TypeError, ValueError) as e:
+                reason = f"invalid_field: {e}"
+        if reason is not None:
+            failures.append((i, reason))
+        records.append(record)
+    return records, failures
+
+def _field_array(records, name, arrow_type):
+    return pa.array([None if r is None else r.get(name) for r in records], arrow_type)
+
+def _timestamps_array(records):
+    """所有行的时间戳拼成一列整批解析，再按每行个数组装为列表列"""
+    counts = [len(r['timestamps']) if r is not None and 'timestamps' in r else 0 for r in records]
+    raw = [ts for r in records if r is not None for ts in r.get('timestamps', ())]
+    times = parse_datetime_series(raw) if raw else pd.Series(dtype='datetime64[us, UTC]')
+    values = pa.array(times, from_pandas=True).cast(LOGIN_TYPE.field('timestamps').type.value_type, safe=False)
+    offsets = pa.array(np.concatenate([[0], np.cumsum(counts)]).astype(np.int32))
+    missing = pa.array([r is None or 'timestamps' not in r for r in records])
+    return pa.ListArray.from_arrays(offsets, values, mask=missing)
+
+def history_array(records, arrow_type):
+    """把记录列表按列组装为结构体列（逐字段建数组，不逐行构造 Arrow 对象）"""
+    children = []
+    for field in arrow_type:
+        if field.name == 'timestamps':
+            children.append(_timestamps_array(records))
+        else:
+            children.append(_field_array(records, field.name, field.type))
+    mask = pa.array([r is None for r in records])
+    return pa.StructArray.from_arrays(children, fields=list(arrow_type), mask=mask)
+
+CONVERTERS = {'purchase_history': purchase_record, 'login_history': login_record}
+
+def compact_batch(batch, file, offset=0):
+    """
+    压缩一个记录批次
+    参数:
+        offset (int): 本批第一行在文件中的行号
+    返回:
+        (Table, dict): 历史列替换为嵌套列后的表；隔离记录（按列组织，可直接建表）
+    """
+    table = pa.Table.from_batches([batch])
+    ids = table.column('id').to_pylist() if 'id' in table.column_names else [None] * len(table)
+    quarantine = {name: [] for name in quarantine_schema().names}
+    for column, arrow_type in HISTORY_TYPES.items():
+        if column not in table.column_names:
+            continue
+        values = table.column(column).to_pylist()
+        records, failures = _convert(values, CONVERTERS[column])
+        index = table.column_names.index(column)
+        table = table.set_column(index, pa.field(column, arrow_type), history_array(records, arrow_type))
+        for i, reason in failures:
+            quarantine['file'].append(file)
+            quarantine['row'].append(offset + i)
+            quarantine['id'].append(ids[i])
+            quarantine['column'].append(column)
+            quarantine['reason'].append(reason)
+            quarantine['value'].append(values[i])
+        METRICS.incr(f"quarantined.{column}", len(failures))
+    return table, quarantine
+
+def compacted_schema(schema):
+    """输入 schema 中的历史列替换为嵌套类型"""
+    for column, arrow_type in HISTORY_TYPES.items():
+        index = schema.get_field_index(column)
+        if index >= 0:
+            schema = schema.set(index, pa.field(column, arrow_type))
+    return schema
+
+def is_compacted(schema):
+    """文件的历史列是否已是嵌套类型"""
+    return any(pa.types.is_struct(schema.field(c).type) for c in HISTORY_TYPES if c in schema.names)
+
+def compacted_paths(file_path):
+    """压缩副本与隔离文件路径"""
+    file = os.path.basename(file_path)
+    return os.path.join(output_dir, file), os.path.join(output_dir, QUARANTINE_DIR, file)
+
+def compact_file(file_path, batch_size=100_000):
+    """
+    压缩单个文件：按批读取、转换并追加写出，内存只与批大小相关
+    先写临时文件，全部写完再替换，中途失败不会留下不完整的压缩副本
+    返回:
+        (int, int): 行数与隔离记录数
+    """
+    paths = compacted_paths(file_path)
+    tmp_paths = [f"{path}.tmp" for path in paths]
+    parquet_file = pq.ParquetFile(file_path)
+    schema = parquet_file.schema_arrow
+    q_schema = quarantine_schema(schema.field('id').type if 'id' in schema.names else pa.int64())
+    rows = quarantined = 0
+    try:
+        with pq.ParquetWriter(tmp_paths[0], compacted_schema(schema)) as writer, \
+                pq.ParquetWriter(tmp_paths[1], q_schema) as q_writer:
+            batches = iter(parquet_file.iter_batches(batch_size=batch_size))
+            while True:
+                with METRICS.timer('read'):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                with METRICS.timer('compact'):
+                    table, quarantine = compact_batch(batch, os.path.basename(file_path), rows)
+                with METRICS.timer('write'):
+                    writer.write_table(table)
+                    q_writer.write_table(pa.table(quarantine, schema=q_schema))
+                rows += len(table)
+                quarantined += len(quarantine['row'])
+    except BaseException:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    for tmp_path, path in zip(tmp_paths, paths):
+        os.replace(tmp_path, path)
+    METRICS.incr('rows', rows)
+    return rows, quarantined
+
+def compact_dataset(file_paths, manifest, batch_size=100_000):
+    """
+    压缩多个文件（未变化且产出仍在的文件跳过）
+    返回:
+        dict: 文件 -> {"rows", "quarantined"} 或 {"error"}
+    """
+    os.makedirs(os.path.join(output_dir, QUARANTINE_DIR), exist_ok=True)
+    params = {"batch_size": batch_size}
+    results = {}
+    for file_path in file_paths:
+        file = os.path.basename(file_path)
+        outputs = list(compacted_paths(file_path))
+        if manifest.is_current(file_path, 'compact', params, outputs):
+            results[file] = manifest.result(file_path, 'compact')
+            print(f"{file}: 文件未变化，沿用已有的压缩副本")
+            continue
+        if is_compacted(pq.ParquetFile(file_path).schema_arrow):
+            print(f"{file}: 历史列已是嵌套类型，跳过")
+            continue
+        start = time.time()
+        try:
+            with METRICS.file(file):
+                rows, quarantined = compact_file(file_path, batch_size)
+        except Exception as e:
+            METRICS.error('compact', e, file)
+            results[file] = {"error": str(e)}
+            print(f"{file}: 压缩失败 - {e}")
+            continue
+        results[file] = {"rows": rows, "quarantined": quarantined}
+        manifest.record(file_path, 'compact', outputs, result=results[file], params=params)
+        before, after = os.path.getsize(file_path), os.path.getsize(outputs[0])
+        print(f"{file}: {rows} 行 | 隔离 {quarantined} 条 | {before / 1e6:.1f}MB -> {after / 1e6:.1f}MB | "
+              f"耗时 {time.time()-start:.2f}秒")
+    return results
+
+def main(argv=None):
+    global output_dir
+    arg_parser = argparse.ArgumentParser(description="把历史字段一次性压缩为 Arrow 嵌套列，下游不再解析JSON")
+    arg_parser.add_argument('--input-dir', default=parquet_dir, help="输入 Parquet 目录")
+    arg_parser.add_argument('--output-dir', default=output_dir, help="压缩副本输出目录（下游脚本的 --input-dir）")
+    arg_parser.add_argument('--batch-size', type=int, default=100_000, help="每批读取的行数")
+    arg_parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help="处理清单路径（增量运行）")
+    arg_parser.add_argument('--metrics', default='compact_metrics.json', help="运行指标 JSON 输出路径")
+    arg_parser.add_argument('--profile', metavar='PATH', help="开启性能剖析并把结果写入 PATH")
+    arg_parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile', help="剖析工具")
+    args = arg_parser.parse_args(argv)
+    output_dir = args.output_dir
+
+    file_paths = [os.path.join(args.input_dir, f) for f in sorted(os.listdir(args.input_dir)) if f.endswith('.parquet')]
+    if not file_paths:
+        print("该目录中没有找到Parquet文件")
+        return
+
+    start = time.time()
+    profiler = start_profiler(args.profile, args.profiler)
+    results = compact_dataset(file_paths, Manifest(args.manifest), args.batch_size)
+    stop_profiler(profiler)
+
+    done = [r for r in results.values() if r and "error" not in r]
+    print(f"\n压缩完成: {len(done)}/{len(file_paths)} 个文件, {sum(r['rows'] for r in done)} 行, "
+          f"隔离 {sum(r['quarantined'] for r in done)} 条 | 总耗时 {time.time()-start:.1f}秒")
+    print(f"压缩副本: {output_dir}（作为其他脚本的 --input-dir）")
+    print(f"隔离表: {os.path.join(output_dir, QUARANTINE_DIR)}（pq.read_table 读取整个目录）")
+    METRICS.report()
+    METRICS.save(args.metrics)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+import time
+import queue
+import operator
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from metrics import METRICS
+
+# 原始用户数据的统一读取：声明各列读入后的类型，只读取调用方需要的列，数值列降精度，
+# 字符串和时间列保持 Arrow 存储；简单过滤条件先按行组统计信息跳过整个行组，再逐行过滤。
+# 每次读取文件中的总字节数、实际读取的字节数、降精度前后的内存计入 METRICS 的 read.* 计数器；
+# prefetch 在后台线程中提前读取下一批（或下一个文件），与当前批的处理重叠
+
+# 列名 -> 读入后的类型（None 为按文件原样读取）
+SCHEMA = {
+    'id': pa.int64(),
+    'email': pa.string(),
+    'age': pa.int8(),  # 按文件内取值范围在 int8/int16/int32 中选能容纳的最小类型
+    'income': pa.float32(),
+    'gender': pa.string(),
+    'country': pa.string(),
+    'address': pa.string(),
+    'is_active': None,  # 保持原样，check 要识别非布尔值
+    'last_login': pa.timestamp('us', 'UTC'),  # parse_dates 时解析为 Arrow 时间戳
+    'registration_date': pa.timestamp('us', 'UTC'),
+    'purchase_history': None,  # JSON 字符串或压缩后的嵌套列
+    'login_history': None,
+}
+INT_TYPES = [pa.int8(), pa.int16(), pa.int32(), pa.int64()]
+# 含空值的整数列转为 pandas 时会变成浮点，取值在此范围内时用 float32 代替 float64
+FLOAT32_EXACT = 2 ** 24
+# 即 pandas 3 默认的 str 类型；旧版本 pandas 也得到 Arrow 存储的字符串
+STRING_DTYPE = pd.StringDtype('pyarrow', na_value=np.nan)
+# 预读深度缺省为1（双缓冲：处理当前批的同时读取下一批）
+PREFETCH_DEPTH = 1
+FILTER_OPS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+              '>': operator.gt, '>=': operator.ge}
+
+def _count(counters, name, n):
+    """计入全局 METRICS，同时计入调用方传入的本次读取计数器（在预读线程中读取时用于单独汇报）"""
+    METRICS.incr(name, n)
+    if counters is not None and n:
+        counters[name] += n
+
+def _columns(parquet_file, columns):
+    """请求的列中文件里实际存在的列（缺省为全部列）；未声明的列名报错"""
+    names = parquet_file.schema_arrow.names
+    if columns is None:
+        return list(names)
+    unknown = [c for c in columns if c not in SCHEMA]
+    if unknown:
+        raise ValueError(f"未知的列: {', '.join(unknown)}")
+    return [c for c in columns if c in names]
+
+def _leaf_columns(metadata):
+    """顶层列名 -> 其叶子列在行组元数据中的序号（嵌套列有多个叶子）"""
+    leaves = {}
+    if metadata.num_row_groups:
+        row_group = metadata.row_group(0)
+        for j in range(row_group.num_columns):
+            leaves.setdefault(row_group.column(j).path_in_schema.split('.')[0], []).append(j)
+    return leaves
+
+def _statistics(metadata, leaves, group, column):
+    """扁平列在某个行组的统计信息（没有时返回 None）"""
+    if len(leaves.get(column, ())) != 1:
+        return None
+    statistics = metadata.row_group(group).column(leaves[column][0]).statistics
+    return statistics if statistics is not None and statistics.has_min_max else None
+
+def _may_match(statistics, op, value):
+    """按行组的最小/最大值判断是否可能有满足条件的行（无统计信息或无法比较时视为可能）"""
+    if statistics is None:
+        return True
+    low, high = statistics.min, statistics.max
+    try:
+        if op == '==':
+            return low <= value <= high
+        if op == 'in':
+            return any(low <= v <= high for v in value)
+        if op == '!=':
+            return not (low == high == value)
+        if op in ('<', '<='):
+            return FILTER_OPS[op](low, value)
+        return FILTER_OPS[op](high, value)
+    except TypeError:
+        return True
+
+def filter_expression(filters):
+    """
+    把 [(列, 运算符, 值), ...]（各条件同时成立）转为 Arrow 表达式
+    运算符: == != < <= > >= in
+    """
+    expression = None
+    for column, op, value in filters:
+        if op == 'in':
+            term = pc.field(column).isin(list(value))
+        elif op in FILTER_OPS:
+            term = FILTER_OPS[op](pc.field(column), value)
+        else:
+            raise ValueError(f"不支持的过滤运算符: {op}")
+        expression = term if expression is None else expression & term
+    return expression
+
+def _bounds(parquet_file, leaves, column):
+    """
+    整个文件中某列的 (最小值, 最大值, 是否有空值)，统计信息不全时返回 None
+    按整个文件而不是单个批次确定降精度的类型，同一文件各批次的类型一致
+    """
+    metadata = parquet_file.metadata
+    low = high = None
+    nulls = False
+    for group in range(metadata.num_row_groups):
+        statistics = _statistics(metadata, leaves, group, column)
+        if statistics is None or not statistics.has_null_count:
+            return None
+        low = statistics.min if low is None else min(low, statistics.min)
+        high = statistics.max if high is None else max(high, statistics.max)
+        nulls = nulls or statistics.null_count > 0
+    return None if low is None else (low, high, nulls)
+
+def downcast_types(parquet_file, columns, leaves=None):
+    """
+    各数值列降精度后的类型：整数列取能容纳取值范围的最小类型（含空值时用 float32），
+    浮点列转为声明的较窄类型；其余列不在返回结果中
+    """
+    schema = parquet_file.schema_arrow
+    leaves = _leaf_columns(parquet_file.metadata) if leaves is None else leaves
+    types = {}
+    for column in columns:
+        source, declared = schema.field(column).type, SCHEMA.get(column)
+        if declared is None:
+            continue
+        if pa.types.is_integer(source) and pa.types.is_integer(declared):
+            bounds = _bounds(parquet_file, leaves, column)
+            if bounds is None:
+                continue
+            low, high, nulls = bounds
+            if nulls:
+                target = pa.float32() if -FLOAT32_EXACT <= low and high <= FLOAT32_EXACT else None
+            else:
+                target = next((t for t in INT_TYPES[INT_TYPES.index(declared):]
+                               if np.iinfo(t.to_pandas_dtype()).min <= low
+                               and high <= np.iinfo(t.to_pandas_dtype()).max), None)
+        elif pa.types.is_floating(source) and pa.types.is_floating(declared):
+            target = declared
+        else:
+            continue
+        if target is not None and target.bit_width < source.bit_width:
+            types[column] = target
+    return types
+
+class _ReadPlan:
+    """一次读取要读的列和行组、行过滤表达式、降精度类型"""
+
+    def __init__(self, parquet_file, columns, filters, row_groups, downcast, counters=None):
+        self.counters = counters
+        metadata = parquet_file.metadata
+        leaves = _leaf_columns(metadata)
+        self.columns = _columns(parquet_file, columns)
+        filters = list(filters or [])
+        self.read_columns = self.columns + [c for c, _, _ in filters if c not in self.columns]
+        candidates = range(metadata.num_row_groups) if row_groups is None else list(row_groups)
+        self.row_groups = [g for g in candidates
+                           if all(_may_match(_statistics(metadata, leaves, g, c), op, v) for c, op, v in filters)]
+        self.expression = filter_expression(filters) if filters else None
+        if downcast is True:
+            self.types = downcast_types(parquet_file, self.columns, leaves)
+        else:
+            self.types = downcast_types(parquet_file, [c for c in self.columns if c in (downcast or ())], leaves)
+
+        def size(groups, names):
+            indexes = [j for name in names for j in leaves.get(name, ())]
+            return sum(metadata.row_group(g).column(j).total_compressed_size for g in groups for j in indexes)
+
+        _count(counters, 'read.bytes_total', size(candidates, leaves))
+        _count(counters, 'read.bytes_read', size(self.row_groups, self.read_columns) if self.read_columns else 0)
+        _count(counters, 'read.row_groups_skipped', len(candidates) - len(self.row_groups))
+
+    def finish(self, table):
+        """行过滤、去掉只用于过滤的列、降精度"""
+        _count(self.counters, 'read.rows', table.num_rows)
+        if self.expression is not None:
+            rows = table.num_rows
+            table = table.filter(self.expression)
+            _count(self.counters, 'read.rows_filtered', rows - table.num_rows)
+        table = table.select(self.columns)
+        if self.types:
+            before = table.nbytes
+            table = table.cast(pa.schema([pa.field(f.name, self.types.get(f.name, f.type), f.nullable)
+                                          for f in table.schema]))
+            _count(self.counters, 'read.memory_before', before)
+            _count(self.counters, 'read.memory_after', table.nbytes)
+        return table
+
+def read_arrow(path, columns=None, filters=None, row_groups=None, downcast=True, counters=None):
+    """
+    读取一个原始数据文件
+    参数:
+        columns (list): 需要的列（文件中没有的列跳过），缺省为全部列
+        filters (list): [(列, 运算符, 值), ...]，先按行组统计信息跳过行组，再逐行过滤
+        row_groups (list): 只读取这些行组
+        downcast (bool|list): 数值列降精度（见 SCHEMA）；为列名列表时只对这些列降精度
+        counters (Counter): 本次读取的 read.* 计数同时累加到这里（全局 METRICS 照常计入）
+    返回:
+        pa.Table
+    """
+    parquet_file = pq.ParquetFile(path)
+    plan = _ReadPlan(parquet_file, columns, filters, row_groups, downcast, counters)
+    if not plan.columns:
+        return pa.table({})
+    return plan.finish(parquet_file.read_row_groups(plan.row_groups, columns=plan.read_columns))
+
+def iter_arrow(path, columns=None, filters=None, row_groups=None, batch_size=100_000, downcast=True,
+               counters=None):
+    """按记录批次读取（参数同 read_arrow），每批为一个 pa.Table"""
+    parquet_file = pq.ParquetFile(path)
+    plan = _ReadPlan(parquet_file, columns, filters, row_groups, downcast, counters)
+    if not plan.columns or not plan.row_groups:
+        return
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=plan.row_groups,
+                                           columns=plan.read_columns):
+        yield plan.finish(pa.Table.from_batches([batch]))
+
+def keep_nested(arrow_type):
+    """to_pandas 的 types_mapper：嵌套列（压缩后的历史字段）保留为 ArrowDtype，不展开成逐行 Python 对象"""
+    if pa.types.is_struct(arrow_type) or pa.types.is_list(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+    return None
+
+def types_mapper(arrow_type):
+    """to_pandas 的 types_mapper：字符串、时间戳和嵌套列保留 Arrow 存储"""
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return STRING_DTYPE
+    if pa.types.is_timestamp(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+    return keep_nested(arrow_type)
+
+def parse_date_column(values, counters=None):
+    """
+    解析时间列为 UTC 时间戳：先按 ISO8601 整列解析，失败的值再逐个用 dateutil 解析（format='mixed'）
+    两次都无法解析的值为空并计入 read.unparsed_dates
+    """
+    if isinstance(values.dtype, pd.ArrowDtype) and pa.types.is_timestamp(values.dtype.pyarrow_dtype):
+        return pd.to_datetime(values, utc=True)
+    parsed = pd.to_datetime(values, format='ISO8601', utc=True, errors='coerce')
+    failed = parsed.isna() & values.notna()
+    if failed.any():
+        parsed[failed] = pd.to_datetime(values[failed].astype(str), format='mixed', utc=True, errors='coerce')
+        _count(counters, 'read.unparsed_dates', int((parsed.isna() & values.notna()).sum()))
+    return parsed
+
+def to_pandas(table, parse_dates=(), counters=None):
+    """
+    转为 DataFrame
+    参数:
+        parse_dates (list): 解析为 UTC 时间戳（ArrowDtype）的字符串列（见 parse_date_column）
+    """
+    df = table.to_pandas(types_mapper=types_mapper)
+    for column in parse_dates:
+        if column in df.columns and not isinstance(df[column].dtype, pd.ArrowDtype):
+            df[column] = parse_date_column(df[column], counters).astype(pd.ArrowDtype(SCHEMA[column]))
+    return df
+
+def read(path, columns=None, filters=None, row_groups=None, downcast=True, parse_dates=(), counters=None):
+    """读取一个原始数据文件为 DataFrame（参数见 read_arrow 和 to_pandas）"""
+    return to_pandas(read_arrow(path, columns, filters, row_groups, downcast, counters), parse_dates, counters)
+
+def iter_batches(path, columns=None, filters=None, row_groups=None, batch_size=100_000, downcast=True,
+                 parse_dates=(), counters=None):
+    """按记录批次读取为 DataFrame"""
+    for table in iter_arrow(path, columns, filters, row_groups, batch_size, downcast, counters):
+        yield to_pandas(table, parse_dates, counters)
+
+def timed_batches(batches, stage='read'):
+    """逐批把 Arrow 记录批次转为 DataFrame，读取与解码耗时计入 stage，行数计入 rows"""
+    batches = iter(batches)
+    while True:
+        with METRICS.timer(stage):
+            batch = next(batches, None)
+            df = None if batch is None else batch.to_pandas(types_mapper=keep_nested)
+        if df is None:
+            return
+        METRICS.incr('rows', len(df))
+        yield df
+
+def prefetch(items, depth=PREFETCH_DEPTH):
+    """
+    在后台线程中提前迭代 items（读取、解码），与调用方对上一项的处理重叠
+    队列中最多缓存 depth 项，同时存在的项不超过 depth + 2 个（队列中、正在读取、正在处理）；
+    depth <= 0 时不预读。后台读取耗时计入 METRICS 计时器 prefetch.read，调用方等待耗时计入
+    prefetch.wait，二者之差即被处理时间掩盖的 I/O 时间
+    """
+    if depth <= 0:
+        yield from items
+        return
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(entry):
+        # 调用方提前结束迭代时不再阻塞在满的队列上
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        iterator = iter(items)
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                put(('done', None, time.perf_counter() - start))
+                return
+            except Exception as e:
+                put(('error', e, time.perf_counter() - start))
+                return
+            put(('item', item, time.perf_counter() - start))
+
+    # 后台读取的 read.* 计数记入开始迭代时所在的文件
+    thread = threading.Thread(target=METRICS.bind(produce), name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            kind, value, seconds = buffer.get()
+            METRICS.add_time('prefetch.wait', time.perf_counter() - start)
+            METRICS.add_time('prefetch.read', seconds)
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+def describe_read(counters):
+    """把 read.* 计数器整理成一行摘要（没有读取记录时返回空字符串）"""
+    total = counters.get('read.bytes_total', 0)
+    if not total:
+        return ''
+    read_bytes = counters.get('read.bytes_read', 0)
+    text = f"读取 {read_bytes / 2**20:.1f}MB / 文件共 {total / 2**20:.1f}MB（节省 {1 - read_bytes / total:.0%}）"
+    if counters.get('read.row_groups_skipped'):
+        text += f" | 跳过 {counters['read.row_groups_skipped']} 个行组"
+    if counters.get('read.rows_filtered'):
+        text += f" | 过滤 {counters['read.rows_filtered']} 行"
+    if counters.get('read.memory_before'):
+        saved = counters['read.memory_before'] - counters.get('read.memory_after', 0)
+        text += f" | 降精度节省内存 {saved / 2**20:.1f}MB"
+    return text
+
+def describe_prefetch(timers):
+    """预读掩盖的 I/O 时间摘要（没有预读时返回空字符串）"""
+    read_seconds = timers.get('prefetch.read', 0.0)
+    if not read_seconds:
+        return ''
+    wait = timers.get('prefetch.wait', 0.0)
+    hidden = max(0.0, read_seconds - wait)
+    return (f"后台读取 {read_seconds:.2f}秒，等待 {wait:.2f}秒，"
+            f"掩盖 I/O {hidden:.2f}秒（{hidden / read_seconds:.0%}）")
+
+def report_read_stats(counters=None, timers=None):
+    """打印本次运行读取原始数据的节省情况及预读掩盖的 I/O 时间"""
+    text = describe_read(METRICS.counters if counters is None else counters)
+    if text:
+        print(f"数据读取: {text}")
+    text = describe_prefetch(METRICS.timers if timers is None else timers)
+    if text:
+        print(f"预读: {text}")
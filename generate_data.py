@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# 合成数据生成：与原始数据集相同的列，固定随机种子，可配置规模和脏数据比例，
+# 用于在没有真实数据目录时做性能测试和功能验证
+
+# 各类脏数据的默认比例（按行）
+DIRTY_RATES = {
+    'null_id': 0.001,
+    'null_email': 0.005,
+    'invalid_email': 0.01,
+    'age_out_of_range': 0.005,
+    'invalid_gender': 0.01,
+    'income_outlier': 0.001,
+    'register_after_login': 0.01,
+    'invalid_date': 0.002,
+    'invalid_json': 0.005,
+    'quasi_json': 0.01,
+    'null_history': 0.01,
+}
+COUNTRIES = ['中国', '美国', '日本', '德国', '英国', '法国', '巴西', '印度']
+CITIES = ['北京市朝阳区', '上海市浦东新区', '广州市天河区', '深圳市南山区', '杭州市西湖区',
+          '成都市武侯区', '苏州工业园区', '大理州', '某某县城关镇', '未知地址']
+CATEGORIES = ['电子产品', '服装', '食品', '家居', '图书', '运动户外', '美妆']
+PAYMENT_METHODS = ['支付宝', '微信支付', '信用卡', '银行转账', '现金']
+PAYMENT_STATUS = ['已支付', '已支付', '已支付', '部分退款', '已退款']
+DEVICES = ['mobile', 'desktop', 'tablet']
+DATE_RANGE = (np.datetime64('2015-01-01T00:00:00'), np.datetime64('2025-01-01T00:00:00'))
+SCHEMA = pa.schema([
+    ('id', pa.int64()), ('email', pa.string()), ('age', pa.int64()), ('income', pa.float64()),
+    ('gender', pa.string()), ('country', pa.string()), ('address', pa.string()), ('is_active', pa.bool_()),
+    ('last_login', pa.string()), ('registration_date', pa.string()),
+    ('purchase_history', pa.string()), ('login_history', pa.string()),
+])
+
+def _dates(rng, n, start=DATE_RANGE[0], end=DATE_RANGE[1]):
+    """[start, end) 内均匀分布的随机时间（秒精度）"""
+    span = int((end - start) / np.timedelta64(1, 's'))
+    return start + rng.integers(0, span, n).astype('timedelta64[s]')
+
+def _iso(dates):
+    return np.datetime_as_string(dates, unit='s')
+
+def _hit(rng, n, rates, rule):
+    """按脏数据比例抽取命中的行"""
+    return rng.random(n) < rates.get(rule, 0)
+
+def _quasi_json(text):
+    """改写为类 JSON 字符串：Python 字面量格式（单引号、None），需要 safe_json_parse 的容错解析"""
+    return repr({**json.loads(text), "note": None})
+
+def generate_chunk(rng, start_id, n, rates=DIRTY_RATES, max_logins=20):
+    """
+    生成一批用户数据
+    参数:
+        rng (Generator): numpy 随机数生成器
+        start_id (int): 本批第一个用户 id
+        n (int): 行数
+        rates (dict): 各类脏数据比例
+        max_logins (int): 每个用户最多的登录记录数
+    返回:
+        Table: 与原始数据集相同列的 Arrow 表
+    """
+    ids = np.arange(start_id, start_id + n, dtype=np.int64)
+
+    emails = np.array([f"user{i}@example.com" for i in ids.tolist()], dtype=object)
+    emails[_hit(rng, n, rates, 'invalid_email')] = 'invalid-email'
+    emails[_hit(rng, n, rates, 'null_email')] = None
+
+    age = rng.integers(16, 80, n)
+    bad_age = _hit(rng, n, rates, 'age_out_of_range')
+    age[bad_age] = rng.choice([-5, 150], int(bad_age.sum()))
+
+    income = np.round(rng.lognormal(10.8, 0.6, n), 2)
+    income[_hit(rng, n, rates, 'income_outlier')] *= 100
+
+    gender = rng.choice(np.array(['男', '女'], dtype=object), n)
+    bad_gender = _hit(rng, n, rates, 'invalid_gender')
+    gender[bad_gender] = rng.choice(np.array(['其他', '未知', 'M'], dtype=object), int(bad_gender.sum()))
+
+    registration = _dates(rng, n)
+    last_login = registration + rng.integers(0, 3 * 365 * 86400, n).astype('timedelta64[s]')
+    after = _hit(rng, n, rates, 'register_after_login')
+    last_login[after] = registration[after] - rng.integers(86400, 365 * 86400, int(after.sum())).astype('timedelta64[s]')
+    last_login_str = _iso(last_login).astype(object)
+    last_login_str[_hit(rng, n, rates, 'invalid_date')] = 'notadate'
+
+    # 购买历史（JSON字符串）
+    prices = np.round(rng.uniform(10, 5000, n), 2)
+    item_counts = rng.integers(0, 10, n)
+    categories = rng.choice(CATEGORIES, (n, 2))
+    methods = rng.choice(PAYMENT_METHODS, n)
+    status = rng.choice(PAYMENT_STATUS, n)
+    purchase = np.array([
+        json.dumps({"avg_price": float(p), "categories": f"{c[0]},{c[1]}",
+                    "items": [{"id": j} for j in range(k)], "payment_method": m, "payment_status": s},
+                   ensure_ascii=False)
+        for p, k, c, m, s in zip(prices.tolist(), item_counts.tolist(), categories.tolist(),
+                                 methods.tolist(), status.tolist())
+    ], dtype=object)
+
+    # 登录历史：所有时间戳一次生成，再按每人的个数切分
+    login_counts = rng.integers(0, max_logins + 1, n)
+    stamps = _iso(_dates(rng, int(login_counts.sum()))).tolist()
+    offsets = np.concatenate([[0], np.cumsum(login_counts)]).tolist()
+    device_counts = rng.integers(1, len(DEVICES) + 1, n).tolist()
+    durations = np.round(rng.uniform(1, 120, n), 1).tolist()
+    login = np.array([
+        json.dumps({"timestamps": stamps[offsets[i]:offsets[i + 1]], "devices": DEVICES[:device_counts[i]],
+                    "avg_session_duration": durations[i]})
+        for i in range(n)
+    ], dtype=object)
+
+    for column in (purchase, login):
+        quasi = _hit(rng, n, rates, 'quasi_json')
+        column[quasi] = [_quasi_json(text) for text in column[quasi]]
+        column[_hit(rng, n, rates, 'invalid_json')] = '{invalid json'
+        column[_hit(rng, n, rates, 'null_history')] = None
+
+    return pa.table({
+        'id': pa.array(ids, mask=_hit(rng, n, rates, 'null_id')),
+        'email': emails,
+        'age': age,
+        'income': income,
+        'gender': gender,
+        'country': rng.choice(COUNTRIES, n),
+        'address': rng.choice(CITIES, n),
+        'is_active': rng.random(n) < 0.6,
+        'last_login': last_login_str,
+        'registration_date': _iso(registration),
+        'purchase_history': purchase,
+        'login_history': login,
+    }, schema=SCHEMA)
+
+def generate_file(path, rows, seed=0, start_id=0, rates=DIRTY_RATES, max_logins=20, row_group_size=100_000):
+    """按行组分批生成并写出一个 parquet 文件，内存只与行组大小相关"""
+    rng = np.random.default_rng(seed)
+    with pq.ParquetWriter(path, SCHEMA) as writer:
+        for offset in range(0, rows, row_group_size):
+            n = min(row_group_size, rows - offset)
+            writer.write_table(generate_chunk(rng, start_id + offset, n, rates, max_logins))
+    return path
+
+def generate_dataset(output_dir, files=1, rows_per_file=10_000, seed=0, rates=DIRTY_RATES,
+                     max_logins=20, row_group_size=100_000):
+    """
+    生成多个 parquet 文件（文件间 id 不重复）
+    返回:
+        list: 生成的文件路径
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for k in range(files):
+        path = os.path.join(output_dir, f"part-{k:05d}.parquet")
+        generate_file(path, rows_per_file, seed + k, k * rows_per_file, rates, max_logins, row_group_size)
+        paths.append(path)
+    return paths
+
+def parse_rates(specs, scale=1.0):
+    """解析 rule=rate 形式的脏数据比例设置，其余规则按 scale 缩放默认比例"""
+    rates = {rule: rate * scale for rule, rate in DIRTY_RATES.items()}
+    for spec in specs or []:
+        rule, _, rate = spec.partition('=')
+        if rule not in DIRTY_RATES:
+            raise ValueError(f"未知的脏数据类型: {rule}（可选: {', '.join(DIRTY_RATES)}）")
+        rates[rule] = float(rate)
+    return rates
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="生成与原始数据集结构相同的合成用户数据")
+    arg_parser.add_argument('output_dir', help="输出目录")
+    arg_parser.add_argument('--files', type=int, default=1, help="文件数")
+    arg_parser.add_argument('--rows', type=int, default=10_000, help="每个文件的行数")
+    arg_parser.add_argument('--seed', type=int, default=0, help="随机种子")
+    arg_parser.add_argument('--row-group-size', type=int, default=100_000, help="parquet 行组大小")
+    arg_parser.add_argument('--max-logins', type=int, default=20, help="每个用户最多的登录记录数")
+    arg_parser.add_argument('--dirty-scale', type=float, default=1.0, help="所有脏数据比例的缩放系数（0为全部干净）")
+    arg_parser.add_argument('--dirty', action='append', metavar='RULE=RATE', help="单独设置某类脏数据比例，可重复")
+    args = arg_parser.parse_args()
+
+    start = time.time()
+    paths = generate_dataset(args.output_dir, args.files, args.rows, args.seed,
+                             parse_rates(args.dirty, args.dirty_scale), args.max_logins, args.row_group_size)
+    print(f"已生成 {len(paths)} 个文件，共 {args.files * args.rows} 行 | 耗时 {time.time()-start:.1f}秒")
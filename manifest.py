@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows 上不加锁
+    fcntl = None
+
+# 处理清单：记录每个输入文件的指纹（路径、大小、修改时间、内容哈希）及各阶段的产出，
+# 重跑时跳过未变化的文件，中途崩溃后从已完成的文件之后继续
+DEFAULT_MANIFEST = 'processing_manifest.json'
+
+def file_hash(path, chunk_size=1 << 20):
+    """分块计算文件内容哈希"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_fingerprint(path, known=None):
+    """
+    计算文件指纹
+    参数:
+        known (dict): 已记录的指纹；大小和修改时间都未变时沿用其哈希，避免重复读取大文件
+    返回:
+        dict: size, mtime, hash
+    """
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if known and known.get("hash") and known.get("size") == stat.st_size and known.get("mtime") == stat.st_mtime:
+        fingerprint["hash"] = known["hash"]
+    else:
+        fingerprint["hash"] = file_hash(path)
+    return fingerprint
+
+class Manifest:
+    """
+    处理清单（JSON文件），每完成一个文件立即落盘
+    读取-合并-保存在 <清单>.lock 文件锁内进行，多个脚本同时运行时不会丢失彼此的记录；
+    磁盘上的清单自上次读写后未被其他进程改过时不重新读取
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST):
+        self.path = path
+        self._stamp = None
+        self.files = self._load()
+        self._fingerprints = {}
+
+    def _disk_stamp(self):
+        """磁盘上清单文件的标识（每次保存都是替换为新文件，inode 随之变化）"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        self._stamp = self._disk_stamp()
+        if self._stamp is None:
+            return {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f).get("files", {})
+        except (OSError, ValueError):
+            print(f"警告: 处理清单 {self.path} 无法读取，将全部重新处理")
+            return {}
+
+    def _refresh(self):
+        """其他进程改过清单时重新读取"""
+        if self._disk_stamp() != self._stamp:
+            self.files = self._load()
+
+    @contextmanager
+    def _locked(self):
+        """独占清单的文件锁"""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _save(self):
+        # 先写临时文件再替换，避免写到一半崩溃损坏清单
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"files": self.files}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+        self._stamp = self._disk_stamp()
+
+    def fingerprint(self, file_path):
+        """本次运行内缓存的文件指纹"""
+        key = os.path.abspath(file_path)
+        if key not in self._fingerprints:
+            self._fingerprints[key] = file_fingerprint(file_path, self.files.get(key))
+        return self._fingerprints[key]
+
+    def is_current(self, file_path, stage, params=None, outputs=None):
+        """
+        文件内容未变、该阶段已用相同参数完成且产出仍在时返回 True
+        参数:
+            outputs (list): 本次期望的产出路径；与记录不同（如换了输出目录）时视为未完成
+        """
+        entry = self.files.get(os.path.abspath(file_path))
+        if not entry or stage not in entry.get("stages", {}):
+            return False
+        fingerprint = self.fingerprint(file_path)
+        if fingerprint["hash"] != entry.get("hash"):
+            return False
+        record = entry["stages"][stage]
+        if record.get("params") != params:
+            return False
+        if outputs is not None and record.get("outputs") != [os.path.abspath(p) for p in outputs]:
+            return False
+        if not all(os.path.exists(p) for p in record.get("outputs", [])):
+            return False
+        if fingerprint["mtime"] != entry.get("mtime"):
+            # 仅修改时间变化（内容相同），更新记录以免下次重新计算哈希
+            with self._locked():
+                self._refresh()
+                entry = self.files.get(os.path.abspath(file_path))
+                if entry and entry.get("hash") == fingerprint["hash"]:
+                    entry.update(fingerprint)
+                    self._save()
+        return True
+
+    def result(self, file_path, stage):
+        """该文件该阶段记录的结果摘要"""
+        entry = self.files.get(os.path.abspath(file_path), {})
+        return entry.get("stages", {}).get(stage, {}).get("result")
+
+    def record(self, file_path, stage, outputs=(), result=None, params=None):
+        """记录文件某阶段完成；在文件锁内与磁盘上的清单合并后保存，其他脚本的阶段记录不会丢失"""
+        key = os.path.abspath(file_path)
+        fingerprint = self.fingerprint(file_path)
+        with self._locked():
+            self._refresh()
+            entry = self.files.get(key, {})
+            if entry.get("hash") != fingerprint["hash"]:
+                entry = {"stages": {}}  # 内容变化后旧阶段记录全部失效
+            entry.update({"path": key, **fingerprint})
+            entry.setdefault("stages", {})[stage] = {
+                "outputs": [os.path.abspath(p) for p in outputs],
+                "result": result,
+                "params": params,
+                "finished_at": time.time(),
+            }
+            self.files[key] = entry
+            self._save()
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import threading
+import cProfile
+import pstats
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# 运行指标：按文件、按阶段收集计数器（行数、各类解析失败、慢路径回退）和计时器
+# （读取、解析、画像、写出、渲染），代替逐条 print，最后输出为 JSON
+MAX_ERROR_SAMPLES = 5
+
+class Metrics:
+    """
+    计数器与计时器；file() 范围内的记录同时计入该文件，可合并其他进程的结果
+    文件范围按线程区分：后台线程（预读、渲染）用 bind 包装后，记录计入创建任务时所在的文件
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = Counter()
+        self.timers = defaultdict(float)
+        self.error_samples = defaultdict(list)
+        self.files = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _file(self):
+        """当前线程所在的文件范围"""
+        return getattr(self._local, 'entry', None)
+
+    @_file.setter
+    def _file(self, entry):
+        self._local.entry = entry
+
+    def bind(self, fn):
+        """把 fn 绑定到调用方当前的文件范围：在其他线程中执行时，计数和计时仍记入该文件"""
+        entry = self._file
+
+        def bound(*args, **kwargs):
+            previous, self._file = self._file, entry
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._file = previous
+        return bound
+
+    def incr(self, name, n=1):
+        """计数器加 n"""
+        if not n:
+            return
+        with self._lock:
+            self.counters[name] += n
+            if self._file is not None:
+                self._file["counters"][name] += n
+
+    def error(self, kind, error, context=None):
+        """记录一次失败：按类型计数，每类只保留前几条示例"""
+        self.incr(f"errors.{kind}")
+        with self._lock:
+            samples = self.error_samples[kind]
+            if len(samples) < MAX_ERROR_SAMPLES:
+                samples.append(f"{context}: {error}" if context is not None else str(error))
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.timers[stage] += seconds
+            if self._file is not None:
+                self._file["timers"][stage] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        """累计代码块耗时到某阶段"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def file(self, name):
+        """该范围内（当前线程，及用 bind 包装的后台任务）的计数和计时同时记入文件 name"""
+        entry = {"seconds": 0.0, "counters": Counter(), "timers": defaultdict(float)}
+        previous, self._file = self._file, entry
+        self.files[name] = entry  # 范围结束后才完成的后台任务仍可计入
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            self._file = previous
+            entry["seconds"] = time.perf_counter() - start
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": dict(self.timers),
+                "error_samples": dict(self.error_samples),
+                "files": {name: {"seconds": entry["seconds"], "counters": dict(entry["counters"]),
+                                 "timers": dict(entry["timers"])} for name, entry in self.files.items()},
+            }
+
+    def pop(self):
+        """取出当前结果并清空（工作进程每个任务结束时返回给主进程）"""
+        data = self.to_dict()
+        self.reset()
+        return data
+
+    def merge(self, data):
+        """合并 to_dict 格式的结果"""
+        self.counters.update(data["counters"])
+        for stage, seconds in data["timers"].items():
+            self.timers[stage] += seconds
+        for kind, samples in data["error_samples"].items():
+            self.error_samples[kind] = (self.error_samples[kind] + samples)[:MAX_ERROR_SAMPLES]
+        self.files.update(data["files"])
+        return self
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"generated_at": time.strftime('%Y-%m-%dT%H:%M:%S'), **self.to_dict()},
+                      f, ensure_ascii=False, indent=1)
+
+    def report(self):
+        """打印各阶段耗时和失败计数摘要"""
+        if self.timers:
+            print("各阶段耗时: " + " | ".join(f"{k} {v:.2f}s" for k, v in sorted(self.timers.items())))
+        errors = {k[len("errors."):]: v for k, v in self.counters.items() if k.startswith("errors.")}
+        for kind, count in sorted(errors.items()):
+            samples = self.error_samples.get(kind)
+            print(f"- {kind} 失败 {count} 次" + (f"（示例: {samples[0]}）" if samples else ""))
+
+METRICS = Metrics()
+
+def start_profiler(path, tool='cprofile'):
+    """
+    开启性能剖析（path 为空时不剖析）
+    参数:
+        tool (str): 'cprofile' 或 'pyinstrument'（未安装时回退到 cProfile）
+    返回:
+        剖析器对象，交给 stop_profiler
+    """
+    if not path:
+        return None
+    if tool == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("警告: 未安装 pyinstrument，改用 cProfile")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return path, profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return path, profiler
+
+def stop_profiler(handle):
+    """结束剖析并写出结果：cProfile 写 .prof（可用 snakeviz 查看）并打印前20个热点，pyinstrument 写 HTML"""
+    if handle is None:
+        return
+    path, profiler = handle
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    else:
+        profiler.stop()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+    print(f"性能剖析结果已保存至: {os.path.abspath(path)}")
@@ -0,0 +1,376 @@
+import os
+import time
+from datetime import datetime, timezone
+import argparse
+from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import analysis
+import check
+import dataset
+import show
+from manifest import Manifest, DEFAULT_MANIFEST
+from metrics import METRICS, start_profiler, stop_profiler
+from streaming_stats import RunningStats
+
+# 单次扫描流水线：每个文件只读取、解码一次，按批交给各阶段（异常检测、分布统计、画像构建）处理，
+# 各阶段仍写出与单独运行 check.py / show.py / analysis.py 时相同的结果
+
+class Stage(ABC):
+    """
+    流水线阶段：声明需要的列，逐批处理，每个文件结束时写出自己的结果（子类必须实现 process）
+    downcast 为单独运行对应脚本时读取降精度的列，交给 process 的数据类型与单独运行时一致，
+    两种方式写出的缓存结果可以互相沿用
+    """
+    name = None
+    columns = []
+    downcast = []
+
+    def params(self):
+        """影响产出的参数（用于处理清单）"""
+        return None
+
+    def outputs(self, file_path):
+        """该文件本次期望的产出路径（None 表示不检查）"""
+        return None
+
+    def is_current(self, manifest, file_path):
+        return manifest.is_current(file_path, self.name, self.params(), self.outputs(file_path))
+
+    def start_file(self, file_path):
+        pass
+
+    @abstractmethod
+    def process(self, df):
+        """处理一批数据"""
+
+    def finish_file(self, file_path, manifest):
+        pass
+
+    def abort_file(self, file_path):
+        pass
+
+    def skip_file(self, file_path):
+        """文件未变化、沿用缓存结果时调用"""
+        pass
+
+    def close(self):
+        """所有文件处理完后写出汇总结果"""
+        pass
+
+class CheckStage(Stage):
+    """异常检测（check.py）"""
+    name = 'check'
+    columns = check.CHECK_COLUMNS
+    downcast = check.CHECK_COLUMNS
+
+    def __init__(self, schema, threshold=None, text_report=False):
+        self.schema = schema
+        self.threshold = threshold
+        self.text_report = text_report
+        self.files = []
+
+    def params(self):
+        return {"income_threshold": self.threshold}
+
+    def outputs(self, file_path):
+        return list(check.check_partial_paths(os.path.basename(file_path)))
+
+    def start_file(self, file_path):
+        self._ids, self._incomes, self._masks = [], [], []
+        self._stats = RunningStats()
+
+    def process(self, df):
+        # 未指定全局阈值时，收入规则需要整个文件的均值/标准差，先跳过，文件结束时补上
+        threshold = np.inf if self.threshold is None else self.threshold
+        self._masks.append(check.detect_anomalies(df, threshold).to_numpy())
+        self._ids.append(df['id'])
+        if self.threshold is None:
+            income = pd.to_numeric(df['income'], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+            self._incomes.append(income)
+            self._stats.update(income)
+
+    def finish_file(self, file_path, manifest):
+        mask = np.concatenate(self._masks) if self._masks else np.zeros(0, dtype=np.uint8)
+        ids = pd.concat(self._ids, ignore_index=True) if self._ids else pd.Series(dtype='int64')
+        if self.threshold is None and self._incomes:
+            file_threshold = self._stats.mean + 3 * self._stats.std()
+            over = np.concatenate(self._incomes) > file_threshold
+            mask |= np.where(over, check.ANOMALY_RULES['income_over_3sigma'], 0).astype(np.uint8)
+        mask = pd.Series(mask, name='mask')
+        file = os.path.basename(file_path)
+        table = check.anomaly_table(file, pd.DataFrame({'id': ids}), mask, self.schema)
+        check.save_check_partial(file_path, table, check.count_rules(mask), manifest, self.params())
+        self.files.append(file)
+
+    def skip_file(self, file_path):
+        self.files.append(os.path.basename(file_path))
+
+    def close(self):
+        if self.files:
+            check.write_check_outputs(self.files, self.schema, self.text_report)
+
+class ShowStage(Stage):
+    """分布统计与图表（show.py）"""
+    name = 'show'
+    columns = show.NEEDED_COLUMNS
+    downcast = show.NEEDED_COLUMNS
+
+    def __init__(self, results_dir=None, visualize=True):
+        self.partials = []
+        self.results_dir = results_dir
+        self.visualize = visualize
+        self._used_dir = None
+        self._cached = None
+
+    def params(self):
+        return show.PARTIAL_PARAMS
+
+    def outputs(self, file_path):
+        return [self._partial_path(file_path)]
+
+    def is_current(self, manifest, file_path):
+        # 缓存的计数损坏或不完整时视为未完成，重新计算
+        self._cached = super().is_current(manifest, file_path) and show.load_partial(self._partial_path(file_path))
+        return bool(self._cached)
+
+    def _partial_path(self, file_path):
+        path = show.partial_path_for(file_path, self.results_dir)
+        self._used_dir = os.path.dirname(os.path.dirname(path))
+        return path
+
+    def start_file(self, file_path):
+        self._dist = show.UserDistribution()
+        os.makedirs(os.path.dirname(self._partial_path(file_path)), exist_ok=True)
+
+    def process(self, df):
+        self._dist.update(df[[c for c in self.columns if c in df.columns]])
+
+    def finish_file(self, file_path, manifest):
+        partial_path = self._partial_path(file_path)
+        show.save_partial(self._dist, partial_path)
+        manifest.record(file_path, self.name, [partial_path], params=self.params())
+        self.partials.append(self._dist)
+
+    def skip_file(self, file_path):
+        self.partials.append(self._cached)
+
+    def close(self):
+        if self._used_dir is None:
+            return
+        total = show.reduce_partials(self.partials)
+        if self.visualize:
+            show.draw_charts(total, self._used_dir)
+        else:
+            show.save_distribution(total, self._used_dir)
+
+class ProfileStage(Stage):
+    """用户画像构建（analysis.py）"""
+    name = 'profile'
+    columns = analysis.PROFILE_INPUT_COLUMNS
+    downcast = analysis.PROFILE_DOWNCAST_COLUMNS
+
+    def __init__(self, output_format='parquet', keep_raw=False, viz_users=5, dashboard=False, as_of=None,
+                 rfm_bins='fixed'):
+        self.options = {"output_format": output_format, "keep_raw": keep_raw}
+        self.viz_users = viz_users
+        self.dashboard = dashboard
+        self.as_of = as_of
+        self.rfm_bins = rfm_bins
+        self.profile_paths = []
+        # 处理清单中记录的参数（as_of、rfm_bins 不传给 ProfileWriter）
+        self._params_options = {**self.options, "as_of": as_of, "rfm_bins": rfm_bins}
+
+    def params(self):
+        return analysis.profile_params(self._params_options)
+
+    def outputs(self, file_path):
+        return [analysis.profiles_path(file_path, None, self.options["output_format"])]
+
+    def start_file(self, file_path):
+        self._writer = analysis.ProfileWriter(file_path, None, **self.options)
+        self._now = self.as_of or datetime.now(timezone.utc)
+        self._queue = None
+        if self.viz_users > 0:
+            dashboard = analysis.dashboard_path(file_path) if self.dashboard else None
+            self._queue = analysis.VisualizationQueue(dashboard=dashboard)
+
+    def process(self, df):
+        parsed = analysis.parse_histories_batch(df)
+        table = analysis.build_profiles_batch(df, now=self._now, parsed=parsed)
+        if self._queue and self._queue.submitted < self.viz_users:
+            self._queue.submit_table(table, parsed, self.viz_users - self._queue.submitted)
+        self._writer.write(table)
+
+    def _close_file(self):
+        if self._queue:
+            self._queue.close()
+        self._writer.close()
+
+    def finish_file(self, file_path, manifest):
+        self._close_file()
+        analysis.record_profile(manifest, file_path, self._writer.count, self._params_options)
+        self.profile_paths.append(self._writer.path)
+
+    def abort_file(self, file_path):
+        self._close_file()
+
+    def skip_file(self, file_path):
+        self.profile_paths.append(self.outputs(file_path)[0])
+
+    def close(self):
+        if self.rfm_bins == 'quantile' and self.profile_paths:
+            analysis.apply_quantile_rfm(self.profile_paths)
+        if self.profile_paths:
+            analysis.update_index(analysis.output_dir, self.profile_paths)
+
+def run_pipeline(file_paths, stages, manifest, batch_size=100_000, prefetch=dataset.PREFETCH_DEPTH):
+    """
+    逐文件单次扫描：只读取尚未完成的阶段所需列的并集，每批依次交给各阶段
+    各阶段处理当前批时后台线程读取下一批（prefetch 为预读批数，0 关闭）
+    读取解码耗时（预读时为等待时间）计入 METRICS 的 read，各阶段计算耗时计入以阶段名命名的计时器
+    """
+    for file_path in file_paths:
+        file = os.path.basename(file_path)
+        active = []
+        for stage in stages:
+            if stage.is_current(manifest, file_path):
+                stage.skip_file(file_path)
+            else:
+                active.append(stage)
+        if not active:
+            print(f"跳过未变化的文件: {file}")
+            continue
+
+        file_start = time.time()
+        started = []
+        with METRICS.file(file):
+            try:
+                # 各阶段共用一次读取，只对所有阶段都降精度的列降精度；
+                # 其余列按各阶段单独运行时的类型在交给该阶段前再转换（如异常检测的收入为 float32）
+                parquet_file = pq.ParquetFile(file_path)
+                wanted = {c for stage in active for c in stage.columns}
+                columns = [c for c in dataset.SCHEMA if c in wanted and c in parquet_file.schema_arrow.names]
+                shared = [c for c in columns if all(c in stage.downcast for stage in active)]
+                types = dataset.downcast_types(parquet_file, [c for c in columns if c not in shared
+                                                              and any(c in stage.downcast for stage in active)])
+                stage_types = {stage: {c: t.to_pandas_dtype() for c, t in types.items() if c in stage.downcast}
+                               for stage in active}
+                for stage in active:
+                    with METRICS.timer(stage.name):
+                        stage.start_file(file_path)
+                    started.append(stage)
+
+                batches = dataset.prefetch(dataset.iter_arrow(file_path, columns, batch_size=batch_size,
+                                                              downcast=shared), prefetch)
+                for df in dataset.timed_batches(batches):
+                    for stage in active:
+                        with METRICS.timer(stage.name):
+                            stage.process(df.astype(stage_types[stage]) if stage_types[stage] else df)
+
+                for stage in active:
+                    with METRICS.timer(stage.name):
+                        stage.finish_file(file_path, manifest)
+                print(f"✓ {file}: {', '.join(s.name for s in active)} | 耗时 {time.time()-file_start:.1f}s")
+            except Exception as e:
+                METRICS.error('file', e, file)
+                print(f"✗ 处理文件 {file} 时出错: {e}")
+                for stage in started:
+                    stage.abort_file(file_path)
+
+    for stage in stages:
+        with METRICS.timer(stage.name):
+            stage.close()
+
+def print_timings(timers, stages):
+    """分别输出 I/O 时间与各阶段计算时间（渲染在后台线程中进行，单独列出）"""
+    names = ['read'] + [stage.name for stage in stages]
+    total = sum(timers.get(name, 0.0) for name in names)
+    print("\n耗时统计:")
+    for name in names:
+        seconds = timers.get(name, 0.0)
+        label = "I/O(读取+解码)" if name == "read" else f"阶段 {name}"
+        print(f"- {label}: {seconds:.2f} 秒 ({seconds / max(total, 1e-9) * 100:.1f}%)")
+    if timers.get('render'):
+        print(f"- 后台渲染: {timers['render']:.2f} 秒")
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="单次扫描流水线：一次读取同时完成异常检测、分布统计和画像构建")
+    arg_parser.add_argument('input_path', nargs='?', help="Parquet 文件目录（同 --input-dir，保留兼容旧用法）")
+    arg_parser.add_argument('--input-dir', help="Parquet 文件目录")
+    arg_parser.add_argument('--stages', default='check,show,profile', help="要运行的阶段（逗号分隔）")
+    arg_parser.add_argument('--batch-size', type=int, default=100_000, help="每批读取的行数")
+    arg_parser.add_argument('--prefetch', type=int, default=dataset.PREFETCH_DEPTH,
+                            help="预读深度：处理当前批时后台提前读取的批数（0 关闭），内存约为 (预读深度+2) 批")
+    arg_parser.add_argument('--global-stats', action='store_true', help="异常检测使用全量数据集的3σ阈值")
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count(), help="全量收入统计的并行进程数")
+    arg_parser.add_argument('--text-report', action='store_true', help="异常检测额外输出文本摘要")
+    arg_parser.add_argument('--format', choices=['parquet', 'json'], default='parquet',
+                            help="画像输出格式（json 不含 7x24 登录矩阵，群体热力图只能用 parquet 画像）")
+    arg_parser.add_argument('--keep-raw', action='store_true', help="parquet 画像保留原始历史字符串列")
+    arg_parser.add_argument('--viz-users', type=int, default=5, help="每个文件生成可视化的用户数（0为不生成）")
+    arg_parser.add_argument('--dashboard', action='store_true', help="可视化合并为每个文件一个仪表盘页面")
+    arg_parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help="处理清单路径（增量/断点续跑）")
+    arg_parser.add_argument('--metrics', default='pipeline_metrics.json', help="运行指标 JSON 输出路径")
+    arg_parser.add_argument('--profile', metavar='PATH', help="开启性能剖析并把结果写入 PATH")
+    arg_parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile', help="剖析工具")
+    arg_parser.add_argument('--output-dir', help="输出根目录（缺省时各阶段沿用单独运行时的位置）")
+    arg_parser.add_argument('--no-viz', action='store_true', help="无界面模式：不绘图、不生成可视化，也不加载绘图库")
+    arg_parser.add_argument('--as-of', help="画像RFM参考时间，指定后结果可复现；缺省为各文件开始处理的时间")
+    arg_parser.add_argument('--rfm-bins', choices=['fixed', 'quantile'], default='fixed',
+                            help="RFM分档方式：固定阈值，或全量数据集的五分位点（仅 parquet 输出，需同时指定 --as-of）")
+    args = arg_parser.parse_args(argv)
+    try:
+        as_of = analysis.parse_as_of(args.as_of)
+    except ValueError as e:
+        arg_parser.error(str(e))
+    if args.rfm_bins == 'quantile' and args.format != 'parquet':
+        arg_parser.error("分位数RFM只支持 parquet 输出")
+    if args.rfm_bins == 'quantile' and as_of is None:
+        # 沿用缓存的画像按以前运行时的时间计算 recency，与新画像混在同一组分位点里会错档
+        arg_parser.error("分位数RFM需要用 --as-of 固定参考时间")
+
+    input_dir = args.input_dir or args.input_path
+    if not input_dir:
+        arg_parser.error("需要指定输入目录（--input-dir 或位置参数）")
+
+    file_paths = [os.path.join(input_dir, f) for f in sorted(os.listdir(input_dir))
+                  if f.endswith('.parquet')]
+    if not file_paths:
+        print("错误: 未找到Parquet文件")
+        raise SystemExit(1)
+    manifest = Manifest(args.manifest)
+    if args.output_dir:
+        check.set_output_dir(os.path.join(args.output_dir, 'check'))
+        analysis.set_output_dir(os.path.join(args.output_dir, 'user_profiles'))
+    os.makedirs(check.partial_dir, exist_ok=True)
+
+    stage_names = [name.strip() for name in args.stages.split(',') if name.strip()]
+    stages = []
+    if 'check' in stage_names:
+        threshold = None
+        if args.global_stats:
+            stats, _ = check.global_income_stats(file_paths, manifest, args.workers)
+            threshold = stats.mean + 3 * stats.std()
+            print(f"全量3σ收入阈值: {threshold:.2f}")
+        stages.append(CheckStage(check.mask_schema(check.id_type(file_paths)), threshold, args.text_report))
+    if 'show' in stage_names:
+        show_dir = os.path.join(args.output_dir, 'analysis_results') if args.output_dir else None
+        stages.append(ShowStage(show_dir, not args.no_viz))
+    if 'profile' in stage_names:
+        stages.append(ProfileStage(args.format, args.keep_raw, 0 if args.no_viz else args.viz_users, args.dashboard,
+                                   as_of, args.rfm_bins))
+
+    profiler = start_profiler(args.profile, args.profiler)
+    start = time.time()
+    run_pipeline(file_paths, stages, manifest, args.batch_size, args.prefetch)
+    print_timings(METRICS.timers, stages)
+    dataset.report_read_stats()
+    METRICS.report()
+    METRICS.save(args.metrics)
+    stop_profiler(profiler)
+    print(f"总耗时: {time.time()-start:.1f}秒")
+
+if __name__ == "__main__":
+    main()
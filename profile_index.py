@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# 画像点查索引：在画像输出目录旁维护按 user_id 排序的数组 (id, 文件编号, 偏移, 长度)，
+# 以内存映射方式打开并二分查找，单个用户的画像只需读取一个行组（parquet）或一段字节（json）
+# 每次画像生成后只重建新增或变化文件的条目，再与原有条目归并；不在本次画像文件集合中的文件
+# （已删除，或换了输出格式后的旧格式文件）的条目同时移除
+
+INDEX_FILE = 'profile_index.npy'
+META_FILE = 'profile_index.json'
+# parquet 条目的 offset 为文件内行号（length 为0）；json 条目为记录的字节偏移和字节长度
+INDEX_DTYPE = np.dtype([('id', '<i8'), ('file', '<i4'), ('offset', '<i8'), ('length', '<i8')])
+
+def _entries(file_no, ids, valid, offsets, lengths):
+    """组装一个文件的索引条目（valid 为假的空 id 跳过），按 id 排序"""
+    entries = np.empty(int(valid.sum()), dtype=INDEX_DTYPE)
+    entries['id'] = np.asarray(ids)[valid]
+    entries['file'] = file_no
+    entries['offset'] = np.asarray(offsets)[valid]
+    entries['length'] = np.asarray(lengths)[valid]
+    return entries[np.argsort(entries['id'], kind='stable')]
+
+def parquet_entries(path, file_no):
+    """
+    parquet 画像文件的索引条目（只读取 user_id 列）
+    返回:
+        (ndarray, dict): 条目与文件信息（行组起始行号，查找时据此定位行组）
+    """
+    parquet_file = pq.ParquetFile(path)
+    column = parquet_file.read(columns=['user_id']).column(0)
+    valid = column.is_valid().to_numpy(zero_copy_only=False)
+    # 空 id 不建条目；其余 id 无损转为整数，非整数 id（如 1.5）报错而不是截断后与别的用户混在一起
+    try:
+        ids = np.zeros(len(column), dtype=np.int64)
+        ids[valid] = column.drop_null().cast(pa.int64()).to_numpy()
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        raise ValueError(f"{path}: user_id 无法无损转换为整数（{e}）") from e
+    sizes = [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]
+    entries = _entries(file_no, ids, valid, np.arange(len(ids)), np.zeros(len(ids), dtype=np.int64))
+    return entries, {"format": "parquet", "row_group_starts": np.cumsum([0] + sizes[:-1]).tolist()}
+
+def json_entries(path, file_no):
+    """json 画像文件（记录数组）的索引条目：逐条 raw_decode 记下每条记录的字节范围"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    ids, valid, offsets, lengths = [], [], [], []
+    pos, char_pos, byte_pos = text.index('[') + 1, 0, 0
+    while True:
+        while pos < len(text) and text[pos] in ' \r\n\t,':
+            pos += 1
+        if pos >= len(text) or text[pos] == ']':
+            break
+        record, end = decoder.raw_decode(text, pos)
+        byte_pos += len(text[char_pos:pos].encode('utf-8'))
+        length = len(text[pos:end].encode('utf-8'))
+        user_id = record.get('user_id')
+        if user_id is not None and not (isinstance(user_id, int) or float(user_id).is_integer()):
+            raise ValueError(f"{path}: user_id 无法无损转换为整数（{user_id!r}）")
+        ids.append(-1 if user_id is None else int(user_id))
+        valid.append(user_id is not None)
+        offsets.append(byte_pos)
+        lengths.append(length)
+        byte_pos, char_pos, pos = byte_pos + length, end, end
+    return _entries(file_no, np.array(ids, dtype=np.int64), np.array(valid, dtype=bool), offsets, lengths), \
+        {"format": "json"}
+
+class ProfileIndex:
+    """只读的画像点查索引（条目数组以内存映射打开，不整体载入内存）"""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, META_FILE), encoding='utf-8') as f:
+            self.files = json.load(f)["files"]
+        self.entries = np.load(os.path.join(index_dir, INDEX_FILE), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def locate(self, user_id):
+        """
+        查找用户所在位置
+        返回:
+            list: (文件路径, 文件信息, offset, length)，同一 id 出现在多个文件时全部返回
+        """
+        ids = self.entries['id']
+        start, end = np.searchsorted(ids, user_id, 'left'), np.searchsorted(ids, user_id, 'right')
+        return [(os.path.join(self.index_dir, self.files[e['file']]['path']), self.files[e['file']],
+                 int(e['offset']), int(e['length'])) for e in self.entries[start:end]]
+
+    def get(self, user_id):
+        """返回该用户的画像（与 json 输出相同的嵌套记录），不存在时返回 None；跳过索引建立后被删除的文件"""
+        for path, info, offset, length in self.locate(user_id):
+            if os.path.exists(path):
+                return read_profile(path, info, offset, length)
+        return None
+
+def read_profile(path, info, offset, length):
+    """按索引条目读取一条画像记录"""
+    if info["format"] == "json":
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+    import analysis  # 画像表还原为嵌套记录；索引模块本身不依赖 analysis
+    starts = info["row_group_starts"]
+    group = int(np.searchsorted(starts, offset, 'right')) - 1
+    parquet_file = pq.ParquetFile(path)
+    # 登录矩阵列占行组读取的大部分时间，嵌套记录中也不包含，点查时不读
+    columns = [c for c in parquet_file.schema_arrow.names if c != analysis.LOGIN_MATRIX_COLUMN]
+    table = parquet_file.read_row_group(group, columns=columns).slice(offset - starts[group], 1)
+    return analysis.profiles_from_table(table.to_pandas())[0]
+
+def _load(index_dir):
+    """读取可写的索引（条目数组整体载入，用于更新）"""
+    meta_path = os.path.join(index_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return [], np.empty(0, dtype=INDEX_DTYPE)
+    with open(meta_path, encoding='utf-8') as f:
+        files = json.load(f)["files"]
+    return files, np.load(os.path.join(index_dir, INDEX_FILE))
+
+def _save(index_dir, files, entries):
+    """先写临时文件再替换，查询方不会读到写了一半的索引"""
+    tmp_path = os.path.join(index_dir, f"{INDEX_FILE}.tmp.npy")
+    np.save(tmp_path, entries)
+    os.replace(tmp_path, os.path.join(index_dir, INDEX_FILE))
+    tmp_path = os.path.join(index_dir, f"{META_FILE}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"files": files}, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, os.path.join(index_dir, META_FILE))
+
+def update_index(index_dir, profile_paths):
+    """
+    增量更新索引：只为新增或大小/修改时间变化的画像文件重建条目，与其余条目归并
+    参数:
+        index_dir (str): 索引所在目录（通常即画像输出目录）
+        profile_paths (list): 当前全部画像文件（parquet 或 json）；不在其中或已不存在的文件的条目被移除
+    返回:
+        int: 重建或移除条目的文件数
+    """
+    old_files, old_entries = _load(index_dir)
+    current = {os.path.relpath(path, index_dir) for path in profile_paths if os.path.exists(path)}
+    # 保留仍有效的文件并重新编号，移除的文件不再占用编号
+    kept_numbers = [i for i, info in enumerate(old_files)
+                    if info["path"] in current and os.path.exists(os.path.join(index_dir, info["path"]))]
+    removed = len(old_files) - len(kept_numbers)
+    renumber = np.full(len(old_files), -1, dtype=np.int32)
+    renumber[kept_numbers] = np.arange(len(kept_numbers), dtype=np.int32)
+    files = [old_files[i] for i in kept_numbers]
+    entries = old_entries[np.isin(old_entries['file'], kept_numbers)]
+    entries['file'] = renumber[entries['file']]
+    numbers = {info["path"]: i for i, info in enumerate(files)}
+    changed, new_entries = [], []
+    for path in profile_paths:
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        key = os.path.relpath(path, index_dir)
+        file_no = numbers.get(key)
+        if file_no is not None and files[file_no]["size"] == stat.st_size and files[file_no]["mtime"] == stat.st_mtime:
+            continue
+        if file_no is None:
+            file_no = numbers[key] = len(files)
+            files.append(None)
+        build = json_entries if path.endswith('.json') else parquet_entries
+        file_entries, info = build(path, file_no)
+        files[file_no] = {"path": key, "size": stat.st_size, "mtime": stat.st_mtime, "rows": len(file_entries), **info}
+        changed.append(file_no)
+        new_entries.append(file_entries)
+    if not changed and not removed:
+        return 0
+    # 保留的条目仍按 id 有序：只对新条目排序，再按 searchsorted 的位置一次插入（线性归并），不对全部条目重新排序
+    kept = entries[~np.isin(entries['file'], changed)]
+    new = np.concatenate(new_entries) if new_entries else np.empty(0, dtype=INDEX_DTYPE)
+    new = new[np.argsort(new['id'], kind='stable')]
+    merged = np.insert(kept, np.searchsorted(kept['id'], new['id'], 'right'), new)
+    _save(index_dir, files, merged)
+    return len(changed) + removed
+
+def profile_files(output_dir):
+    """输出目录中的全部画像文件；同一输入文件同时有 parquet 和 json 画像时只取较新的一个"""
+    latest = {}
+    for f in sorted(os.listdir(output_dir)):
+        for suffix in ('_profiles.parquet', '_profiles.json'):
+            if f.endswith(suffix):
+                path = os.path.join(output_dir, f)
+                source = f[:-len(suffix)]
+                if source not in latest or os.path.getmtime(path) > os.path.getmtime(latest[source]):
+                    latest[source] = path
+    return sorted(latest.values())
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="画像点查索引：按 user_id 查询单个用户画像")
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="建立或增量更新索引")
+    build_parser.add_argument('--output-dir', default='user_profiles', help="画像输出目录（索引写在该目录下）")
+    lookup_parser = subparsers.add_parser('lookup', help="查询用户画像（JSON 输出）")
+    lookup_parser.add_argument('user_ids', type=int, nargs='+', help="要查询的 user_id")
+    lookup_parser.add_argument('--output-dir', default='user_profiles', help="画像输出目录")
+    args = arg_parser.parse_args(argv)
+
+    if args.command == 'build':
+        start = time.time()
+        updated = update_index(args.output_dir, profile_files(args.output_dir))
+        print(f"索引已更新: 重建 {updated} 个文件 | 共 {len(ProfileIndex(args.output_dir))} 条 | "
+              f"耗时 {time.time()-start:.2f}秒")
+        return
+
+    if not os.path.exists(os.path.join(args.output_dir, META_FILE)):
+        print(f"错误: {args.output_dir} 下没有画像索引，请先运行 build", file=sys.stderr)
+        raise SystemExit(1)
+    index = ProfileIndex(args.output_dir)
+    for user_id in args.user_ids:
+        start = time.perf_counter()
+        profile = index.get(user_id)
+        elapsed = (time.perf_counter() - start) * 1000
+        if profile is None:
+            print(f"未找到用户 {user_id}", file=sys.stderr)
+            continue
+        print(json.dumps(profile, ensure_ascii=False, default=str))
+        print(f"查询耗时: {elapsed:.1f}ms", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
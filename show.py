@@ -1,22 +1,172 @@
 import os
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 from datetime import datetime
+import json
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import dataset
+from manifest import Manifest, DEFAULT_MANIFEST
+from metrics import METRICS
 
-# 设置文件夹路径
+# 设置文件夹路径（命令行 --input-dir 或位置参数可覆盖）
 folder_path = '/Users/aurora/Downloads/DATA/10G_data_new'
 
-def enhanced_user_analysis(folder_path):
+# 需要读取的列及各图表的分箱定义
+NEEDED_COLUMNS = ['age', 'is_active', 'income', 'registration_date']
+AGE_BINS = [0, 18, 25, 35, 45, 55, 65, 100]
+AGE_LABELS = ['0-18', '19-25', '26-35', '36-45', '46-55', '56-65', '65+']
+INCOME_BINS = [0, 30000, 50000, 75000, 100000, 150000, np.inf]
+INCOME_LABELS = [
+    '<30k', '30k-50k', '50k-75k', 
+    '75k-100k', '100k-150k', '>150k'
+]
+
+# 活跃用户收入分布的读取过滤条件（下推到 parquet 读取）
+ACTIVE_FILTER = [('is_active', '==', True)]
+
+# 缓存的分文件结果格式（格式或计数口径变化时清单中的旧记录失效；dates 为注册时间的解析方式）
+PARTIAL_PARAMS = {"partial": "counts", "dates": "iso8601+mixed"}
+
+class UserDistribution:
+    """
+    三个图表所需的计数器：年龄取值计数、活跃用户收入分箱计数、每日注册数
+    逐批累加，内存只与不同取值/天数有关，与数据量无关；可合并、可序列化
+    """
+
+    def __init__(self):
+        self.columns = set()
+        self.age_counts = pd.Series(dtype='int64')
+        self.active_users = 0
+        self.income_counts = pd.Series(0, index=INCOME_LABELS, dtype='int64')
+        self.daily_registrations = pd.Series(dtype='int64')
+        self.date_errors = 0
+
+    @staticmethod
+    def _add(total, counts):
+        return total.add(counts, fill_value=0).astype('int64')
+
+    def update(self, df):
+        """用一批数据更新计数"""
+        self.columns.update(df.columns)
+        if 'age' in df.columns:
+            self.age_counts = self._add(self.age_counts, df['age'].value_counts())
+        if 'is_active' in df.columns and 'income' in df.columns:
+            self.add_active_income(df.loc[df['is_active'] == True, 'income'])
+        if 'registration_date' in df.columns:
+            dates = df['registration_date']
+            if pd.api.types.is_numeric_dtype(dates):
+                # 如果是数字时间戳(假设是秒级)
+                dates = pd.to_datetime(dates, unit='s')
+            else:
+                # 与 check.py 相同的解析：ISO8601 失败的值再用 dateutil 解析，两次都失败的才计入 date_errors
+                dates = dataset.parse_date_column(dates).dt.tz_localize(None)
+                self.date_errors += int((dates.isna() & df['registration_date'].notna()).sum())
+            self.daily_registrations = self._add(self.daily_registrations, dates.dt.floor('D').value_counts())
+        return self
+
+    def add_active_income(self, active_income):
+        """累加活跃用户的收入分箱计数"""
+        self.active_users += len(active_income)
+        groups = pd.cut(active_income, bins=INCOME_BINS, labels=INCOME_LABELS, right=False)
+        self.income_counts = self._add(self.income_counts, groups.value_counts(sort=False))
+
+    def merge(self, other):
+        """合并另一个计数器"""
+        self.columns.update(other.columns)
+        self.age_counts = self._add(self.age_counts, other.age_counts)
+        self.active_users += other.active_users
+        self.income_counts = self._add(self.income_counts, other.income_counts)
+        self.daily_registrations = self._add(self.daily_registrations, other.daily_registrations)
+        self.date_errors += other.date_errors
+        return self
+
+    def to_dict(self):
+        return {
+            "columns": sorted(self.columns),
+            "age_counts": {repr(float(k)): int(v) for k, v in self.age_counts.items()},
+            "active_users": self.active_users,
+            "income_counts": {k: int(v) for k, v in self.income_counts.items()},
+            "daily_registrations": {k.isoformat(): int(v) for k, v in self.daily_registrations.items()},
+            "date_errors": self.date_errors,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        dist = cls()
+        dist.columns = set(data["columns"])
+        dist.age_counts = pd.Series({float(k): v for k, v in data["age_counts"].items()}, dtype='int64')
+        dist.active_users = data["active_users"]
+        dist.income_counts = pd.Series(data["income_counts"], dtype='int64').reindex(INCOME_LABELS, fill_value=0)
+        daily = data["daily_registrations"]
+        dist.daily_registrations = pd.Series(list(daily.values()), index=pd.to_datetime(list(daily)), dtype='int64')
+        dist.date_errors = data["date_errors"]
+        return dist
+
+def aggregate_file(file_path, batch_size=1_000_000, prefetch=dataset.PREFETCH_DEPTH):
+    """
+    只读取需要的列（年龄、收入降精度），按记录批次累加一个文件的计数；累加当前批时后台读取下一批
+    is_active 为布尔列时，活跃用户收入单独读取：is_active 条件下推到 parquet 读取，没有活跃用户的行组整个跳过
+    """
+    dist = UserDistribution()
+    schema = pq.read_schema(file_path)
+    pushdown = ('income' in schema.names and 'is_active' in schema.names
+                and pa.types.is_boolean(schema.field('is_active').type))
+    columns = [c for c in NEEDED_COLUMNS if not (pushdown and c in ('is_active', 'income'))]
+    for df in dataset.prefetch(dataset.iter_batches(file_path, columns, batch_size=batch_size), prefetch):
+        dist.update(df)
+    if pushdown:
+        dist.columns.update(['is_active', 'income'])
+        batches = dataset.iter_batches(file_path, ['income'], filters=ACTIVE_FILTER, batch_size=batch_size)
+        for df in dataset.prefetch(batches, prefetch):
+            dist.add_active_income(df['income'])
+    return dist
+
+def map_file(file_path, partial_path, prefetch=dataset.PREFETCH_DEPTH):
+    """
+    map 阶段：计算一个文件的计数并写入分文件结果（可在工作进程中运行）
+    返回:
+        (UserDistribution, dict): 计数与本任务的读取计数器（METRICS 格式，由主进程合并）
+    """
+    dist = aggregate_file(file_path, prefetch=prefetch)
+    save_partial(dist, partial_path)
+    return dist, METRICS.pop()
+
+def save_partial(dist, partial_path):
+    """写入单个文件的计数（先写临时文件再替换，中途崩溃不会留下截断的缓存）"""
+    tmp_path = f"{partial_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(dist.to_dict(), f)
+    os.replace(tmp_path, partial_path)
+
+def load_partial(partial_path):
+    """读取缓存的单个文件计数；文件损坏或不完整时返回 None，按未缓存处理重新计算"""
+    try:
+        with open(partial_path, encoding='utf-8') as f:
+            return UserDistribution.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"缓存的计数 {partial_path} 无法读取（{e}），重新计算")
+        return None
+
+def reduce_partials(partials):
+    """reduce 阶段：合并各文件的计数（合并满足结合律，顺序无关）"""
+    return functools.reduce(UserDistribution.merge, partials, UserDistribution())
+
+def enhanced_user_analysis(folder_path, workers=1, results_dir=None, visualize=True,
+                           prefetch=dataset.PREFETCH_DEPTH, manifest_path=DEFAULT_MANIFEST):
     """
     增强版用户数据分析:
     1. 用户年龄分布(饼图)
     2. 活跃用户收入分布(柱状图)
     3. 用户注册时间趋势(折线图)
+    workers > 1 时 map 阶段在进程池中并行，每个文件一个任务
+    results_dir 缺省为输入目录下的 analysis_results；visualize=False 时只输出汇总计数 JSON，不加载绘图库
+    prefetch 为每个文件内后台预读的批数（0 关闭）；manifest_path 为处理清单路径
     """
-    # 初始化DataFrame来存储所有数据
-    all_data = pd.DataFrame()
     parquet_files = [f for f in os.listdir(folder_path) if f.endswith('.parquet')]
     
     if not parquet_files:
@@ -25,61 +175,105 @@ def enhanced_user_analysis(folder_path):
     
     print(f"找到 {len(parquet_files)} 个Parquet文件，开始读取...")
     
-    # 逐个读取Parquet文件
-    for file in tqdm(parquet_files):
+    # 创建结果目录（partials 下缓存每个文件的计数，增量运行时未变化的文件直接复用）
+    results_dir = results_dir or os.path.join(folder_path, 'analysis_results')
+    partial_dir = os.path.join(results_dir, 'partials')
+    os.makedirs(partial_dir, exist_ok=True)
+    manifest = Manifest(manifest_path)
+    
+    partials, todo = [], {}
+    for file in parquet_files:
         file_path = os.path.join(folder_path, file)
-        try:
-            df = pd.read_parquet(file_path)
-            
-            # 选择需要的列(假设列名为'age', 'is_active', 'income', 'registration_date')
-            cols_to_keep = []
-            if 'age' in df.columns:
-                cols_to_keep.append('age')
-            if 'is_active' in df.columns:
-                cols_to_keep.append('is_active')
-            if 'income' in df.columns:
-                cols_to_keep.append('income')
-            if 'registration_date' in df.columns:
-                cols_to_keep.append('registration_date')
-            
-            if cols_to_keep:
-                all_data = pd.concat([all_data, df[cols_to_keep]], ignore_index=True)
-        except Exception as e:
-            print(f"读取文件 {file} 时出错: {e}")
-    
-    if all_data.empty:
+        partial_path = partial_path_for(file_path, results_dir)
+        cached = manifest.is_current(file_path, 'show', PARTIAL_PARAMS, [partial_path]) and load_partial(partial_path)
+        if cached:
+            partials.append(cached)
+        else:
+            todo[file_path] = partial_path
+    if partials:
+        print(f"{len(partials)} 个文件未变化，沿用缓存的计数")
+    
+    # map 阶段：只为新增或变化的文件计算计数
+    def done(file_path, result):
+        dist, metrics = result
+        METRICS.merge(metrics)
+        manifest.record(file_path, 'show', [todo[file_path]], params=PARTIAL_PARAMS)
+        partials.append(dist)
+    
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(map_file, fp, pp, prefetch): fp for fp, pp in todo.items()}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    done(futures[future], future.result())
+                except Exception as e:
+                    print(f"读取文件 {os.path.basename(futures[future])} 时出错: {e}")
+    else:
+        for file_path, partial_path in tqdm(todo.items()):
+            try:
+                done(file_path, map_file(file_path, partial_path, prefetch))
+            except Exception as e:
+                print(f"读取文件 {os.path.basename(file_path)} 时出错: {e}")
+    
+    dataset.report_read_stats()
+    
+    # reduce 阶段
+    total = reduce_partials(partials)
+    if visualize:
+        draw_charts(total, results_dir)
+    else:
+        save_distribution(total, results_dir)
+
+def partial_path_for(file_path, results_dir=None):
+    """单个文件计数结果的缓存路径（缺省为输入目录下 analysis_results/partials）"""
+    folder, file = os.path.split(file_path)
+    return os.path.join(results_dir or os.path.join(folder, 'analysis_results'), 'partials', f"{file}.json")
+
+def save_distribution(total, results_dir):
+    """无界面模式：把合并后的计数写成 distribution.json"""
+    path = os.path.join(results_dir, 'distribution.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(total.to_dict(), f, ensure_ascii=False)
+    print(f"汇总计数已保存至: {path}")
+
+def _pyplot():
+    """按需加载 matplotlib（只保存图片，使用无界面后端）"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def draw_charts(total, results_dir):
+    """由合并后的计数绘制三个图表"""
+    if not total.columns:
         print("没有找到有效数据")
         return
     
-    # 创建结果目录
-    results_dir = os.path.join(folder_path, 'analysis_results')
-    os.makedirs(results_dir, exist_ok=True)
-    
     # 1. 年龄分布分析(饼图)
-    if 'age' in all_data.columns:
-        analyze_age_distribution(all_data, results_dir)
+    if 'age' in total.columns:
+        analyze_age_distribution(total.age_counts, results_dir)
     
     # 2. 活跃用户收入分布(柱状图)
-    if 'is_active' in all_data.columns and 'income' in all_data.columns:
-        analyze_active_user_income(all_data, results_dir)
+    if 'is_active' in total.columns and 'income' in total.columns:
+        analyze_active_user_income(total, results_dir)
     
     # 3. 用户注册时间趋势(折线图)
-    if 'registration_date' in all_data.columns:
-        analyze_registration_trend(all_data, results_dir)
+    if 'registration_date' in total.columns:
+        analyze_registration_trend(total, results_dir)
 
-def analyze_age_distribution(data, save_dir):
-    """分析年龄分布并绘制饼图"""
+def analyze_age_distribution(age_counts, save_dir):
+    """分析年龄分布并绘制饼图（age_counts 为各年龄取值的计数）"""
+    plt = _pyplot()
     print("\n正在分析年龄分布...")
     
     # 统计年龄分布
-    age_distribution = data['age'].value_counts(normalize=True) * 100
+    age_distribution = age_counts.sort_values(ascending=False) / age_counts.sum() * 100
     
     # 如果年龄值过多，进行分组
     if len(age_distribution) > 15:
-        bins = [0, 18, 25, 35, 45, 55, 65, 100]
-        labels = ['0-18', '19-25', '26-35', '36-45', '46-55', '56-65', '65+']
-        data['age_group'] = pd.cut(data['age'], bins=bins, labels=labels, right=False)
-        age_distribution = data['age_group'].value_counts(normalize=True) * 100
+        age_group = pd.cut(age_counts.index, bins=AGE_BINS, labels=AGE_LABELS, right=False)
+        group_counts = age_counts.groupby(age_group, observed=False).sum()
+        age_distribution = group_counts / group_counts.sum() * 100
         age_distribution = age_distribution.sort_index()
         
         # 绘制分组后的饼图
@@ -103,35 +297,17 @@ def analyze_age_distribution(data, save_dir):
     print(f"年龄分布饼图已保存至: {save_path}")
     plt.close()
 
-def analyze_active_user_income(data, save_dir):
-    """分析活跃用户收入分布并绘制柱状图"""
+def analyze_active_user_income(dist, save_dir):
+    """分析活跃用户收入分布并绘制柱状图（dist 为 UserDistribution 计数器）"""
+    plt = _pyplot()
     print("\n正在分析活跃用户收入分布...")
     
-    # 筛选活跃用户
-    active_users = data[data['is_active'] == True]
-    
-    if active_users.empty:
+    if dist.active_users == 0:
         print("没有活跃用户数据")
         return
     
-    # 定义收入区间(可根据实际数据调整)
-    income_bins = [0, 30000, 50000, 75000, 100000, 150000, np.inf]
-    income_labels = [
-        '<30k', '30k-50k', '50k-75k', 
-        '75k-100k', '100k-150k', '>150k'
-    ]
-    
-    # 分类收入
-    active_users['income_group'] = pd.cut(
-        active_users['income'], 
-        bins=income_bins, 
-        labels=income_labels,
-        right=False
-    )
-    
-    # 统计各收入区间占比
-    income_dist = active_users['income_group'].value_counts(normalize=True) * 100
-    income_dist = income_dist.sort_index()
+    # 统计各收入区间占比（区间见 INCOME_BINS）
+    income_dist = dist.income_counts / dist.income_counts.sum() * 100
     
     # 绘制柱状图
     plt.figure(figsize=(12, 6))
@@ -157,27 +333,22 @@ def analyze_active_user_income(data, save_dir):
     print(f"活跃用户收入分布图已保存至: {save_path}")
     plt.close()
 
-def analyze_registration_trend(data, save_dir):
-    """分析用户注册时间趋势并绘制折线图"""
+def analyze_registration_trend(dist, save_dir):
+    """分析用户注册时间趋势并绘制折线图（dist 为 UserDistribution 计数器）"""
+    plt = _pyplot()
     print("\n正在分析用户注册时间趋势...")
     
-    # 转换日期格式(假设是时间戳或字符串)
-    try:
-        if np.issubdtype(data['registration_date'].dtype, np.number):
-            # 如果是数字时间戳(假设是秒级)
-            data['registration_date'] = pd.to_datetime(data['registration_date'], unit='s')
-        else:
-            # 尝试自动解析日期字符串
-            data['registration_date'] = pd.to_datetime(data['registration_date'])
-    except Exception as e:
-        print(f"日期转换出错: {e}")
+    if dist.date_errors:
+        print(f"日期转换出错: {dist.date_errors} 条注册日期无法解析，已忽略")
+    if dist.daily_registrations.empty:
+        print("没有可用的注册日期数据")
         return
     
     # 按日期统计注册量
-    reg_daily = data['registration_date'].dt.floor('D').value_counts().sort_index()
+    reg_daily = dist.daily_registrations.sort_index()
     
     # 按月统计(备选方案)
-    reg_monthly = data['registration_date'].dt.to_period('M').value_counts().sort_index()
+    reg_monthly = reg_daily.groupby(reg_daily.index.to_period('M')).sum().sort_index()
     reg_monthly.index = reg_monthly.index.to_timestamp()
     
     # 绘制折线图
@@ -207,5 +378,21 @@ def analyze_registration_trend(data, save_dir):
     print(f"用户注册趋势图已保存至: {save_path}")
     plt.close()
 
-# 执行分析
-enhanced_user_analysis(folder_path)
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="用户数据分布分析")
+    arg_parser.add_argument('input_path', nargs='?', help="输入 Parquet 目录（同 --input-dir，保留兼容旧用法）")
+    arg_parser.add_argument('--input-dir', help="输入 Parquet 目录")
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count(), help="map 阶段的并行进程数")
+    arg_parser.add_argument('--output-dir', help="结果目录（缺省为输入目录下的 analysis_results）")
+    arg_parser.add_argument('--no-viz', action='store_true', help="无界面模式：只输出汇总计数，不绘图")
+    arg_parser.add_argument('--prefetch', type=int, default=dataset.PREFETCH_DEPTH,
+                            help="预读深度：处理当前批时后台提前读取的批数（0 关闭）")
+    arg_parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help="处理清单路径（增量运行）")
+    args = arg_parser.parse_args(argv)
+    
+    # 执行分析
+    input_dir = args.input_dir or args.input_path or folder_path
+    enhanced_user_analysis(input_dir, args.workers, args.output_dir, not args.no_viz, args.prefetch, args.manifest)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import math
+import numpy as np
+
+# 可合并的流式统计：各文件/各进程分别累计，最后合并得到全量数据集的统计量，
+# 结果与数据如何切分无关
+
+class RunningStats:
+    """计数、均值、M2（Welford/Chan 算法），可按批更新并与其他实例合并"""
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, min=math.inf, max=-math.inf):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    def update(self, values):
+        """用一批数值更新（忽略空值）"""
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.size:
+            batch_mean = values.mean()
+            batch = RunningStats(values.size, batch_mean, float(((values - batch_mean) ** 2).sum()),
+                                 float(values.min()), float(values.max()))
+            self.merge(batch)
+        return self
+
+    def merge(self, other):
+        """合并另一个实例（Chan 并行算法）"""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def std(self, ddof=1):
+        """标准差（默认样本标准差，与 pandas.Series.std 一致）"""
+        if self.count <= ddof:
+            return float('nan')
+        return math.sqrt(self.m2 / (self.count - ddof))
+
+    def to_dict(self):
+        return {"count": self.count, "mean": self.mean, "m2": self.m2, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+class QuantileSketch:
+    """
+    相对误差分位数草图（DDSketch 思路）
+    数值按对数分桶计数，返回的分位数相对误差不超过 relative_accuracy；
+    桶计数直接相加即可合并，内存只与数值的量级范围有关
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _add_buckets(self, store, magnitudes):
+        keys, counts = np.unique(np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def update(self, values):
+        """用一批数值更新（忽略空值）"""
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self._add_buckets(self.positive, values[values > 0])
+        self._add_buckets(self.negative, -values[values < 0])
+        self.zero_count += int(np.count_nonzero(values == 0))
+        self.count += values.size
+        return self
+
+    def merge(self, other):
+        """合并另一个草图（精度参数须一致）"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("只能合并相同精度的分位数草图")
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def _bucket_value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """近似分位数，q 取 [0, 1]"""
+        if self.count == 0:
+            return float('nan')
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._bucket_value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._bucket_value(key)
+        return self._bucket_value(max(self.positive))
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": {str(k): v for k, v in self.positive.items()},
+            "negative": {str(k): v for k, v in self.negative.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        sketch.positive = {int(k): v for k, v in data["positive"].items()}
+        sketch.negative = {int(k): v for k, v in data["negative"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        return sketch
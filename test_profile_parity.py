@@ -0,0 +1,86 @@
+import math
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import analysis
+
+# 批量画像与逐行画像的一致性：在带脏数据的合成数据上逐个用户比较字段值和类型
+
+CATEGORIES = ['电子产品', '服装', '食品', '家居']
+PAYMENT_METHODS = ['支付宝', '微信支付', '信用卡']
+PAYMENT_STATUS = ['已支付', '部分退款', '已退款']
+ADDRESSES = ['北京市朝阳区', '上海市浦东新区', '苏州工业园区', '大理州', '某某县城关镇', '未知地址']
+
+def normalize(value):
+    """去掉原始历史字段，列表按内容排序（devices 顺序不固定），数值带上类型以便发现 int/float 不一致"""
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.items() if not k.startswith('_raw')}
+    if isinstance(value, list):
+        return sorted(value)
+    if isinstance(value, float) and math.isnan(value):
+        return 'nan'
+    if isinstance(value, (int, float)):
+        return type(value).__name__, value
+    return value
+
+def _purchase(rng):
+    record = {"avg_price": round(float(rng.uniform(10, 5000)), 2),
+              "categories": ",".join(rng.choice(CATEGORIES, 2)),
+              "items": [{"id": j} for j in range(int(rng.integers(0, 5)))],
+              "payment_method": str(rng.choice(PAYMENT_METHODS)),
+              "payment_status": str(rng.choice(PAYMENT_STATUS))}
+    return json.dumps(record, ensure_ascii=False)
+
+def _login(rng):
+    # 时间都在参考时间30天以前，逐行与批量各自取当前时间也不影响 last_30d_logins
+    days = rng.integers(0, 3000, int(rng.integers(0, 8)))
+    stamps = [str(np.datetime64('2015-01-01T08:00:00') + np.timedelta64(int(d), 'D')) for d in days]
+    return json.dumps({"timestamps": stamps, "devices": ['mobile', 'desktop'][:int(rng.integers(1, 3))],
+                       "avg_session_duration": round(float(rng.uniform(1, 120)), 1)})
+
+@pytest.fixture(scope='module')
+def dirty_df():
+    rng = np.random.default_rng(1)
+    n = 500
+    # 最近登录只精确到日：recency 只在跨过 UTC 零点时变化，两条路径各取当前时间也一致
+    last_login = [str(np.datetime64('2018-01-01') + np.timedelta64(int(d), 'D')) for d in rng.integers(0, 2000, n)]
+    df = pd.DataFrame({
+        'id': np.arange(n),
+        'age': rng.integers(16, 80, n).astype(object),
+        'income': np.round(rng.lognormal(11, 1, n), 2),
+        'gender': rng.choice(['男', '女', "'男'", '其他'], n),
+        'country': rng.choice(['中国', '美国', '日本'], n),
+        'address': rng.choice(ADDRESSES, n),
+        'last_login': last_login,
+        'registration_date': '2017-06-01',
+        'purchase_history': [_purchase(rng) for _ in range(n)],
+        'login_history': [_login(rng) for _ in range(n)],
+    })
+    # 脏数据：非数值/空/越界年龄、空收入、无法解析的时间、非法/类 JSON/空的历史
+    df.loc[[3, 7], 'age'] = 'abc'
+    df.loc[[5, 9], 'age'] = None
+    df.loc[[11, 13], 'age'] = [-5, 150]
+    df.loc[15, 'income'] = np.nan
+    df.loc[17, 'last_login'] = 'notadate'
+    df.loc[[19, 21], 'purchase_history'] = ['{invalid json', None]
+    df.loc[[23, 25], 'login_history'] = ['{invalid json', None]
+    df.loc[27, 'purchase_history'] = df.loc[27, 'purchase_history'].replace('"', "'")
+    return df
+
+def test_batch_matches_row_profiles(dirty_df):
+    batch = analysis.profiles_from_table(analysis.build_profiles_batch(dirty_df))
+    assert len(batch) == len(dirty_df)
+    for (_, row), record in zip(dirty_df.iterrows(), batch):
+        profile = analysis.build_user_profile(row)
+        assert profile is not None, row['id']
+        assert normalize(profile) == normalize(record['profile']), row['id']
+
+def test_non_numeric_age_is_unknown(dirty_df):
+    for i in (3, 5, 7, 9):
+        assert analysis.build_user_profile(dirty_df.loc[i])['basic']['age_segment'] == "未知"
+
+def test_empty_purchase_history_is_float(dirty_df):
+    profile = analysis.build_user_profile(dirty_df.loc[21])
+    assert isinstance(profile['consumption']['avg_price'], float)
+    assert isinstance(profile['value']['monetary'], float)